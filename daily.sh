@@ -5,4 +5,4 @@
 # `load_from_api` is able to do adhoc imports of any content though.
 
 ./manage.sh load_from_api --target profiles elife-metrics community reviewed-preprints
-./manage.sh load_from_api --target lax --days 2
+./manage.sh load_from_api --target lax --days 2 --workers 4
@@ -122,7 +122,19 @@ CONN_MAX_AGE = 0 # 0 = no pooling
 API_URL = cfg('general.api-url')
 EVENT_QUEUE = cfg('sqs.queue-name', None) # ll: observer--ci, observer--prod, observer--2017-04-282
 FEEDLY_GA_MEASUREMENT_ID = cfg('general.feedly-ga-measurement-id', None) or 'G-xxxxxxxxxx'
-SECONDS_BETWEEN_REQUESTS = 0.2 # 200ms
+SECONDS_BETWEEN_REQUESTS = 0.2 # 200ms, on average. see `consume.LIMITER`
+MAX_CONCURRENT_REQUESTS = int(cfg('general.max-concurrent-requests', 4))
+# connections to the API are pooled and kept alive, see `consume.session`
+HTTP_POOL_SIZE = max(MAX_CONCURRENT_REQUESTS, int(cfg('general.http-pool-size', 10)))
+HTTP_CONNECT_TIMEOUT = float(cfg('general.http-connect-timeout', 10)) # seconds
+HTTP_READ_TIMEOUT = float(cfg('general.http-read-timeout', 60)) # seconds
+# on-disk cache of API responses that are revalidated with conditional requests, see `http_cache`.
+# opt-in, disabled if no directory given. `daily.sh` only sends conditional requests once this is set.
+API_CACHE_DIR = cfg('general.api-cache-dir', None) or None
+API_CACHE_MAX_BYTES = int(cfg('general.api-cache-max-bytes', 1024 * 1024 * 1024)) # 1GiB
+# articles are regenerated in batches sized to take about this long to commit, see `ingest_logic.regenerate_many_articles`
+REGEN_COMMIT_SECONDS = float(cfg('general.regen-commit-seconds', 2)) # seconds
+REGEN_MAX_BATCH_SIZE = int(cfg('general.regen-max-batch-size', 500))
 
 # Internationalization
 
@@ -0,0 +1,333 @@
+"""benchmarks of observer's ingestion.
+
+each benchmark returns a map of results that `report` prints.
+benchmarks that write to the database should be run inside `throwaway_database`."""
+
+import copy, glob, io, json, os, time
+import contextlib, multiprocessing, resource, tracemalloc
+from et3 import render
+from dateutil import parser
+from rfc3339 import rfc3339
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import override_settings
+from . import consume, fake_api, models, http_stats, ingest_logic, logic, utils
+import logging
+
+LOG = logging.getLogger(__name__)
+
+@contextlib.contextmanager
+def throwaway_database():
+    "creates an empty database, like the test runner does, and destroys it afterwards"
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+@contextlib.contextmanager
+def fake_api_running(rate=None, **kwargs):
+    """starts a `fake_api.FakeAPI` server and points observer at it.
+    the on-disk API cache is disabled and requests are made at `rate` requests per second."""
+    server = fake_api.start(**kwargs)
+    limiter = consume.LIMITER
+    if rate:
+        consume.LIMITER = consume.TokenBucket(rate=rate, capacity=settings.MAX_CONCURRENT_REQUESTS)
+    try:
+        with override_settings(API_URL=server.url, API_CACHE_DIR=None):
+            yield server
+    finally:
+        consume.LIMITER = limiter
+        server.stop()
+
+def report(title, results, stdout=None):
+    "prints the given map of `results`"
+    print(title, file=stdout)
+    width = max(len(key) for key in results)
+    for key, val in results.items():
+        if isinstance(val, float):
+            val = "%.2f" % val
+        print("  %s  %s" % (key.ljust(width), val), file=stdout)
+
+#
+# benchmarks
+#
+
+def load_from_api(scale=1, latency=0, error_rate=0, padding=0, rate=None, quiet=True, **options):
+    """runs `./manage.sh load_from_api` end to end against a `fake_api` with the given `options`.
+    returns a map of results."""
+    with fake_api_running(scale=scale, latency=latency, error_rate=error_rate, padding=padding, rate=rate) as server:
+        stdout = io.StringIO() if quiet else None
+        start = time.monotonic()
+        with contextlib.redirect_stdout(stdout) if quiet else contextlib.nullcontext():
+            try:
+                call_command('load_from_api', **options)
+            except SystemExit as err:
+                if err.code:
+                    raise
+        elapsed = time.monotonic() - start
+        stats = server.stats()
+    http = http_stats.STATS.as_dict().values()
+
+    num_articles = models.Article.objects.count()
+    return {
+        'elapsed (seconds)': elapsed,
+        'requests': stats['requests'],
+        'errors': stats['errors'],
+        'retries': sum(entry['retries'] for entry in http),
+        'backoff (seconds)': sum(entry['backoff-seconds'] for entry in http),
+        'MiB received': stats['bytes'] / 1024 / 1024,
+        'requests/sec': stats['requests'] / elapsed,
+        'articles': num_articles,
+        'articles/sec': num_articles / elapsed,
+        'raw json rows': models.RawJSON.objects.count(),
+    }
+
+def regenerate(scale=1, workers=1):
+    """loads content from a `fake_api` and times regenerating all of it with `ingest_logic.regenerate_all`
+    using `workers` processes. returns a map of results."""
+    load_from_api(scale=scale, rate=1000, workers=4)
+    start = time.monotonic()
+    ingest_logic.regenerate_all(workers=workers)
+    elapsed = time.monotonic() - start
+    num_articles = models.Article.objects.count()
+    num_rows = models.RawJSON.objects.count()
+    return {
+        'workers': workers,
+        'elapsed (seconds)': elapsed,
+        'raw json rows': num_rows,
+        'rows/sec': num_rows / elapsed,
+        'articles': num_articles,
+        'articles/sec': num_articles / elapsed,
+    }
+
+def _article_corpus():
+    "returns the article-json fixtures prepared like `ingest_logic.flatten_article_json` does"
+    version_list = []
+    for path in sorted(glob.glob(os.path.join(fake_api.FIXTURE_DIR, 'ajson', '*.json'))):
+        with open(path, 'r') as fh:
+            version_list.append(json.load(fh))
+    for data in version_list:
+        data['known-versions'] = [v for v in version_list if v['id'] == data['id']]
+        data['history'] = {}
+        data['metrics'] = {}
+    return version_list
+
+def flatten(iterations=100):
+    """times flattening article-json with `ingest_logic.DESC` interpreted by `et3.render.render_item`
+    and compiled by `extractors.compile_description`. returns a map of results."""
+    data_list = _article_corpus()
+
+    def timed(fn):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            for data in data_list:
+                fn(data)
+        return (time.perf_counter() - start) / (iterations * len(data_list))
+
+    interpreted = timed(lambda data: render.render_item(ingest_logic.DESC, data))
+    compiled = timed(ingest_logic.render_article)
+    return {
+        'articles': len(data_list) * iterations,
+        'interpreted (ms/article)': interpreted * 1000,
+        'compiled (ms/article)': compiled * 1000,
+        'speedup': interpreted / compiled,
+    }
+
+def _dict_update_copying(d1, d2):
+    "`utils.dict_update(d1, d2, immutable=True)` as it was, when `utils.deepcopy` was `copy.deepcopy`"
+    d1 = copy.deepcopy(d1)
+    d1.update(d2)
+    return d1
+
+def _extract_children_original(mush):
+    """`ingest_logic.extract_children` as it was originally, before authors had a key, unchanged except for calling
+    `_dict_update_copying`"""
+
+    assert isinstance(mush, dict), "`extract_children` must be a dictionary of data, not %r" % type(mush)
+
+    known_children = {
+        'subjects': {'Model': models.Subject, 'key_list': ["name"]},
+        'authors': {'Model': models.Author},
+        'categories': {'Model': models.ContentCategory, 'key_list': ["name"]},
+    }
+
+    children = []
+    for childtype, kwargs in known_children.items():
+        # if 'categories' in 'digest'
+        # if 'authors' in 'article'
+        if childtype in mush:
+            data = mush[childtype]
+            children.extend([_dict_update_copying(kwargs, {'orig_data': row, 'parent-relation': childtype}) for row in data])
+
+    # remove the children from the mush, they must be saved separately
+    utils.delall(mush, known_children.keys())
+    return mush, children
+
+def _extract_children_copying(mush):
+    """`ingest_logic.extract_children` as it was just before child records stopped being copied, when each author
+    was copied to add it's key, unchanged except for calling `_dict_update_copying`"""
+
+    assert isinstance(mush, dict), "`extract_children` must be a dictionary of data, not %r" % type(mush)
+
+    known_children = {
+        'subjects': {'Model': models.Subject, 'key_list': ["name"]},
+        # authors are never updated, only created, so they can be interned. see `utils.interning`
+        'authors': {'Model': models.Author, 'key_list': ["key"], 'intern': True},
+        'categories': {'Model': models.ContentCategory, 'key_list': ["name"]},
+    }
+
+    if 'authors' in mush:
+        mush['authors'] = [dict(author, key=models.author_key(author['type'], author['name'], author['country']))
+                           for author in mush['authors']]
+
+    children = []
+    for childtype, kwargs in known_children.items():
+        # if 'categories' in 'digest'
+        # if 'authors' in 'article'
+        if childtype in mush:
+            data = mush[childtype]
+            children.extend([_dict_update_copying(kwargs, {'orig_data': row, 'parent-relation': childtype}) for row in data])
+
+    # remove the children from the mush, they must be saved separately
+    utils.delall(mush, known_children.keys())
+    return mush, children
+
+def allocations(iterations=20):
+    """measures the time taken and memory allocated extracting the child records of flattened article-json with
+    `ingest_logic.extract_children`, as it was when each child record was copied and as it was originally.
+    the original doesn't give authors a key, so it does less work than the others. returns a map of results."""
+    mush_list = [ingest_logic.render_article(data) for data in _article_corpus()]
+    num_articles = len(mush_list) * iterations
+
+    def measure(fn):
+        "returns a pair of (microseconds, KiB allocated and kept) per article"
+        input_list = [copy.deepcopy(mush) for _ in range(iterations) for mush in mush_list]
+        start = time.perf_counter()
+        list(map(fn, input_list))
+        elapsed = time.perf_counter() - start
+
+        input_list = [copy.deepcopy(mush) for _ in range(iterations) for mush in mush_list]
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            result = list(map(fn, input_list)) # keep the results
+            allocated = tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+        del result
+        return elapsed / num_articles * 1000000, allocated / num_articles / 1024
+
+    original_time, original_kib = measure(_extract_children_original)
+    copying_time, copying_kib = measure(_extract_children_copying)
+    copy_free_time, copy_free_kib = measure(ingest_logic.extract_children)
+    return {
+        'articles': num_articles,
+        'original (us/article)': original_time,
+        'copying (us/article)': copying_time,
+        'copy-free (us/article)': copy_free_time,
+        'original (KiB/article)': original_kib,
+        'copying (KiB/article)': copying_kib,
+        'copy-free (KiB/article)': copy_free_kib,
+        'reduction': 1 - copy_free_kib / copying_kib,
+    }
+
+# keys of the fixture data whose values are timestamps
+DATE_KEYS = ['published', 'updated', 'versionDate', 'statusDate', 'reviewedDate', 'sentForReview']
+
+def _timestamps(data):
+    "yields the timestamps in `data`, a fixture or part of one"
+    if isinstance(data, dict):
+        for key, val in data.items():
+            if key in DATE_KEYS and isinstance(val, str):
+                yield val
+            else:
+                yield from _timestamps(val)
+    elif isinstance(data, list):
+        for val in data:
+            yield from _timestamps(val)
+
+def dates(iterations=20):
+    """times parsing the timestamps found in the fixtures with `dateutil` and `utils.todt`, as ingestion does,
+    and formatting them with `rfc3339` and `utils.ymdhms`, as reports do. returns a map of results."""
+    val_list = []
+    for path in sorted(glob.glob(os.path.join(fake_api.FIXTURE_DIR, '*', '*.json'))):
+        with open(path, 'r') as fh:
+            val_list.extend(_timestamps(json.load(fh)))
+    dt_list = [utils.todt(val) for val in val_list]
+
+    def timed(fn, arg_list):
+        "returns the mean number of microseconds `fn` takes per item in `arg_list`"
+        start = time.perf_counter()
+        for _ in range(iterations):
+            for arg in arg_list:
+                fn(arg)
+        return (time.perf_counter() - start) / (iterations * len(arg_list)) * 1000000
+
+    utils._str_todt.cache_clear()
+    return {
+        'timestamps': len(val_list),
+        'unique timestamps': len(set(val_list)),
+        'dateutil (us/timestamp)': timed(lambda val: utils._utc(parser.parse(val, fuzzy=False)), val_list),
+        'todt, uncached (us/timestamp)': timed(utils._str_todt.__wrapped__, val_list),
+        'todt (us/timestamp)': timed(utils.todt, val_list),
+        'rfc3339 (us/row)': timed(lambda dt: rfc3339(utils.todt(dt), utc=True), dt_list),
+        'ymdhms (us/row)': timed(utils.ymdhms, dt_list),
+    }
+
+def synthetic_raw_json(rows=1000000, batch_size=10000):
+    "inserts `rows` rows of article-json with a unique manuscript id each and empty json"
+    with connection.cursor() as cursor:
+        for batch in utils.partition(range(1, rows + 1), batch_size):
+            cursor.executemany(
+                "INSERT INTO observer_rawjson (msid, version, json, json_type, dirty) VALUES (%s, 1, '{}', %s, %s)",
+                [(str(msid), models.LAX_AJSON, True) for msid in batch])
+
+def _max_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _measured(fn, conn):
+    "calls `fn` and sends the growth of the peak resident set size of this process, in KiB, and the seconds taken to `conn`"
+    start, peak = time.monotonic(), _max_rss()
+    fn()
+    conn.send((_max_rss() - peak, time.monotonic() - start))
+    conn.close()
+
+def measure_memory(fn):
+    """calls `fn` in a forked process, that starts with a copy of this process's memory, and returns a pair of
+    (MiB the peak resident set size grew by, seconds taken)"""
+    if connection.vendor != 'sqlite':
+        # the connection can't be shared with a forked process. in-memory sqlite databases are copied.
+        connection.close()
+    ctx = multiprocessing.get_context('fork')
+    reader, writer = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_measured, args=(fn, writer))
+    proc.start()
+    growth, elapsed = reader.recv()
+    proc.join()
+    return growth / 1024, elapsed
+
+def stream_ids(rows=1000000, batches_of=25):
+    """times iterating over the manuscript ids of `rows` rows of synthetic raw json in batches, as article
+    regeneration does, by evaluating `logic.known_articles` and by streaming it with `utils.iter_chunked`.
+    returns a map of results, including how much peak memory usage grew while iterating."""
+    synthetic_raw_json(rows)
+
+    def evaluated():
+        # ids are held in the queryset's result cache and a result is kept per batch
+        utils.lmap(len, utils.partition(logic.known_articles(), batches_of))
+
+    def streamed():
+        for batch in utils.partition(utils.iter_chunked(logic.known_articles()), batches_of):
+            len(batch)
+
+    evaluated_growth, evaluated_elapsed = measure_memory(evaluated)
+    streamed_growth, streamed_elapsed = measure_memory(streamed)
+    return {
+        'rows': rows,
+        'evaluated (seconds)': evaluated_elapsed,
+        'evaluated, peak memory growth (MiB)': evaluated_growth,
+        'streamed (seconds)': streamed_elapsed,
+        'streamed, peak memory growth (MiB)': streamed_growth,
+    }
@@ -1,11 +1,14 @@
+import os
+import json
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import backoff, requests, requests_cache
-from . import utils, models
+from . import utils, models, http_cache, http_stats
 from slugify import slugify
 import math
 from datetime import timedelta
 from django.conf import settings
-from django.db import transaction
 import logging
 
 LOG = logging.getLogger(__name__)
@@ -22,15 +25,119 @@ if settings.DEBUG:
         'expire_after': timedelta(hours=24)
     })
 
+#
+# rate limiting
+#
+
+class TokenBucket:
+    """a thread-safe token bucket.
+    tokens are added at `rate` tokens per second up to a maximum of `capacity` tokens.
+    each request takes a token, blocking until one is available."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        "blocks until a token is available. returns the number of seconds spent waiting."
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+class AIMD:
+    """additive-increase, multiplicative-decrease of a concurrency `limit`.
+    requests report whether they were throttled (429, 5xx, connection errors) with `record`.
+    each call to `adjust` inspects the requests recorded since the previous call:
+    if the throttled rate is above `threshold` the limit is halved, otherwise it grows by one."""
+
+    def __init__(self, minimum, maximum, threshold=0.05):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.threshold = threshold
+        self.limit = minimum
+        self.requests = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def record(self, throttled=False):
+        with self.lock:
+            self.requests += 1
+            if throttled:
+                self.throttled += 1
+
+    def adjust(self):
+        "returns the new concurrency limit"
+        with self.lock:
+            if self.requests:
+                if (self.throttled / self.requests) > self.threshold:
+                    self.limit = max(self.minimum, self.limit // 2)
+                    LOG.warning("%s of %s requests throttled, reducing concurrency to %s", self.throttled, self.requests, self.limit)
+                else:
+                    self.limit = min(self.maximum, self.limit + 1)
+            self.requests = self.throttled = 0
+            return self.limit
+
+# shared by all threads. requests to the API are made at an average rate of one every `SECONDS_BETWEEN_REQUESTS`.
+LIMITER = TokenBucket(rate=1 / settings.SECONDS_BETWEEN_REQUESTS, capacity=settings.MAX_CONCURRENT_REQUESTS)
+CONCURRENCY = AIMD(minimum=1, maximum=settings.MAX_CONCURRENT_REQUESTS)
+
+def _throttled(status_code):
+    "returns `True` if the response status code suggests the API would like us to slow down"
+    return status_code == 429 or status_code >= 500
+
+#
+# http sessions
+#
+
+_SESSION = {'pid': None, 'session': None}
+_SESSION_LOCK = threading.Lock()
+
+def session():
+    """returns a `requests.Session` shared by all threads in the current process.
+    connections to `settings.API_URL` are pooled and kept alive between requests.
+    a new session is created if the process has been forked."""
+    with _SESSION_LOCK:
+        pid = os.getpid()
+        if _SESSION['pid'] != pid:
+            sess = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=settings.HTTP_POOL_SIZE)
+            sess.mount(settings.API_URL, adapter)
+            _SESSION.update({'pid': pid, 'session': sess})
+        return _SESSION['session']
+
+def threads_allowed():
+    """returns `True` if the API can be requested from many threads at once.
+    the cache installed by `requests_cache` in DEBUG mode replaces `requests.Session` and it's sqlite backend
+    can't be shared between threads."""
+    return not issubclass(requests.Session, requests_cache.CachedSession)
+
+#
+#
+#
+
 def _giveup(err):
-    "accepts the exception and returns a truthy value if the exception should not be retried"
-    if err.response.status_code == 404:
-        return True
+    """accepts the exception and returns a truthy value if the exception should not be retried.
+    connection errors and timeouts have no response and are always retried."""
+    return err.response is not None and err.response.status_code == 404
 
 def _giving_up(details):
+    http_stats.STATS.giveup(details['args'][0])
     LOG.warn("request %s failed after %s attempts", details['args'][0], details['tries'])
 
 def _retrying(details):
+    http_stats.STATS.retry(details['args'][0], details['wait'])
     LOG.warn("re-attempting request: %s", details['args'][0])
 
 @backoff.on_exception(
@@ -42,28 +149,63 @@ def _retrying(details):
     on_giveup=_giving_up,
     max_time=300 # seconds, 5mins
 )
-def requests_get(*args, **kwargs):
-    "requests.get wrapper that handles attempts to re-try a request on error EXCEPT on 404 responses"
+def requests_get(url, params=None, **kwargs):
+    """`requests.get` wrapper that handles attempts to re-try a request on error EXCEPT on 404 responses.
+    requests are made using the pooled connections of the shared `session`.
+    each attempt is recorded in `http_stats.STATS`."""
     headers = kwargs.pop('headers', {})
     headers['user-agent'] = 'observer/unreleased (https://github.com/elifesciences/observer)'
     kwargs['headers'] = headers
-    resp = requests.get(*args, **kwargs)
-    resp.raise_for_status()
+    kwargs.setdefault('timeout', (settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT))
+    limiter_wait = LIMITER.take()
+    start = time.monotonic()
+    try:
+        resp = session().get(url, params=params, **kwargs)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+        http_stats.STATS.request(url, None, time.monotonic() - start, limiter_wait=limiter_wait)
+        CONCURRENCY.record(throttled=True)
+        raise
+    http_stats.STATS.request(url, resp.status_code, time.monotonic() - start, len(resp.content or b''), limiter_wait)
+    try:
+        resp.raise_for_status()
+    except requests.exceptions.HTTPError:
+        CONCURRENCY.record(throttled=_throttled(resp.status_code))
+        raise
+    CONCURRENCY.record()
     return resp
 
+def cached_get(url, params):
+    """returns the decoded JSON response of a GET request to `url` with `params`.
+    if the `http_cache` is enabled, previously cached responses are revalidated and served from disk
+    when the API responds with a '304 Not Modified'."""
+    if not http_cache.enabled():
+        return requests_get(url, params).json()
+
+    entry = http_cache.get(url, params)
+    headers = http_cache.conditional_headers(entry) if entry else {}
+    resp = requests_get(url, params, headers=headers)
+    if entry and resp.status_code == 304:
+        http_cache.revalidated(url, params, entry, resp)
+        return json.loads(entry['body'])
+    http_cache.put(url, params, resp)
+    return resp.json()
+
 def consume(endpoint, user_params={}):
     params = {'per-page': 100, 'page': 1}
     params.update(user_params)
     url = settings.API_URL + "/" + endpoint.strip('/')
     LOG.info('fetching %s params %s' % (url, params))
+    start = time.monotonic()
     try:
-        return requests_get(url, params).json()
+        return cached_get(url, params)
     except requests.exceptions.RequestException as err:
-        if not err.response.status_code == 404:
+        if err.response is None or err.response.status_code != 404:
             # we expect 404s on unpublished content. everything else should be logged.
             context = {'url': url, 'params': params, 'user-params': user_params}
             LOG.error("failed to fetch %s: %s", endpoint, err, extra=context)
         raise err
+    finally:
+        http_stats.STATS.call(url, time.monotonic() - start)
 
 
 #
@@ -73,6 +215,28 @@ def consume(endpoint, user_params={}):
 def default_idfn(row):
     return row['id']
 
+def upsert_raw_json(data, key_list):
+    """creates or updates a `models.RawJSON` row from the map of RawJSON fields in `data`.
+    rows whose content hasn't changed since they were last stored are not written, otherwise they are marked dirty.
+    returns a triple of (inst, created, updated), like `utils.create_or_update`."""
+    data = dict(data, content_hash=utils.content_hash(data['json']), dirty=True)
+    inst = models.RawJSON.objects.filter(**utils.subdict(data, key_list)).defer('json').first()
+    if inst and inst.content_hash == data['content_hash']:
+        return (inst, False, False)
+    if inst:
+        [setattr(inst, key, val) for key, val in data.items()]
+        inst.save()
+        return (inst, False, True)
+    inst = models.RawJSON(**data)
+    inst.save()
+    return (inst, True, False)
+
+def bulk_upsert_raw_json(data_list, key_list, where=None):
+    """creates or updates many `models.RawJSON` rows at once, see `upsert_raw_json` and `utils.bulk_upsert`.
+    returns a pair of (created, updated) counts."""
+    data_list = [dict(data, content_hash=utils.content_hash(data['json']), dirty=True) for data in data_list]
+    return utils.bulk_upsert(models.RawJSON, data_list, key_list, where=where, unchanged_field='content_hash')
+
 def upsert(iid, json_type, content):
     data = {
         'msid': iid,
@@ -80,20 +244,23 @@ def upsert(iid, json_type, content):
         'json': content,
         'json_type': json_type
     }
-    return utils.create_or_update(models.RawJSON, data, ['msid', 'json_type'])
+    return upsert_raw_json(data, ['msid', 'json_type'])
 
 def upsert_all(json_type, rows, idfn):
+    """creates or updates the RawJSON of many unversioned `rows` of `json_type` at once.
+    returns a pair of (created, updated) counts."""
     def do_safely(row):
         try:
             item_id = idfn(row)
         except Exception:
             LOG.error("failed to extract item id from row: %s", row)
-            return
-        return upsert(item_id, json_type, row)
+            return None
+        return {'msid': item_id, 'version': None, 'json': row, 'json_type': json_type}
 
-    with transaction.atomic():
-        utils.lmap(do_safely, rows)
-    return None
+    data_list = [data for data in map(do_safely, rows) if data]
+    created, updated = bulk_upsert_raw_json(data_list, ['msid', 'json_type'], where="version IS NULL")
+    LOG.info("%s %s rows: %s created, %s updated, %s unchanged", len(data_list), json_type, created, updated, len(data_list) - created - updated)
+    return (created, updated)
 
 #
 # generic content consumption
@@ -112,14 +279,21 @@ def single(endpoint, idfn=None, **kwargs):
     idfn = idfn or default_idfn
     return upsert(idfn(data), content_type, data)
 
-def all_items(endpoint, idfn=None, some_fn=None):
+def all_items(endpoint, idfn=None, some_fn=None, start_page=1, checkpoint=None):
     """consumes all items from the given `endpoint` and then creates/inserts them into the database.
-    items are inserted into the database in groups of 100.
+    pages are fetched concurrently, up to `settings.MAX_CONCURRENT_REQUESTS` at a time,
+    and the number of concurrent requests is adjusted according to the error rate of the API.
+    pages are fetched one at a time in this thread if `threads_allowed` is `False`.
+    items are inserted into the database in page order in groups of 100.
     `idfn` is used to derive the value for `models.RawJSON.json_id`.
 
     if `some_fn` then per-page consumption is broken as soon as some_fn(item) returns False.
     all results until some_fn(item) returned False are upserted.
-    a list of `idfn(item)` is returned when `some_fn` is supplied."""
+    a list of `idfn(item)` is returned when `some_fn` is supplied.
+
+    consumption begins at `start_page`.
+    if `checkpoint` then it is called with the page number of the last page upserted that isn't preceded by a page
+    that failed to download, and with `complete=True` once every page has been upserted."""
     initial = consume(endpoint, {'per-page': 1})
     per_page = 100
     num_pages = math.ceil(initial["total"] / float(per_page))
@@ -134,41 +308,67 @@ def all_items(endpoint, idfn=None, some_fn=None):
     except KeyError:
         do_upsert = False
 
+    def fetch(page):
+        try:
+            return consume(endpoint, {'page': page, 'per-page': per_page})
+        except requests.exceptions.RequestException:
+            return None
+
+    def flush(page):
+        upsert_all(content_type, accumulator, idfn)
+        # a failed page must be fetched again when resumed
+        position = page if failed_page is None else failed_page - 1
+        if checkpoint and position >= start_page:
+            checkpoint(position)
+
     accumulator = []
     accumulate = 100 # accumulate n pages before inserting
     id_accumulator = [] if some_fn else None
     break_iteration = False
-    for page in range(1, num_pages + 1):
-        try:
-            resp = consume(endpoint, {'page': page, 'per-page': per_page})
-        except requests.exceptions.RequestException:
-            continue
+    page = None
+    failed_page = None # the first page that failed to download
+    page_iter = iter(range(start_page, num_pages + 1))
+    with ThreadPoolExecutor(max_workers=settings.MAX_CONCURRENT_REQUESTS) as executor:
+        while not break_iteration:
+            page_list = list(utils.take(CONCURRENCY.limit, page_iter))
+            if not page_list:
+                break
 
-        page = resp['items']
+            # `executor.map` yields results in the order of `page_list`
+            resp_iter = executor.map(fetch, page_list) if threads_allowed() else map(fetch, page_list)
+            for page, resp in zip(page_list, resp_iter):
+                if resp is None:
+                    if failed_page is None:
+                        failed_page = page
+                    continue
 
-        if some_fn:
-            page = []
-            for item in resp['items']:
-                if some_fn(item):
-                    page.append(item)
-                    id_accumulator.append(idfn(item))
-                else:
-                    break_iteration = True
+                items = resp['items']
+
+                if some_fn:
+                    items = []
+                    for item in resp['items']:
+                        if some_fn(item):
+                            items.append(item)
+                            id_accumulator.append(idfn(item))
+                        else:
+                            break_iteration = True
 
-        accumulator.extend(page)
+                accumulator.extend(items)
 
-        if do_upsert and len(accumulator) >= accumulate:
-            upsert_all(content_type, accumulator, idfn)
-            accumulator = []
+                if do_upsert and len(accumulator) >= accumulate:
+                    flush(page)
+                    accumulator = []
 
-        if break_iteration:
-            break
+                if break_iteration:
+                    break
 
-        # pause between requests to prevent flooding
-        time.sleep(settings.SECONDS_BETWEEN_REQUESTS)
+            CONCURRENCY.adjust()
 
     # handle any leftovers
     if do_upsert and accumulator:
-        upsert_all(content_type, accumulator, idfn)
+        flush(page)
+
+    if checkpoint and failed_page is None:
+        checkpoint(complete=True)
 
     return id_accumulator
@@ -0,0 +1,116 @@
+"""compiles et3 descriptions into plain Python functions.
+
+`et3.render.render_item` interprets a description on every item it renders: for each key it walks the
+pipeline, checking the type of every segment and splitting every path as it goes.
+`compile_description` does that work once and generates a function that renders an item the same way,
+returning identical results and raising the same errors.
+
+paths are compiled when they are created with `path` (rather than `et3.extract.path`), and `pp` and
+`foreach` segments when they carry the attributes `ingest_logic` gives them."""
+
+from collections import OrderedDict
+from et3 import extract, render
+
+NO_DEFAULT = 0xDEADBEEF # `et3.extract.lookup` raises a `KeyError` rather than return a default
+
+def path(p, default=NO_DEFAULT):
+    "like `et3.extract.path` but remembers the path and default so it can be compiled"
+    fn = extract.path(p, default)
+    fn.path, fn.default = p, default
+    return fn
+
+def compile_path(p, default=NO_DEFAULT):
+    """returns a function that looks up `p` in the data given to it, like `et3.extract.lookup`.
+    the path is split once rather than once per call."""
+    if p is None:
+        return lambda data: data
+    if not isinstance(p, str):
+        return extract.path(p, default) # raises a `ValueError` when called
+    bit_list = p.split('.')
+
+    def fn(data):
+        for bit in bit_list:
+            if isinstance(data, dict):
+                if bit not in data:
+                    if default == NO_DEFAULT:
+                        raise KeyError(bit)
+                    return default
+                data = data[bit]
+            elif isinstance(data, list):
+                data = data[int(bit)]
+            else:
+                raise ValueError("lookup context must be a dictionary or a list, got %r: %r" % (type(data), data))
+        return data
+    return fn
+
+def compile_pp(pobj_list):
+    """returns a function that returns the value of the first path in `pobj_list` that doesn't cause an error,
+    like `ingest_logic.pp`. paths that can be compiled are compiled."""
+    fn_list = [compile_segment(pobj) for pobj in pobj_list]
+    if not fn_list:
+        return lambda data: None
+    *head, last = fn_list
+
+    def fn(data):
+        for pfn in head:
+            try:
+                return pfn(data)
+            except BaseException:
+                continue
+        return last(data)
+    return fn
+
+def compile_segment(segment):
+    "returns a function of a single argument equivalent to `et3.render.do` with the given pipeline `segment`"
+    if hasattr(segment, 'path') and hasattr(segment, 'default'):
+        return compile_path(segment.path, segment.default)
+    if hasattr(segment, 'pobjs'):
+        return compile_pp(segment.pobjs)
+    if hasattr(segment, 'foreach_description'):
+        render_row = compile_description(segment.foreach_description)
+        return lambda data: [render_row(row) for row in data]
+    if hasattr(segment, 'requires_context'):
+        return lambda data: segment({}, data)
+    return segment
+
+def compile_description(description):
+    """returns a function that renders an item with `description`, like `et3.render.render_item` with no context.
+    the returned function is generated Python, one statement per pipeline segment."""
+    namespace = {'EXCLUDE_ME': render.EXCLUDE_ME, 'doall': render.doall, 'OrderedDict': OrderedDict}
+    line_list = ["def render_item(item):"]
+    line_list.append("    result = %s()" % ('OrderedDict' if isinstance(description, OrderedDict) else 'dict'))
+
+    def bind(val):
+        "adds `val` to the namespace of the generated function and returns it's name"
+        name = "_%s" % len(namespace)
+        namespace[name] = val
+        return name
+
+    def expr(segment, arg):
+        "returns an expression applying `segment` to the variable `arg`"
+        if callable(segment):
+            return "%s(%s)" % (bind(compile_segment(segment)), arg)
+        return bind(segment)
+
+    def pipeline_expr(segment, arg):
+        # a tuple of segments are each applied to the same value. a tuple within a tuple is a constant.
+        if isinstance(segment, tuple):
+            return "(%s)" % "".join("%s, " % expr(subseg, arg) for subseg in segment)
+        return expr(segment, arg)
+
+    for key, pipeline in description.items():
+        if isinstance(pipeline, dict):
+            line_list.append("    val = %s(item)" % bind(compile_description(pipeline)))
+        elif isinstance(pipeline, list):
+            line_list.append("    val = item")
+            line_list.extend("    val = %s" % pipeline_expr(segment, 'val') for segment in pipeline)
+        elif callable(pipeline):
+            line_list.append("    val = %s(doall, item)" % bind(pipeline))
+        else:
+            raise AssertionError("render pipeline for item is an unhandled type: %r" % type(pipeline))
+        line_list.append("    if not val == EXCLUDE_ME:")
+        line_list.append("        result[%s] = val" % bind(key))
+    line_list.append("    return result")
+
+    exec(compile("\n".join(line_list), "<compiled description>", "exec"), namespace)
+    return namespace['render_item']
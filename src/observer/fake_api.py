@@ -0,0 +1,293 @@
+"""a local stand-in for the eLife API, used to benchmark ingestion without touching the real API.
+
+content is served from the test fixtures in `observer/tests/fixtures`. listings are scaled up by `scale`,
+repeating the fixture items with unique identifiers, and `ARTICLES_PER_SCALE * scale` articles are synthesised
+from the article-json fixtures.
+
+the server can also be made slower (`latency`), less reliable (`error_rate`) and responses larger (`padding`).
+
+usage:
+    server = fake_api.start(scale=2, latency=0.05)
+    ... # requests to server.url
+    server.stop()"""
+
+import os, re, json, glob, random, hashlib, threading, time
+from os.path import join
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from . import utils
+import logging
+
+LOG = logging.getLogger(__name__)
+
+FIXTURE_DIR = join(os.path.dirname(os.path.abspath(__file__)), 'tests', 'fixtures')
+
+# number of synthetic articles per unit of `scale`
+ARTICLES_PER_SCALE = 100
+
+# synthetic articles are numbered from here to avoid clashing with real article ids
+FIRST_MSID = 100001
+
+# API listing endpoint => fixture directory.
+# the remaining endpoints in `ingest_logic.CONTENT_DESCRIPTIONS` have a fixture directory of the same name.
+FIXTURE_DIRS = {
+    'press-packages': 'presspackages',
+    'metrics/article/summary': 'metrics-summary',
+}
+
+def listing_endpoints():
+    "returns a list of the API listing endpoints observer consumes, excluding `/articles`"
+    from . import ingest_logic
+    endpoint_list = [desc['api-list'] for desc in ingest_logic.CONTENT_DESCRIPTIONS.values() if 'api-list' in desc]
+    return sorted(set(endpoint_list + ['metrics/article/summary']))
+
+#
+# corpus
+#
+
+def _copy_id(iid, copy):
+    "returns a unique identifier for the `copy`th copy of an item with the identifier `iid`"
+    if copy == 0:
+        return iid
+    if isinstance(iid, int):
+        return iid + (copy * 1000000)
+    if iid.isdigit():
+        return str(int(iid) + (copy * 1000000))
+    # some content ids are limited to 8 characters
+    return hashlib.md5(("%s-%s" % (iid, copy)).encode('utf-8')).hexdigest()[:len(iid)]
+
+def _copy_item(item, copy):
+    item = dict(item)
+    if 'id' in item:
+        item['id'] = _copy_id(item['id'], copy)
+    if 'number' in item: # podcast episodes
+        item['number'] = _copy_id(item['number'], copy)
+    return item
+
+def _load_listing(fixture_dir):
+    "returns a pair of (item-list, total) from the fixtures in `fixture_dir`"
+    path = join(FIXTURE_DIR, fixture_dir, 'many.json')
+    if os.path.exists(path):
+        with open(path, 'r') as fh:
+            data = json.load(fh)
+        return data['items'], data['total']
+    # no listing fixture, use the individual items instead
+    item_list = []
+    for path in sorted(glob.glob(join(FIXTURE_DIR, fixture_dir, '*.json'))):
+        with open(path, 'r') as fh:
+            item_list.append(json.load(fh))
+    return item_list, len(item_list)
+
+def _load_articles():
+    "returns a list of article-json fixtures grouped by article: [[v1, v2, ...], ...]"
+    article_map = OrderedDict()
+    for path in sorted(glob.glob(join(FIXTURE_DIR, 'ajson', '*.json'))):
+        with open(path, 'r') as fh:
+            data = json.load(fh)
+        article_map.setdefault(data['id'], []).append(data)
+    return [sorted(version_list, key=lambda v: v['version']) for version_list in article_map.values()]
+
+class Listing:
+    "a fixture listing of `total` items, repeating the fixture `item_list` with unique identifiers"
+
+    def __init__(self, item_list, total):
+        self.item_list = item_list
+        self.total = total
+
+    def page(self, page, per_page):
+        offset = (page - 1) * per_page
+        end = min(offset + per_page, self.total)
+        return [self.item(i) for i in range(offset, end)]
+
+    def item(self, i):
+        copy, idx = divmod(i, len(self.item_list))
+        return _copy_item(self.item_list[idx], copy)
+
+    def find(self, iid):
+        "returns the item with the given `iid` or `None`. slow."
+        for i in range(self.total):
+            item = self.item(i)
+            if str(item.get('id', item.get('number'))) == iid:
+                return item
+        return None
+
+class Articles:
+    "`total` synthetic articles, listed from most to least recently published."
+
+    def __init__(self, total):
+        self.template_list = _load_articles()
+        self.total = total
+        self.epoch = datetime(2020, 1, 1)
+
+    def msid(self, i):
+        "returns the msid of the `i`th article in the listing"
+        return FIRST_MSID + self.total - 1 - i
+
+    def versions(self, msid):
+        "returns the list of article-json versions for the given synthetic `msid` or `None`"
+        i = msid - FIRST_MSID
+        if i < 0 or i >= self.total:
+            return None
+        template = self.template_list[i % len(self.template_list)]
+        version_date = self.epoch + timedelta(hours=i)
+        version_list = []
+        for data in template:
+            data = dict(data)
+            data['id'] = str(msid)
+            data['doi'] = "10.7554/eLife.%s" % msid
+            data['elocationId'] = "e%s" % msid
+            data['versionDate'] = utils.ymdhms(version_date + timedelta(minutes=data['version']))
+            version_list.append(data)
+        return version_list
+
+    def snippet(self, data):
+        return utils.subdict(data, ['id', 'version', 'versionDate', 'status', 'type', 'doi', 'title', 'published'])
+
+    def page(self, page, per_page):
+        offset = (page - 1) * per_page
+        end = min(offset + per_page, self.total)
+        return [self.snippet(self.versions(self.msid(i))[-1]) for i in range(offset, end)]
+
+#
+# server
+#
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.record(status, len(body))
+
+    def pad(self, item_list):
+        padding = self.server.padding
+        if padding:
+            for item in item_list:
+                item['-padding'] = 'x' * padding
+        return item_list
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        if server.error_rate and server.random() < server.error_rate:
+            self.send_json(503, {'title': 'Service Unavailable'})
+            return
+
+        url = urlparse(self.path)
+        endpoint = url.path.strip('/')
+        params = parse_qs(url.query)
+        page = int(params.get('page', [1])[0])
+        per_page = int(params.get('per-page', [20])[0])
+
+        status, data = server.route(endpoint, page, per_page)
+        if data and 'items' in data:
+            self.pad(data['items'])
+        elif data and status == 200:
+            self.pad([data])
+        self.send_json(status, data or {'title': 'Not found'})
+
+ARTICLE_VERSIONS = re.compile(r'^articles/(?P<msid>\d+)/versions$')
+ARTICLE_VERSION = re.compile(r'^articles/(?P<msid>\d+)/versions/(?P<version>\d+)$')
+ARTICLE_METRICS = re.compile(r'^metrics/article/(?P<msid>\d+)/summary$')
+
+class FakeAPI(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, scale=1, latency=0, error_rate=0, padding=0, seed=None):
+        super().__init__(address, Handler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.padding = padding
+        self._random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        self.num_errors = 0
+        self.bytes_sent = 0
+
+        self.articles = Articles(max(1, int(ARTICLES_PER_SCALE * scale)))
+        self.listings = {}
+        for endpoint in listing_endpoints():
+            item_list, total = _load_listing(FIXTURE_DIRS.get(endpoint, endpoint))
+            if item_list:
+                self.listings[endpoint] = Listing(item_list, max(1, int(total * scale)))
+
+    @property
+    def url(self):
+        return "http://%s:%s" % self.server_address[:2]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def random(self):
+        with self.lock:
+            return self._random.random()
+
+    def record(self, status, num_bytes):
+        with self.lock:
+            self.num_requests += 1
+            self.bytes_sent += num_bytes
+            if status >= 400:
+                self.num_errors += 1
+
+    def stats(self):
+        with self.lock:
+            return {'requests': self.num_requests, 'errors': self.num_errors, 'bytes': self.bytes_sent}
+
+    def route(self, endpoint, page, per_page):
+        "returns a pair of (status, data) for the given request"
+        if endpoint == 'articles':
+            return 200, {'total': self.articles.total, 'items': self.articles.page(page, per_page)}
+
+        match = ARTICLE_VERSIONS.match(endpoint)
+        if match:
+            version_list = self.articles.versions(int(match['msid']))
+            if version_list:
+                return 200, {'versions': [self.articles.snippet(v) for v in version_list]}
+            return 404, None
+
+        match = ARTICLE_VERSION.match(endpoint)
+        if match:
+            version_list = self.articles.versions(int(match['msid'])) or []
+            version = int(match['version'])
+            if 0 < version <= len(version_list):
+                return 200, version_list[version - 1]
+            return 404, None
+
+        match = ARTICLE_METRICS.match(endpoint)
+        if match:
+            summary = self.listings['metrics/article/summary'].find(match['msid'])
+            if summary:
+                return 200, {'total': 1, 'items': [summary]}
+            return 404, None
+
+        if endpoint in self.listings:
+            listing = self.listings[endpoint]
+            return 200, {'total': listing.total, 'items': listing.page(page, per_page)}
+
+        # individual items, like `profiles/{id}`
+        parent, _, iid = endpoint.rpartition('/')
+        if parent in self.listings:
+            item = self.listings[parent].find(iid)
+            if item:
+                return 200, item
+
+        return 404, None
+
+def start(host='127.0.0.1', port=0, **kwargs):
+    """starts a `FakeAPI` server in a background thread and returns it.
+    a random free port is used when `port` is `0`. stop the server with `server.stop()`."""
+    server = FakeAPI((host, port), **kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    LOG.info("fake API listening on %s", server.url)
+    return server
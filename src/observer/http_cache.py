@@ -0,0 +1,150 @@
+"""an on-disk cache of API responses that are revalidated with conditional requests.
+
+responses with an `ETag` or `Last-Modified` header are stored on disk, keyed by their url and parameters.
+the next request for the same url and parameters sends `If-None-Match`/`If-Modified-Since` headers and
+a `304 Not Modified` response is served from disk.
+
+the cache is bounded by `settings.API_CACHE_MAX_BYTES` and the least recently used entries are evicted first.
+the cache is disabled when `settings.API_CACHE_DIR` is empty."""
+
+import os, json, hashlib, threading
+from os.path import join
+from django.conf import settings
+import logging
+
+LOG = logging.getLogger(__name__)
+
+LOCK = threading.Lock()
+
+# running total of bytes on disk per cache directory, populated when the cache directory is first scanned.
+_SIZE = {}
+
+def enabled():
+    return bool(settings.API_CACHE_DIR)
+
+def cache_key(url, params):
+    "returns a hash of the given `url` and `params`"
+    params = sorted((params or {}).items())
+    return hashlib.sha1(json.dumps([url, params]).encode('utf-8')).hexdigest()
+
+def cache_path(key):
+    return join(settings.API_CACHE_DIR, key[:2], key + '.json')
+
+def _entries():
+    "returns a list of (mtime, size, path) for all entries in the cache"
+    results = []
+    for root, _, filename_list in os.walk(settings.API_CACHE_DIR):
+        for filename in filename_list:
+            path = join(root, filename)
+            try:
+                stat = os.stat(path)
+                results.append((stat.st_mtime, stat.st_size, path))
+            except FileNotFoundError:
+                continue
+    return results
+
+def cache_size():
+    "returns the number of bytes used by the cache"
+    with LOCK:
+        if settings.API_CACHE_DIR not in _SIZE:
+            _SIZE[settings.API_CACHE_DIR] = sum(size for _, size, _ in _entries())
+        return _SIZE[settings.API_CACHE_DIR]
+
+def evict(max_bytes=None):
+    """removes the least recently used entries until the cache is below 90% of `max_bytes`.
+    returns the number of entries removed."""
+    max_bytes = settings.API_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    if cache_size() <= max_bytes:
+        return 0
+    with LOCK:
+        entry_list = sorted(_entries()) # oldest first
+        total = sum(size for _, size, _ in entry_list)
+        num_removed = 0
+        for _, size, path in entry_list:
+            if total <= (max_bytes * 0.9):
+                break
+            try:
+                os.unlink(path)
+                total -= size
+                num_removed += 1
+            except FileNotFoundError:
+                continue
+        _SIZE[settings.API_CACHE_DIR] = total
+    LOG.info("evicted %s entries from the API cache", num_removed)
+    return num_removed
+
+def get(url, params):
+    "returns the cached entry for the given `url` and `params`, or `None`"
+    try:
+        with open(cache_path(cache_key(url, params)), 'r') as fh:
+            return json.load(fh)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def conditional_headers(entry):
+    "returns the headers needed to revalidate the given cache `entry`"
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last-modified'):
+        headers['If-Modified-Since'] = entry['last-modified']
+    return headers
+
+def touch(url, params):
+    "marks the cached entry for the given `url` and `params` as recently used"
+    try:
+        os.utime(cache_path(cache_key(url, params)))
+    except FileNotFoundError:
+        pass
+
+def _write(url, params, entry):
+    "writes the cache `entry` for the given `url` and `params` to disk"
+    cache_size() # ensure the cache has been scanned before adding to it
+
+    path = cache_path(cache_key(url, params))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write to a temporary file first so readers never see a partially written entry
+    temp_path = "%s.%s.%s.tmp" % (path, os.getpid(), threading.get_ident())
+    with open(temp_path, 'w') as fh:
+        json.dump(entry, fh)
+    size = os.path.getsize(temp_path)
+    try:
+        size -= os.path.getsize(path) # entry is being replaced
+    except FileNotFoundError:
+        pass
+    os.replace(temp_path, path)
+
+    with LOCK:
+        _SIZE[settings.API_CACHE_DIR] += size
+
+    evict()
+
+def put(url, params, resp):
+    """stores the body of the response `resp` if it can be revalidated later.
+    returns `True` if the response was stored."""
+    etag = resp.headers.get('ETag')
+    last_modified = resp.headers.get('Last-Modified')
+    if not etag and not last_modified:
+        return False
+
+    entry = {
+        'url': url,
+        'params': params,
+        'etag': etag,
+        'last-modified': last_modified,
+        'body': resp.text
+    }
+    _write(url, params, entry)
+    return True
+
+def revalidated(url, params, entry, resp):
+    """updates the cached `entry` after the '304 Not Modified' response `resp`.
+    a 304 may carry new validators, in which case they replace the stored ones and the body is kept,
+    otherwise the entry is just marked as recently used."""
+    etag = resp.headers.get('ETag') or entry.get('etag')
+    last_modified = resp.headers.get('Last-Modified') or entry.get('last-modified')
+    if etag == entry.get('etag') and last_modified == entry.get('last-modified'):
+        touch(url, params)
+        return
+    entry = dict(entry, **{'etag': etag, 'last-modified': last_modified})
+    _write(url, params, entry)
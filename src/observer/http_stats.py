@@ -0,0 +1,143 @@
+"""per-endpoint statistics of requests made to the eLife API.
+
+requests are grouped by endpoint template, like `articles/{id}/versions/{version}`, and for each template
+the number of calls, attempts, response statuses, a latency histogram, bytes received, retries, give-ups and
+the time spent waiting on backoff and the rate limiter are recorded.
+
+`consume` records into the shared `STATS` object. read it with `STATS.report()` or `STATS.as_dict()`."""
+
+import bisect, threading
+from urllib.parse import urlparse
+from django.conf import settings
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf')]
+
+# path segments that are part of an endpoint and never an identifier
+LITERAL_SEGMENTS = ['versions', 'article', 'summary']
+
+def endpoint_template(url):
+    """returns the endpoint template for the given API `url` or endpoint.
+    for example, `https://api.elifesciences.org/articles/123/versions/2` => `articles/{id}/versions/{version}`"""
+    if url.startswith(settings.API_URL):
+        url = url[len(settings.API_URL):]
+    segment_list = urlparse(url).path.strip('/').split('/')
+    template = segment_list[:1]
+    for prev, segment in zip(segment_list, segment_list[1:]):
+        if segment in LITERAL_SEGMENTS:
+            template.append(segment)
+        elif prev == 'versions':
+            template.append('{version}')
+        else:
+            template.append('{id}')
+    return '/'.join(template)
+
+def _new_entry():
+    return {
+        'calls': 0, # calls to `consume.consume`
+        'elapsed': 0.0, # seconds spent in `consume.consume`, including retries
+        'requests': 0, # attempts, including retries
+        'statuses': {}, # {status-code: count}, 'error' for connection errors and timeouts
+        'latency': [0] * len(LATENCY_BUCKETS), # histogram of request latency
+        'latency-total': 0.0,
+        'bytes': 0,
+        'retries': 0,
+        'giveups': 0,
+        'backoff-seconds': 0.0, # seconds spent sleeping between retries
+        'limiter-seconds': 0.0, # seconds spent waiting on `consume.LIMITER`
+    }
+
+def _percentile(histogram, fraction):
+    "returns the upper bound of the latency bucket containing the given `fraction` of requests"
+    total = sum(histogram)
+    if not total:
+        return None
+    running = 0
+    for bound, count in zip(LATENCY_BUCKETS, histogram):
+        running += count
+        if running >= total * fraction:
+            return bound
+    return LATENCY_BUCKETS[-1]
+
+class HTTPStats:
+    "thread-safe per-endpoint request statistics"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def reset(self):
+        with self.lock:
+            self.entries = {}
+
+    def _entry(self, url):
+        template = endpoint_template(url)
+        if template not in self.entries:
+            self.entries[template] = _new_entry()
+        return self.entries[template]
+
+    def call(self, url, elapsed):
+        "records a call to `consume.consume` that took `elapsed` seconds"
+        with self.lock:
+            entry = self._entry(url)
+            entry['calls'] += 1
+            entry['elapsed'] += elapsed
+
+    def request(self, url, status, latency, num_bytes=0, limiter_wait=0):
+        "records a single attempt at a request"
+        with self.lock:
+            entry = self._entry(url)
+            entry['requests'] += 1
+            status = str(status or 'error')
+            entry['statuses'][status] = entry['statuses'].get(status, 0) + 1
+            entry['latency'][bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+            entry['latency-total'] += latency
+            entry['bytes'] += num_bytes
+            entry['limiter-seconds'] += limiter_wait
+
+    def retry(self, url, wait):
+        "records a failed request that will be retried after `wait` seconds"
+        with self.lock:
+            entry = self._entry(url)
+            entry['retries'] += 1
+            entry['backoff-seconds'] += wait
+
+    def giveup(self, url):
+        "records a request that won't be retried"
+        with self.lock:
+            self._entry(url)['giveups'] += 1
+
+    def as_dict(self):
+        "returns a copy of the statistics for each endpoint template, suitable for serialising as JSON"
+        with self.lock:
+            result = {}
+            for template, entry in sorted(self.entries.items()):
+                entry = dict(entry, statuses=dict(entry['statuses']))
+                entry['latency'] = {str(bound): count for bound, count in zip(LATENCY_BUCKETS, entry['latency'])}
+                result[template] = entry
+            return result
+
+    def report(self):
+        "returns a human readable table of the statistics for each endpoint template"
+        header = ['endpoint', 'calls', 'requests', 'retries', 'giveups', 'MiB', 'mean ms', 'p50 ms', 'p95 ms', 'backoff s', 'limiter s']
+        row_list = [header]
+        with self.lock:
+            for template, entry in sorted(self.entries.items()):
+                mean = (entry['latency-total'] / entry['requests']) if entry['requests'] else 0
+                p50, p95 = _percentile(entry['latency'], 0.5), _percentile(entry['latency'], 0.95)
+                row_list.append([
+                    template, entry['calls'], entry['requests'], entry['retries'], entry['giveups'],
+                    "%.2f" % (entry['bytes'] / 1024 / 1024),
+                    "%.0f" % (mean * 1000),
+                    "<=%g" % (p50 * 1000) if p50 is not None else '-',
+                    "<=%g" % (p95 * 1000) if p95 is not None else '-',
+                    "%.1f" % entry['backoff-seconds'],
+                    "%.1f" % entry['limiter-seconds'],
+                ])
+        width_list = [max(len(str(row[i])) for row in row_list) for i in range(len(header))]
+        line_list = []
+        for row in row_list:
+            line_list.append("  ".join(str(val).ljust(width) for val, width in zip(row, width_list)).rstrip())
+        return "\n".join(line_list)
+
+STATS = HTTPStats()
@@ -1,10 +1,15 @@
-import os, math, json, time
+import os, math, json, uuid, time
+import multiprocessing
+from collections import deque
 from functools import partial
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from django.db import models as dj_models, transaction
+from django.db.models import F, Q, OuterRef, Subquery, Count, Min
 from et3 import render
-from et3.extract import path as p
-from . import utils, models, logic, consume
-from .utils import lmap, lfilter, create_or_update, delall, first, second, third, last, ensure, do_all_atomically
+from . import utils, models, logic, consume, profiling
+from .extractors import path as p, compile_description
+from .utils import lmap, lfilter, create_or_update, delall, first, second, third, last, ensure
 import logging
 from requests.exceptions import RequestException
 from django.conf import settings
@@ -88,6 +93,7 @@ def foreach_render(desc):
     "renders description for each item in iterable"
     def wrap(data):
         return [render.render_item(desc, row) for row in data]
+    wrap.foreach_description = desc # see `extractors.compile_segment`
     return wrap
 
 def fltr(fn):
@@ -114,6 +120,7 @@ def pp(*pobjs):
                 if (i + 1) == len(pobjs): # if this is the last p-obj ..
                     raise # die.
                 continue
+    wrapper.pobjs = pobjs # see `extractors.compile_pp`
     return wrapper
 
 #
@@ -216,12 +223,15 @@ ART_POPULARITY = {
 }
 DESC.update(ART_POPULARITY)
 
+# `DESC` compiled into a function that renders article-json, see `extractors.compile_description`
+render_article = compile_description(DESC)
+
 def flatten_article_json(data, known_version_list=[], history=None, metrics=None):
     "takes article-json and squishes it into something observer can digest"
     data['known-versions'] = known_version_list # raw article json the scrape can use to inspect historical values
     data['history'] = history or {} # EJP
     data['metrics'] = metrics or {} # elife-metrics
-    return render.render_item(DESC, data)
+    return render_article(data)
 
 #
 #
@@ -237,7 +247,16 @@ def upsert_json(msid, version, json_type, article_data):
         'json_type': json_type
     }
     version and ensure(version > 0, "'version' in RawJSON must be as a positive integer")
-    return create_or_update(models.RawJSON, article_data, ['msid', 'version', 'json_type'])
+    return consume.upsert_raw_json(article_data, ['msid', 'version', 'json_type'])
+
+# raw json an article is regenerated from
+ARTICLE_JSON_TYPES = [models.LAX_AJSON, models.METRICS_SUMMARY]
+
+def mark_clean(json_type_list, content_id_list):
+    "clears the `dirty` flag of the raw json of each item in `content_id_list` once the content it belongs to has been regenerated"
+    models.RawJSON.objects \
+        .filter(msid__in=content_id_list, json_type__in=json_type_list, dirty=True) \
+        .update(dirty=False)
 
 #
 # insights, tied to models.Article and models.Content
@@ -252,10 +271,12 @@ INSIGHTS_DESC = {
     'datetime_published': [p('published')],
 }
 
+render_insight = compile_description(INSIGHTS_DESC)
+
 def extract_insight(raw_article_data):
     """`models.Content` insight data is extracted from the RawJSON article data.
     it's just a subset of the full data stored in `models.Article`"""
-    return render.render_item(INSIGHTS_DESC, raw_article_data)
+    return render_insight(raw_article_data)
 
 #
 # articles
@@ -272,35 +293,59 @@ def extract_children(mush):
 
     known_children = {
         'subjects': {'Model': models.Subject, 'key_list': ["name"]},
-        'authors': {'Model': models.Author},
+        # authors are never updated, only created, so they can be interned. see `utils.interning`
+        'authors': {'Model': models.Author, 'key_list': ["key"], 'intern': True},
         'categories': {'Model': models.ContentCategory, 'key_list': ["name"]},
     }
 
+    # `mush` belongs to the caller and each row in it is a new map rendered from the raw data,
+    # so rows are used as they are rather than copied.
+    for author in mush.get('authors', []):
+        author['key'] = models.author_key(author['type'], author['name'], author['country'])
+
     children = []
     for childtype, kwargs in known_children.items():
         # if 'categories' in 'digest'
         # if 'authors' in 'article'
         if childtype in mush:
-            data = mush[childtype]
-            children.extend([utils.dict_update(kwargs, {'orig_data': row, 'parent-relation': childtype}, immutable=True) for row in data])
+            # `kwargs` are shared by every child of this type and never modified, see `utils.save_objects`
+            children.extend([dict(kwargs, **{'orig_data': row, 'parent-relation': childtype}) for row in mush[childtype]])
 
     # remove the children from the mush, they must be saved separately
     delall(mush, known_children.keys())
     return mush, children
 
-def extract_article(msid):
+def prefetch_articles(msid_list):
+    """returns a map of {msid: (article-version-data, metrics-data), ...} for each article in `msid_list`.
+    `article-version-data` is the json of all known versions of an article, ordered by version.
+    articles without any known versions are absent. two queries are made regardless of the number of articles."""
+    msid_list = [utils.norm_msid(msid) for msid in msid_list]
+    article_idx = {}
+    with profiling.stage('load', [(models.LAX_AJSON, msid) for msid in msid_list]):
+        rows = models.RawJSON.objects \
+            .filter(msid__in=msid_list, json_type=models.LAX_AJSON) \
+            .order_by('msid', 'version') \
+            .values_list('msid', 'json')
+        for msid, data in rows:
+            article_idx.setdefault(msid, ([], {}))[0].append(data)
+
+        rows = models.RawJSON.objects \
+            .filter(msid__in=list(article_idx.keys()), json_type=models.METRICS_SUMMARY) \
+            .values_list('msid', 'json')
+        for msid, data in rows:
+            article_idx[msid] = (article_idx[msid][0], data)
+    return article_idx
+
+def extract_article(msid, prefetched=None):
     """converts article, metrics, subjects and author data into a list of objects that can be passed to `utils.save_objects`.
-    Most of the data lives in the raw article-json from Lax, but it also combines metrics data from elife-metrics."""
-    article_data = models.RawJSON.objects.filter(msid=str(msid), json_type=models.LAX_AJSON).order_by('version') # ASC
-    ensure(article_data.count(), "article %s does not exist" % msid)
-
-    try:
-        metrics_data = models.RawJSON.objects.get(msid=str(msid), json_type=models.METRICS_SUMMARY).json
-    except models.RawJSON.DoesNotExist:
-        metrics_data = {}
+    Most of the data lives in the raw article-json from Lax, but it also combines metrics data from elife-metrics.
+    `prefetched` is the map returned by `prefetch_articles`, if the article data has been loaded already."""
+    if prefetched is None:
+        prefetched = prefetch_articles([msid])
+    ensure(utils.norm_msid(msid) in prefetched, "article %s does not exist" % msid)
 
     # json for all known versions of this article
-    article_version_data = [rawjson.json for rawjson in article_data]
+    article_version_data, metrics_data = prefetched[utils.norm_msid(msid)]
 
     # the most recent known version of this article
     # scrape has access to historical versions too
@@ -308,10 +353,13 @@ def extract_article(msid):
 
     # TODO: other objects need one of these lines. it's currently just 'committing N objects\ncommiting N objects\n...'
     LOG.info('extracting %s' % article_data.get('id', '???'))
-    article_mush = flatten_article_json(article_data, known_version_list=article_version_data, metrics=metrics_data)
+    key_list = [(models.LAX_AJSON, utils.norm_msid(msid))]
+    with profiling.stage('flatten', key_list):
+        article_mush = flatten_article_json(article_data, known_version_list=article_version_data, metrics=metrics_data)
 
     # extract sub-objects from the article data
-    article_mush, children = extract_children(article_mush)
+    with profiling.stage('extract', key_list):
+        article_mush, children = extract_children(article_mush)
 
     parent = {'Model': models.Article, 'orig_data': article_mush, 'key_list': ['msid']}
     object_pair_list = [(parent, children)]
@@ -321,101 +369,475 @@ def extract_article(msid):
     # we're reusing `utils.save_objects` that handles parents and children, except skipping the children part
     # because this entry has no relation to the models.Article being created.
     if article_mush['type'] == models.INSIGHT:
-        insight_mush = extract_insight(article_data)
+        with profiling.stage('flatten', key_list):
+            insight_mush = extract_insight(article_data)
         parent = {'Model': models.Content, 'orig_data': insight_mush, 'key_list': ['id']}
         children = []
         object_pair_list.append((parent, children))
 
     return object_pair_list
 
+def _write_article(msid, object_list, update=True):
+    """writes the objects returned by `extract_article` within the current transaction.
+    the stored article is updated in place with just the values and relationships that changed, unless
+    `update` is `False`, in which case it is deleted and created again."""
+    with profiling.stage('save', [(models.LAX_AJSON, utils.norm_msid(msid))]):
+        if not update:
+            # destroy what we have, if anything
+            models.Article.objects.filter(msid=msid).delete()
+        utils.save_objects(object_list, update=update)
+
 def _regenerate_article(msid):
-    object_list = extract_article(msid)
     with transaction.atomic():
-        # destroy what we have, if anything. updating may be dangerous
-        models.Article.objects.filter(msid=msid).delete()
-        utils.save_objects(object_list)
-        return models.Article.objects.get(msid=msid)
+        _write_article(msid, extract_article(msid), update=True)
+        mark_clean(ARTICLE_JSON_TYPES, [utils.norm_msid(msid)])
+    return models.Article.objects.get(msid=msid)
 
 # unlike simpler `regenerate_*` functions, article data has stricter transaction rules
 # this is an exception, not the rule.
 # @transaction.atomic
 def regenerate_article(msid):
     "use this when regenerating individual or small numbers of articles."
-    return _regenerate_article(msid)
-
-def regenerate_many_articles(msid_list, batches_of=25):
-    "commits articles in batches of 25 by default"
-    def safe_regen(msid):
+    with utils.QueryCounter() as counter:
+        art = _regenerate_article(msid)
+    LOG.info("regenerated article %s: %s rows written (%s queries)", msid, counter.rows_written, counter.count)
+    return art
+
+def extract_articles(msid_list, prefetched):
+    """extracts each article in `msid_list` from the `prefetched` article and metrics data.
+    returns a map of {msid: object-list, ...}. the object-list of articles with bad data is `None`.
+    doesn't touch the database and may be run in a worker process, see `regenerate_in_processes`."""
+    def safe_extract(msid):
         try:
-            # this is a nested transaction!
-            # this is important for articles because they must be ingested in order
-            # and rolled back as a logical group.
-            # if one version of an article fails, they all do, but the parent transaction is not
-            return regenerate_article(msid)
+            return extract_article(msid, prefetched)
         except (AssertionError, KeyError):
             LOG.error("bad data encountered, skipping regeneration of %s" % msid)
-    do_all_atomically(safe_regen, msid_list, batches_of)
+    return {msid: safe_extract(msid) for msid in msid_list}
+
+def save_articles(extracted):
+    """saves a batch of articles returned by `extract_articles` in a single transaction.
+    there is no savepoint per article. if an article has bad data the batch is rolled back and bisected until the
+    article is found, the article is skipped and the rest of the batch is saved.
+    returns a list of the msids that were saved."""
+    def write(item_list):
+        # all versions of an article are saved, or rolled back, as a logical group.
+        for msid, object_list in item_list:
+            _write_article(msid, object_list)
+        mark_clean(ARTICLE_JSON_TYPES, [utils.norm_msid(msid) for msid, _ in item_list])
+
+    item_list = [(msid, object_list) for msid, object_list in extracted.items() if object_list is not None]
+    with utils.QueryCounter() as counter:
+        saved, failed = utils.commit_bisecting(write, item_list)
+    for msid, _ in failed:
+        LOG.error("bad data encountered, skipping regeneration of %s" % msid)
+    LOG.info("comitting %s objects (%s queries, %s rows written)" % (len(extracted), counter.count, counter.rows_written))
+    return [msid for msid, _ in saved]
+
+def regenerate_in_processes(batch_iter, prefetch, extract, save, workers):
+    """regenerates each batch of content ids in `batch_iter`, flattening raw json in `workers` processes.
+    `prefetch` is called with a batch of ids and loads their raw json.
+    `extract` is called in a worker process with the batch and the result of `prefetch` and converts it into objects.
+    `save` is called with the result of `extract` and writes it to the database.
+    only this process reads and writes to the database, worker processes are forked and never touch it.
+    batches are loaded and written in order while up to `workers * 2` batches are being extracted.
+
+    batches are loaded after the workers are forked, so the result of `prefetch` is pickled and sent to a worker
+    with each batch and the extracted objects are pickled and sent back. this copying is the price of keeping
+    the database in this process and is only worthwhile when flattening is slower than loading and saving.
+    stages recorded by `profiling` in a worker process are lost, so profile with a single worker."""
+    batch_iter = iter(batch_iter)
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+
+        def fill():
+            for batch in islice(batch_iter, workers * 2 - len(pending)):
+                pending.append(executor.submit(extract, batch, prefetch(batch)))
+
+        fill()
+        while pending:
+            extracted = pending.popleft().result()
+            fill() # keep the workers busy while this batch is written
+            save(extracted)
+
+def regenerate_many_articles(msid_list, batches_of=None, workers=1, progress=None):
+    """commits articles in batches of `batches_of` or, by default, in batches sized to take about
+    `settings.REGEN_COMMIT_SECONDS` each to commit, starting with 25.
+    the article and metrics data for each batch of articles is loaded up front with `prefetch_articles`.
+    articles are flattened in `workers` processes when `workers` is greater than 1.
+    `progress` is updated after each batch with the articles that couldn't be regenerated, see `utils.Progress`."""
+    if batches_of:
+        sizer = utils.BatchSizer(batches_of, minimum=batches_of, maximum=batches_of)
+    else:
+        sizer = utils.BatchSizer(25, target=settings.REGEN_COMMIT_SECONDS, maximum=settings.REGEN_MAX_BATCH_SIZE)
+
+    def save(extracted):
+        start = time.monotonic()
+        saved = save_articles(extracted)
+        if len(saved) == len(extracted):
+            # batches that were bisected aren't a fair measure
+            sizer.record(len(extracted), time.monotonic() - start)
+        profiling.batch_done()
+        if progress:
+            failed = set(extracted.keys()) - set(saved)
+            progress.update(len(extracted), [(models.LAX_AJSON, msid) for msid in failed])
+
+    def regen_batch(sub_list):
+        save(extract_articles(sub_list, prefetch_articles(sub_list)))
+
+    # authors are shared between many articles, don't look up the same author twice
+    with utils.interning():
+        if workers > 1:
+            regenerate_in_processes(sizer.partition(msid_list), prefetch_articles, extract_articles, save, workers)
+        else:
+            for batch in sizer.partition(msid_list):
+                regen_batch(batch)
+
+def regenerate_all_articles(dirty=False, workers=1):
+    """regenerates all articles or, if `dirty` is `True`, just those whose article-json or metrics have changed.
+    manuscript ids are read from the database a chunk at a time rather than all at once."""
+    queryset = logic.known_articles()
+    if dirty:
+        queryset = logic.dirty_articles()
+        LOG.info("%s articles have changed", queryset.count())
+    regenerate_many_articles(utils.iter_chunked(queryset), workers=workers)
+
+def compact_authors(delete_orphans=False):
+    """merges authors with the same `key` into the author with the lowest id, keeping their articles.
+    authors without a key are given one first.
+    if `delete_orphans` then authors without any articles are deleted.
+    returns a pair of (merged, deleted) counts."""
+    Through = models.Article.authors.through
+
+    missing = models.Author.objects.filter(key__isnull=True)
+    for batch in utils.partition(missing.iterator(), 1000):
+        for author in batch:
+            author.key = models.author_key(author.type, author.name, author.country)
+        models.Author.objects.bulk_update(batch, ['key'])
+
+    merged = 0
+    duplicates = models.Author.objects \
+        .values('key') \
+        .annotate(num=Count('id'), keep=Min('id')) \
+        .filter(num__gt=1) \
+        .order_by()
+    for row in list(duplicates):
+        with transaction.atomic():
+            duplicate_ids = list(models.Author.objects.filter(key=row['key']).exclude(id=row['keep']).values_list('id', flat=True))
+            article_ids = set(Through.objects.filter(author_id__in=duplicate_ids).values_list('article_id', flat=True))
+            Through.objects.bulk_create([Through(article_id=article_id, author_id=row['keep']) for article_id in article_ids], ignore_conflicts=True)
+            models.Author.objects.filter(id__in=duplicate_ids).delete()
+            merged += len(duplicate_ids)
+    LOG.info("merged %s duplicate authors", merged)
+
+    deleted = 0
+    if delete_orphans:
+        deleted, _ = models.Author.objects.filter(article__isnull=True).delete()
+        LOG.info("deleted %s authors without articles", deleted)
+    return merged, deleted
+
+#
+# checkpoints
+# the progress of bulk downloads is recorded in `models.Checkpoint` so interrupted downloads can be resumed.
+#
+
+COMPLETE = 'complete'
+
+def new_run_id():
+    return uuid.uuid4().hex
+
+def last_run_id():
+    """returns the run id of the most recently recorded incomplete checkpoint, if any.
+    runs that completed every download they started, like later daily runs, have nothing to resume."""
+    checkpoint = models.Checkpoint.objects.filter(complete=False).order_by('-datetime_record_updated').first()
+    return checkpoint.run_id if checkpoint else None
 
-def regenerate_all_articles():
-    regenerate_many_articles(logic.known_articles())
+def save_checkpoint(run_id, target, endpoint, position=None, complete=False):
+    "records the last fully processed `position` of the bulk download of `target` from `endpoint`."
+    data = {'run_id': run_id, 'target': target, 'endpoint': endpoint, 'position': position, 'complete': complete}
+    return create_or_update(models.Checkpoint, data, ['target', 'endpoint'])[0]
+
+def resume_position(run_id, target, endpoint):
+    """returns the last fully processed position of `target` from `endpoint` during the run `run_id`.
+    returns `COMPLETE` if the download was completed and `None` if no progress was recorded."""
+    if not run_id:
+        return None
+    checkpoint = models.Checkpoint.objects.filter(run_id=run_id, target=target, endpoint=endpoint).first()
+    if not checkpoint:
+        return None
+    if checkpoint.complete:
+        LOG.info("%s from %r was completed during run %s, skipping" % (target, endpoint, run_id))
+        return COMPLETE
+    LOG.info("resuming %s from %r at %s" % (target, endpoint, checkpoint.position))
+    return checkpoint.position
+
+def checkpointer(run_id, target, endpoint):
+    """returns a function that records the position of a bulk download, or `None` if no `run_id` given.
+    bulk downloads given a `run_id` call it with the last position up to which everything has been downloaded and
+    with `complete=True` once everything has been. a resumed run continues from there, see `resume_position`."""
+    if not run_id:
+        return None
+    return partial(save_checkpoint, run_id, target, endpoint)
 
 #
 # upsert article-json from api
 #
 
-# TODO: shift this pagination into something generic
-def mkidx():
-    "downloads *all* article snippets to create an msid:version index"
+def update_article_index():
+    """walks the `/articles` listing from newest to oldest, updating the msid:version index in `models.ArticleIndex`.
+    iteration stops at the first article that is unchanged since the index was last updated.
+    returns a list of (msid, version) pairs whose index entries changed."""
     # figures out how many pages to fetch by inspecting 'total' value in response.
     ini = consume.consume("articles", {'per-page': 1})
     per_page = 100.0
     num_pages = math.ceil(ini["total"] / per_page)
-    msid_ver_idx = {} # ll: {09560: 1, ...}
-    LOG.info("%s pages to fetch" % num_pages)
+    changed = [] # [(msid, version, version_date), ...]
     for page in range(1, num_pages + 1):
         resp = consume.consume("articles", {'page': page})
-        for snippet in resp["items"]:
-            msid_ver_idx[snippet["id"]] = snippet["version"]
-    return msid_ver_idx
+        msid_list = [utils.norm_msid(snippet["id"]) for snippet in resp["items"]]
+        known = models.ArticleIndex.objects.filter(msid__in=msid_list).values_list('msid', 'version', 'version_date')
+        known = {msid: (version, version_date) for msid, version, version_date in known}
+        unchanged = False
+        for msid, snippet in zip(msid_list, resp["items"]):
+            entry = (snippet["version"], todt(snippet.get("versionDate")))
+            if known.get(msid) == entry:
+                unchanged = True
+                break
+            changed.append((msid,) + entry)
+        if unchanged:
+            break
+
+    LOG.info("%s articles changed in article index" % len(changed))
+
+    # the index is only updated once the walk is complete, in a single transaction.
+    # an interrupted walk will start again from the beginning.
+    row_list = [{'msid': msid, 'version': version, 'version_date': version_date} for msid, version, version_date in changed]
+    utils.bulk_upsert(models.ArticleIndex, row_list, ['msid'])
+
+    return [(msid, version) for msid, version, _ in changed]
+
+def stale_articles():
+    """returns a list of (msid, version) pairs from the article index whose most recent version hasn't been downloaded.
+    this includes changes to the article index from previous, interrupted, downloads."""
+    latest_version = models.RawJSON.objects \
+        .filter(json_type=models.LAX_AJSON, msid=OuterRef('msid')) \
+        .order_by('-version') \
+        .values('version')[:1]
+    return list(models.ArticleIndex.objects \
+                .annotate(stored_version=Subquery(latest_version)) \
+                .filter(Q(stored_version__isnull=True) | Q(stored_version__lt=F('version'))) \
+                .values_list('msid', 'version'))
+
+def stored_versions(msid):
+    "returns the set of article versions already stored for the given `msid`"
+    return set(models.RawJSON.objects \
+               .filter(msid=utils.norm_msid(msid), json_type=models.LAX_AJSON) \
+               .values_list('version', flat=True))
+
+def versions_to_fetch(msid, version_list):
+    """returns the versions in `version_list` that need to be downloaded for the given `msid`.
+    published versions of an article never change, except the most recent version that may still be corrected.
+    versions we don't have and the most recent version are returned."""
+    if not version_list:
+        return []
+    stored = stored_versions(msid)
+    latest_version = max(version_list)
+    return sorted(v for v in version_list if v not in stored or v == latest_version)
 
 # todo: shift this to `consume.consume` somehow
-def _download_versions(msid, latest_version):
-    "loads *all* versions of a given article `msid`"
-    LOG.info('%s versions to fetch' % latest_version)
-    for version in range(1, latest_version + 1):
+def _download_versions(msid, version_list):
+    """loads the given list of versions of a given article `msid`.
+    returns a list of the versions that were created or changed."""
+    LOG.info('%s versions to fetch' % len(version_list))
+    changed = []
+    for version in version_list:
         article_json = consume.consume("articles/%s/versions/%s" % (msid, version))
-        upsert_json(msid, version, models.LAX_AJSON, article_json)
-        # pause between requests to prevent flooding
-        time.sleep(settings.SECONDS_BETWEEN_REQUESTS)
+        _, created, updated = upsert_json(msid, version, models.LAX_AJSON, article_json)
+        if created or updated:
+            changed.append(version)
+    return changed
 
-def download_article_versions(msid):
-    "loads *all* versions of a given article `msid`"
+def _fetch_version_list(msid):
+    "returns a list of all published versions of the given article `msid`"
     resp = consume.consume("articles/%s/versions" % msid)
     # exclude preprints from article history
-    versions = [v for v in resp["versions"] if v.get("status") != "preprint"]
-    _download_versions(msid, len(versions))
+    return [v["version"] for v in resp["versions"] if v.get("status") != "preprint"]
 
-def download_all_article_versions():
-    "loads *all* versions of *all* articles"
-    msid_ver_idx = mkidx() # urgh. this sucks. lax needs a /summary endpoint too
-    LOG.info("%s articles to fetch" % len(msid_ver_idx))
-    idx = sorted(msid_ver_idx.items(), key=lambda x: x[0], reverse=True)
-    for msid, latest_version in idx:
-        _download_versions(msid, latest_version)
+def download_article_versions(msid):
+    """loads any new versions of a given article `msid` and it's most recent version.
+    returns a list of the versions that were created or changed."""
+    return _download_versions(msid, versions_to_fetch(msid, _fetch_version_list(msid)))
+
+def article_needs_regenerating(msid, changed):
+    """returns `True` if any versions of the article `msid` have `changed`, it's article-json or metrics have changed
+    since it was last regenerated or it has never been regenerated"""
+    if changed:
+        return True
+    if logic.dirty_articles().filter(msid_as_int=int(utils.norm_msid(msid))).exists():
+        return True
+    if models.Article.objects.filter(msid=utils.norm_msid(msid)).exists():
+        LOG.info("article %s is unchanged, skipping regeneration", msid)
+        return False
+    return True
+
+def _log_download_error(msid, err):
+    if isinstance(err, RequestException):
+        log = LOG.debug if err.response is not None and err.response.status_code == 404 else LOG.error
+        log("failed to fetch article %s: %s", msid, err) # probably an unpublished article.
+    else:
+        LOG.error("unhandled exception attempting to download article %s: %s", msid, err)
+
+def download_articles_concurrently(msid_ver_list, regen=False, workers=None, on_finish=None):
+    """downloads the versions of many articles at once using up to `workers` threads.
+    `msid_ver_list` is a list of (msid, latest-version) pairs. if `latest-version` is `None` the list of
+    versions is fetched from the API first.
+    versions of different articles are fetched concurrently and each article is stored, and regenerated
+    if `regen` is `True`, as soon as all of it's versions have been downloaded.
+    requests to the API are rate limited by `consume.LIMITER`.
+    only the calling thread touches the database.
+    `on_finish`, if given, is called with the msid of each article once it has been processed and `True` if it was
+    processed successfully or `False` if not.
+    returns a list of msids that were successfully downloaded."""
+    workers = workers or settings.MAX_CONCURRENT_REQUESTS
+    msid_iter = iter(msid_ver_list)
+    pending = {} # {future: (msid, version)}, version is `None` when fetching the list of versions
+    in_flight = {} # {msid: {version: article-json, ...}, ...}
+    remaining = {} # {msid: number-of-versions-still-to-download, ...}
+    downloaded = []
+
+    def finish(msid):
+        "stores the versions of a downloaded article and regenerates it"
+        version_data = in_flight.pop(msid)
+        remaining.pop(msid, None)
+        try:
+            data_list = [{'msid': utils.norm_msid(msid), 'version': version, 'json': article_json, 'json_type': models.LAX_AJSON}
+                         for version, article_json in sorted(version_data.items())]
+            created, updated = consume.bulk_upsert_raw_json(data_list, ['msid', 'version'])
+            if regen and version_data and article_needs_regenerating(msid, created or updated):
+                regenerate_article(msid)
+            downloaded.append(msid)
+        except KeyboardInterrupt:
+            raise
+        except BaseException:
+            LOG.exception("unhandled exception attempting to store and regenerate article %s", msid)
+        if on_finish:
+            on_finish(msid, msid in downloaded)
+
+    def fail(msid, err):
+        _log_download_error(msid, err)
+        in_flight.pop(msid, None)
+        remaining.pop(msid, None)
+        if on_finish:
+            on_finish(msid, False)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        def schedule(msid, version_list):
+            version_list = versions_to_fetch(msid, version_list)
+            remaining[msid] = len(version_list)
+            for version in version_list:
+                pending[executor.submit(consume.consume, "articles/%s/versions/%s" % (msid, version))] = (msid, version)
+            if not version_list:
+                finish(msid)
+
+        def fill():
+            "keeps a bounded number of articles in flight"
+            while len(in_flight) < (workers * 2):
+                try:
+                    msid, latest_version = next(msid_iter)
+                except StopIteration:
+                    return
+                in_flight[msid] = {}
+                if latest_version is None:
+                    pending[executor.submit(_fetch_version_list, msid)] = (msid, None)
+                else:
+                    schedule(msid, list(range(1, latest_version + 1)))
+
+        fill()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                msid, version = pending.pop(future)
+                if msid not in in_flight:
+                    continue # article has already failed
+                try:
+                    result = future.result()
+                except BaseException as err:
+                    fail(msid, err)
+                    continue
+                if version is None:
+                    schedule(msid, result)
+                    continue
+                in_flight[msid][version] = result
+                remaining[msid] -= 1
+                if not remaining[msid]:
+                    finish(msid)
+            fill()
+
+    return downloaded
+
+def download_all_article_versions(workers=1, run_id=None):
+    "loads any new versions of *all* articles changed in the article index, `workers` articles at a time. see `checkpointer`."
+    target, endpoint = models.LAX_AJSON, "articles"
+    position = resume_position(run_id, target, endpoint)
+    if position == COMPLETE:
+        return
+    checkpoint = checkpointer(run_id, target, endpoint)
+
+    msid_ver_idx = dict(update_article_index())
+    msid_ver_idx.update(stale_articles())
+    idx = sorted(msid_ver_idx.items(), key=lambda x: int(x[0]), reverse=True)
+    if position:
+        # articles are processed from highest msid to lowest
+        idx = [(msid, version) for msid, version in idx if int(msid) < int(position)]
+    LOG.info("%s articles to fetch" % len(idx))
+
+    failed = []
+    if workers > 1:
+        # articles finish in any order. the checkpoint is the lowest msid where all higher msids have been
+        # processed successfully. a failed article is never passed so it's downloaded again when resumed.
+        processed = {} # {msid: success, ...}
+        msid_iter = iter([msid for msid, _ in idx])
+        next_msid = {'msid': next(msid_iter, None)}
+
+        def on_finish(msid, success):
+            processed[msid] = success
+            if not success:
+                failed.append(msid)
+            passed = None
+            while next_msid['msid'] is not None and processed.get(next_msid['msid']):
+                passed = next_msid['msid']
+                next_msid['msid'] = next(msid_iter, None)
+            if passed and checkpoint:
+                checkpoint(passed)
+
+        download_articles_concurrently(idx, workers=workers, on_finish=on_finish)
+    else:
+        for msid, latest_version in idx:
+            _download_versions(msid, versions_to_fetch(msid, list(range(1, latest_version + 1))))
+            if checkpoint:
+                checkpoint(msid)
+
+    if checkpoint and not failed:
+        checkpoint(complete=True)
 
 #
 # metrics data
 #
 
-def _upsert_metrics_ajson(data):
-    version = None
+def _valid_metrics_ajson(data):
     # big ints in sqlite3 are 64 bits/8 bytes large
     try:
         # TODO: shift this check elsewhere, db field validation checking perhaps
         ensure(utils.byte_length(data['id']) <= 8, "bad data encountered, cannot store msid: %s", data['id'])
-        upsert_json(data['id'], version, models.METRICS_SUMMARY, data)
+        return True
     except AssertionError as err:
         LOG.error(err)
+        return False
+
+def _upsert_metrics_ajson(data):
+    version = None
+    if _valid_metrics_ajson(data):
+        upsert_json(data['id'], version, models.METRICS_SUMMARY, data)
 
 def download_article_metrics(msid):
     "loads *all* metrics for *specific* article via API"
@@ -429,24 +851,50 @@ def download_article_metrics(msid):
 # def download_article_metrics(msid):
 #    consume.single("metrics/article/{id}/summary", id=msid)
 
-def download_all_article_metrics():
-    "loads *all* metrics for *all* articles via API"
+def _upsert_metrics_batch(summary_list):
+    "upserts many metrics summaries at once. returns a pair of (created, updated) counts."
+    data_list = [{'msid': utils.norm_msid(data['id']), 'version': None, 'json': data, 'json_type': models.METRICS_SUMMARY}
+                 for data in summary_list if _valid_metrics_ajson(data)]
+    return consume.bulk_upsert_raw_json(data_list, ['msid', 'json_type'], where="version IS NULL")
+
+def download_all_article_metrics(pages_per_batch=10, run_id=None):
+    "loads *all* metrics for *all* articles via API, `pages_per_batch` pages per transaction. see `checkpointer`."
+    target, endpoint = models.METRICS_SUMMARY, "metrics/article/summary"
+    position = resume_position(run_id, target, endpoint)
+    if position == COMPLETE:
+        return 0
+    checkpoint = checkpointer(run_id, target, endpoint)
+
     # calls `consume` until all results are consumed
-    ini = consume.consume("metrics/article/summary", {'per-page': 1})
+    ini = consume.consume(endpoint, {'per-page': 1})
     per_page = 100.0
     num_pages = math.ceil(ini["total"] / per_page)
     LOG.info("%s pages to fetch" % num_pages)
-    results = []
-    for page in range(1, num_pages + 1):
+    batch = []
+    num_results = 0
+    failed_page = None # the first page that failed to download, the checkpoint never passes it
+    for page in range(int(position or 0) + 1, num_pages + 1):
         try:
-            resp = consume.consume("metrics/article/summary", {'page': page})
-            results.extend(resp['items'])
+            resp = consume.consume(endpoint, {'page': page})
+            batch.extend(resp['items'])
         except RequestException as err:
             LOG.error("failed to fetch page of summaries: %s", err)
+            if failed_page is None:
+                failed_page = page
 
-    with transaction.atomic():
-        lmap(_upsert_metrics_ajson, results)
-    return results
+        if page % pages_per_batch == 0 or page == num_pages:
+            _upsert_metrics_batch(batch)
+            num_results += len(batch)
+            LOG.info("upserted %s summaries (page %s of %s), peak memory usage %sMiB", len(batch), page, num_pages, utils.peak_memory())
+            batch = []
+            if checkpoint and failed_page is None:
+                checkpoint(page)
+
+    if checkpoint and failed_page is None:
+        checkpoint(complete=True)
+
+    LOG.info("%s summaries downloaded, peak memory usage %sMiB", num_results, utils.peak_memory())
+    return num_results
 
 # def download_all_article_metrics():
 #    consume.all("metrics/article/summary")
@@ -663,6 +1111,10 @@ CONTENT_DESCRIPTIONS = {
 
 }
 
+# each content type's description compiled into a function that renders it's data
+RENDERERS = {content_type: compile_description(content_description['description'])
+             for content_type, content_description in CONTENT_DESCRIPTIONS.items() if 'description' in content_description}
+
 #
 # generic download and regenerate
 #
@@ -671,18 +1123,14 @@ def flatten_data(content_type, data):
     """takes data from the eLife API and 'flattens' it into something that can be inserted into a database.
     the name comes from the deeply nested article data that extracts fields into a shallow map.
     simpler content types have hardly any nesting at all."""
-    description = CONTENT_DESCRIPTIONS[content_type]['description']
-    return render.render_item(description, data)
-
-def _regenerate_item(content_type, content_id, data=None):
-    """regenerate a single item with *no* transaction.
-    regenerating a single item may cause many child objects to also be created. If called outside
-    of a transaction you may end up with missing data.
-    see `regenerate_item` (no prefix) and `regenerate_list`."""
+    return RENDERERS[content_type](data)
 
+def extract_item(content_type, content_id, data):
+    """converts the raw json `data` of an item into a pair of (Model, object-list) where object-list can be passed to `utils.save_objects`.
+    returns `None` if the item is of an unhandled content type.
+    doesn't touch the database and may be run in a worker process, see `regenerate_in_processes`."""
     content_type = models.find_content_type(content_type)
-
-    data = data or models.RawJSON.objects.get(msid=content_id, json_type=content_type).json
+    key_list = [(content_type, content_id)]
 
     # no 1:1 mapping between endpoint and observer model.
     # `/community` is like this, it returns interviews, blogs, collections, etc
@@ -696,52 +1144,140 @@ def _regenerate_item(content_type, content_id, data=None):
     # in this case, it looks like it was accidental but was stored in RawJSON.
     if not content_type in CONTENT_DESCRIPTIONS:
         LOG.warning("skipping unhandled content type %r. this may need to be deleted from the database: %s" % (content_type, data))
-        return
+        return None
     #assert content_type in CONTENT_DESCRIPTIONS, "unhandled content type %r: %s" % (content_type, data)
 
-    mush = flatten_data(content_type, data)
-    mush, children = extract_children(mush)
+    with profiling.stage('flatten', key_list):
+        mush = flatten_data(content_type, data)
+    with profiling.stage('extract', key_list):
+        mush, children = extract_children(mush)
 
     Klass = CONTENT_DESCRIPTIONS[content_type]['model']
 
     parent = {'Model': Klass, 'orig_data': mush, 'key_list': ['id']}
-    object_list = [(parent, children)]
+    return Klass, [(parent, children)]
+
+def _save_item(json_type, content_id, extracted, update=True):
+    """saves an item returned by `extract_item` with *no* transaction unless it has, or may have, children.
+    the stored item is updated in place unless `update` is `False`, in which case it is deleted and created again."""
+    if extracted is None:
+        mark_clean([json_type], [content_id])
+        return None
+    Klass, object_list = extracted
 
     def do():
-        Klass.objects.filter(id=content_id).delete()
-        utils.save_objects(object_list)
+        with profiling.stage('save', [(json_type, content_id)]):
+            if not update:
+                Klass.objects.filter(id=content_id).delete()
+            utils.save_objects(object_list, update=update)
+            mark_clean([json_type], [content_id])
         return Klass.objects.get(id=content_id)
 
-    if children:
+    children = object_list[0][1]
+    if children or (update and Klass._meta.many_to_many):
         # if content type has children then it's safest to insert them together.
         # this negates any efficiency gains by preferring `_regenerate_item` over `regenerate_item`
         with transaction.atomic():
             return do()
     return do()
 
+def _regenerate_item(content_type, content_id, data=None):
+    """regenerate a single item with *no* transaction.
+    regenerating a single item may cause many child objects to also be created. If called outside
+    of a transaction you may end up with missing data.
+    see `regenerate_item` (no prefix) and `regenerate_list`."""
+    json_type = models.find_content_type(content_type)
+    with profiling.stage('load', [(json_type, content_id)]):
+        data = data or models.RawJSON.objects.get(msid=content_id, json_type=json_type).json
+    return _save_item(json_type, content_id, extract_item(json_type, content_id, data))
+
 @transaction.atomic
 def regenerate_item(content_type, content_id):
     "regenerate a single item in a single transaction"
-    return _regenerate_item(content_type, content_id)
+    with utils.QueryCounter() as counter:
+        item = _regenerate_item(content_type, content_id)
+    LOG.info("regenerated %s %r: %s rows written (%s queries)", content_type, content_id, counter.rows_written, counter.count)
+    return item
+
+def prefetch_items(content_type, content_id_list):
+    "returns a map of {content-id: raw-json, ...} for each item in `content_id_list`. one query is made."
+    json_type = models.find_content_type(content_type)
+    with profiling.stage('load', [(json_type, content_id) for content_id in content_id_list]):
+        return dict(models.RawJSON.objects \
+            .filter(msid__in=content_id_list, json_type=json_type) \
+            .values_list('msid', 'json'))
+
+def extract_items(content_type, content_id_list, prefetched):
+    "returns a map of {content-id: (Model, object-list), ...} for each item in `content_id_list`, see `extract_item`."
+    return {content_id: extract_item(content_type, content_id, prefetched[content_id]) for content_id in content_id_list}
 
-def regenerate_list(content_type, content_id_list):
-    "given a `content_type` and a list of content ID values, regenerate all of them and manage the transaction."
+@transaction.atomic
+def save_items(content_type, extracted):
+    "saves a batch of items returned by `extract_items` in a single transaction"
+    json_type = models.find_content_type(content_type)
+    with utils.QueryCounter() as counter:
+        for content_id, item in extracted.items():
+            _save_item(json_type, content_id, item)
+    LOG.info("comitting %s objects (%s queries, %s rows written)" % (len(extracted), counter.count, counter.rows_written))
+
+def regenerate_list(content_type, content_id_list, workers=1, batches_of=25, progress=None):
+    """given a `content_type` and a list of content ID values, regenerate all of them and manage the transaction.
+    items are committed in batches of `batches_of` and flattened in `workers` processes when `workers` is greater than 1.
+    `progress` is updated after each batch, see `utils.Progress`."""
     if not content_id_list:
         # it's possible what has been downloaded can't be found given the `content_type` and an `id`.
         # check `consume.content_type_from_endpoint`.
         LOG.warning("no content found for content type %r to regenerate", content_type)
-    return do_all_atomically(partial(_regenerate_item, content_type), content_id_list)
-
-def regenerate(content_type):
-    return regenerate_list(content_type, logic.known_content(json_type=content_type))
+        return None
 
-def download_item(content_type, content_id):
+    def save(extracted):
+        save_items(content_type, extracted)
+        profiling.batch_done()
+        if progress:
+            progress.update(len(extracted))
+
+    batch_iter = utils.partition(content_id_list, batches_of)
+    if workers > 1:
+        return regenerate_in_processes(batch_iter, partial(prefetch_items, content_type),
+                                       partial(extract_items, content_type), save, workers)
+    for batch in batch_iter:
+        save(extract_items(content_type, batch, prefetch_items(content_type, batch)))
+
+def regenerate(content_type, dirty=False, workers=1):
+    """regenerates all content of `content_type` or, if `dirty` is `True`, just the content that has changed.
+    content ids are read from the database a chunk at a time rather than all at once."""
+    queryset = logic.known_content(json_type=content_type)
+    if dirty:
+        queryset = logic.dirty_content(json_type=content_type)
+        num_items = queryset.count()
+        LOG.info("%s %s items have changed", num_items, content_type)
+        if not num_items:
+            return None
+    elif not queryset.exists():
+        return regenerate_list(content_type, [], workers)
+    return regenerate_list(content_type, utils.iter_chunked(queryset), workers)
+
+def _download_item(content_type, content_id):
+    "downloads a single item. returns a triple of (rawjson, created, updated)"
     content_description = CONTENT_DESCRIPTIONS[content_type]
     api = content_description['api-item']
     idfn = content_description.get('idfn', consume.default_idfn)
-    return first(consume.single(api, id=content_id, idfn=idfn))
+    return consume.single(api, id=content_id, idfn=idfn)
 
-def download_all(content_type, alt_content_description_map=None, **kwargs):
+def download_item(content_type, content_id):
+    return first(_download_item(content_type, content_id))
+
+def item_needs_regenerating(content_type, content_id, changed):
+    "returns `True` if the item has changed or has never been regenerated"
+    if changed:
+        return True
+    Klass = CONTENT_DESCRIPTIONS[content_type].get('model')
+    if Klass and Klass.objects.filter(id=content_id).exists():
+        LOG.info("%s %r is unchanged, skipping regeneration", content_type, content_id)
+        return False
+    return True
+
+def download_all(content_type, alt_content_description_map=None, run_id=None, **kwargs):
     """downloads *all* pages of content for the given `content_type`.
     for some types of content this is relatively little, perhaps 1-3 pages.
     for other types, like articles, it may be 100+ pages."""
@@ -751,7 +1287,12 @@ def download_all(content_type, alt_content_description_map=None, **kwargs):
     api = content_description['api-list']
     idfn = content_description.get('idfn', consume.default_idfn)
     some_fn = kwargs.pop('some_fn', None)
-    return consume.all_items(api, idfn, some_fn)
+
+    position = resume_position(run_id, content_type, api)
+    if position == COMPLETE:
+        return None
+    checkpoint = checkpointer(run_id, content_type, api)
+    return consume.all_items(api, idfn, some_fn, start_page=int(position or 0) + 1, checkpoint=checkpoint)
 
 #
 #
@@ -794,11 +1335,28 @@ def delete_item(content_type, content_id):
 #
 #
 
-def regenerate_all():
-    regenerate_all_articles()
-
-    for content_type in CONTENT_DESCRIPTIONS.keys():
-        regenerate(content_type)
+# content types that can be regenerated, in the order they are regenerated
+REGENERATABLE = [models.LAX_AJSON] + list(CONTENT_DESCRIPTIONS.keys())
+
+def regenerate_all(dirty=False, workers=1, content_type_list=None, since=None, msid_range=None, batches_of=None, progress=None):
+    """regenerates all content from the raw json stored in the database.
+    if `dirty` is `True`, only content whose raw json has changed since it was last regenerated is regenerated.
+    `content_type_list`, `since` and `msid_range` select just some of the content, see `logic.content_ids`.
+    raw json is flattened in `workers` processes when `workers` is greater than 1, see `regenerate_in_processes`.
+    `progress`, if given, is told how many items have been selected and is updated as they are regenerated."""
+    content_type_list = content_type_list or REGENERATABLE
+    selected = [(content_type, logic.content_ids(content_type, dirty, since, msid_range)) for content_type in content_type_list]
+    if progress:
+        progress.total = sum(queryset.count() for _, queryset in selected)
+        LOG.info("%s items selected for regeneration", progress.total)
+
+    for content_type, queryset in selected:
+        if content_type == models.LAX_AJSON:
+            msid_iter = utils.iter_chunked(queryset)
+            regenerate_many_articles(msid_iter, batches_of=batches_of, workers=workers, progress=progress)
+        elif queryset.exists():
+            content_id_iter = utils.iter_chunked(queryset)
+            regenerate_list(content_type, content_id_iter, workers, batches_of or 25, progress)
 
 #
 #
@@ -808,12 +1366,11 @@ def download_regenerate_article(msid):
     """convenience. Downloads the article versions with the given `msid` and then regenerates it's content.
     WARN: Does not download metrics data, uses what exists, if any."""
     try:
-        download_article_versions(msid)
-        regenerate_article(msid)
+        if article_needs_regenerating(msid, download_article_versions(msid)):
+            regenerate_article(msid)
 
     except RequestException as err:
-        log = LOG.debug if err.response.status_code == 404 else LOG.error
-        log("failed to fetch article %s: %s", msid, err) # probably an unpublished article.
+        _log_download_error(msid, err)
 
     except KeyboardInterrupt as exc:
         raise exc
@@ -821,11 +1378,16 @@ def download_regenerate_article(msid):
     except BaseException:
         LOG.exception("unhandled exception attempting to download and regenerate article %s", msid)
 
-def download_regenerate_article_list(some_fn):
+def download_regenerate_article_list(some_fn, workers=1):
     """downloads and regenerates all articles returned in the article listing endpoint until `some_fn(article_summary)` returns `False`.
-    used by the `load_from_api` command to regenerate articles modified in the last N days."""
+    used by the `load_from_api` command to regenerate articles modified in the last N days.
+    articles are downloaded concurrently when `workers` is greater than 1."""
     alt_content_description_map = {models.LAX_AJSON: {'api-list': 'articles'}}
-    for content_id in download_all(models.LAX_AJSON, alt_content_description_map, some_fn=some_fn):
+    content_id_list = download_all(models.LAX_AJSON, alt_content_description_map, some_fn=some_fn)
+    if workers > 1:
+        download_articles_concurrently([(content_id, None) for content_id in content_id_list], regen=True, workers=workers)
+        return
+    for content_id in content_id_list:
         download_regenerate_article(content_id)
 
 def download_regenerate(content_type, content_id):
@@ -836,10 +1398,11 @@ def download_regenerate(content_type, content_id):
     # all other content uses general handling
 
     try:
-        download_item(content_type, content_id)
-        regenerate_item(content_type, content_id)
+        _, created, updated = _download_item(content_type, content_id)
+        if item_needs_regenerating(content_type, content_id, created or updated):
+            regenerate_item(content_type, content_id)
     except RequestException as err:
-        if err.response.status_code == 404:
+        if err.response is not None and err.response.status_code == 404:
             # item not found. delete it, if it exists.
             delete_item(content_type, content_id)
         else:
@@ -883,7 +1446,7 @@ def file_upsert(path, content_type=models.LAX_AJSON, regen=True, quiet=False):
             consume.upsert(data['id'], content_type, data)[0]
 
         if regen:
-            regenerate_all()
+            regenerate_all(dirty=True)
 
         return None
 
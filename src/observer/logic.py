@@ -20,6 +20,41 @@ def known_articles():
         .order_by('-msid_as_int') \
         .distinct()
 
+def dirty_content(json_type):
+    "returns a queryset of IDs of content whose raw json has changed since it was last regenerated, from newest to oldest."
+    return known_content(json_type).filter(dirty=True)
+
+def dirty_articles():
+    """returns a query set of manuscript_ids whose article-json or metrics have changed since
+    the article was last regenerated, from newest to oldest"""
+    dirty = models.RawJSON.objects \
+        .filter(json_type__in=[models.LAX_AJSON, models.METRICS_SUMMARY], dirty=True) \
+        .values('msid')
+    return known_articles().filter(msid__in=dirty)
+
+def content_ids(json_type, dirty=False, since=None, msid_range=None):
+    """returns a queryset of the IDs of content of `json_type` from newest to oldest, like `known_articles` and `known_content`.
+    if `dirty` then just the IDs of content that has changed since it was last regenerated, see `dirty_articles` and `dirty_content`.
+    if `since` then just the IDs of content whose raw json has been written since the given datetime.
+    if `msid_range`, a pair of (lowest, highest), then just the articles whose manuscript ID is within that range."""
+    if json_type != models.LAX_AJSON:
+        assert msid_range is None, "a range of manuscript IDs can only be given for articles"
+        queryset = dirty_content(json_type) if dirty else known_content(json_type)
+        if since:
+            queryset = queryset.filter(datetime_record_updated__gte=since)
+        return queryset
+
+    queryset = dirty_articles() if dirty else known_articles()
+    if since:
+        updated = models.RawJSON.objects \
+            .filter(json_type__in=[models.LAX_AJSON, models.METRICS_SUMMARY], datetime_record_updated__gte=since) \
+            .values('msid')
+        queryset = queryset.filter(msid__in=updated)
+    if msid_range:
+        lowest, highest = msid_range
+        queryset = queryset.filter(msid_as_int__gte=lowest, msid_as_int__lte=highest)
+    return queryset
+
 def simple_subjects():
     "returns a list of subject name strings"
     return models.Subject.objects.values_list('name', flat=True) # ['foo', 'bar', 'baz']
@@ -0,0 +1,95 @@
+import sys, time
+from django.core.management.base import BaseCommand
+from observer import bench, fake_api, http_stats
+from observer.management.commands.load_from_api import TARGETS
+import logging
+
+LOG = logging.getLogger(__name__)
+
+def fake_api_arguments(parser):
+    parser.add_argument('--scale', type=float, default=1, help="multiplier of the amount of content served")
+    parser.add_argument('--latency', type=float, default=0, help="seconds to wait before responding to a request")
+    parser.add_argument('--error-rate', type=float, default=0, help="fraction of requests that fail with a 503 response")
+    parser.add_argument('--padding', type=int, default=0, help="bytes added to each item served")
+
+class Command(BaseCommand):
+    help = "benchmarks ingestion against a local, fake, eLife API. no changes are made to the configured database."
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+        subparser = subparsers.add_parser('serve', help="run the fake API in the foreground")
+        fake_api_arguments(subparser)
+        subparser.add_argument('--port', type=int, default=8001)
+
+        subparser = subparsers.add_parser('load_from_api', help="run `load_from_api` against the fake API and report throughput")
+        fake_api_arguments(subparser)
+        subparser.add_argument('--rate', type=float, help="maximum requests per second. defaults to the configured rate.")
+        subparser.add_argument('--target', nargs='+', choices=TARGETS)
+        subparser.add_argument('--workers', type=int, default=1)
+
+        subparser = subparsers.add_parser('regen', help="load content from the fake API then time regenerating it")
+        subparser.add_argument('--scale', type=float, default=1, help="multiplier of the amount of content served")
+        subparser.add_argument('--workers', type=int, nargs='+', default=[1], help="number of processes to regenerate with. each is benchmarked in turn.")
+
+        subparser = subparsers.add_parser('flatten', help="time flattening article-json with interpreted and compiled descriptions")
+        subparser.add_argument('--iterations', type=int, default=100)
+
+        subparser = subparsers.add_parser('dates', help="time parsing timestamps during ingestion and formatting them in reports")
+        subparser.add_argument('--iterations', type=int, default=20)
+
+        subparser = subparsers.add_parser('allocations', help="measure the memory allocated extracting child records from article-json")
+        subparser.add_argument('--iterations', type=int, default=20)
+
+        subparser = subparsers.add_parser('stream', help="measure the memory used to iterate over the ids of a large, synthetic, catalogue")
+        subparser.add_argument('--rows', type=int, default=1000000)
+
+    def serve(self, options):
+        server = fake_api.start(port=options['port'], **self.fake_api_options(options))
+        print("fake API listening on %s, ctrl-c to stop" % server.url)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            server.stop()
+
+    def fake_api_options(self, options):
+        return {'scale': options['scale'], 'latency': options['latency'],
+                'error_rate': options['error_rate'], 'padding': options['padding']}
+
+    def handle(self, *args, **options):
+        if options['benchmark'] == 'serve':
+            self.serve(options)
+            sys.exit(0)
+
+        if options['benchmark'] == 'flatten':
+            bench.report("flatten", bench.flatten(iterations=options['iterations']))
+            sys.exit(0)
+
+        if options['benchmark'] == 'dates':
+            bench.report("dates", bench.dates(iterations=options['iterations']))
+            sys.exit(0)
+
+        if options['benchmark'] == 'allocations':
+            bench.report("allocations", bench.allocations(iterations=options['iterations']))
+            sys.exit(0)
+
+        if options['benchmark'] == 'stream':
+            with bench.throwaway_database():
+                bench.report("stream", bench.stream_ids(rows=options['rows']))
+            sys.exit(0)
+
+        if options['benchmark'] == 'regen':
+            for workers in options['workers']:
+                with bench.throwaway_database():
+                    bench.report("regen", bench.regenerate(scale=options['scale'], workers=workers))
+            sys.exit(0)
+
+        load_options = {'workers': options['workers']}
+        if options['target']:
+            load_options['target'] = options['target']
+        with bench.throwaway_database():
+            results = bench.load_from_api(rate=options['rate'], **self.fake_api_options(options), **load_options)
+        bench.report("load_from_api", results)
+        print("\n" + http_stats.STATS.report())
+        sys.exit(0)
@@ -0,0 +1,17 @@
+import sys
+from django.core.management.base import BaseCommand
+from observer import ingest_logic
+import logging
+
+LOG = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = "merges duplicate authors and, optionally, deletes authors without articles."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--delete-orphans', action='store_true', default=False, help="delete authors that aren't attached to any article")
+
+    def handle(self, *args, **options):
+        merged, deleted = ingest_logic.compact_authors(options['delete_orphans'])
+        print("merged %s duplicate authors, deleted %s authors without articles" % (merged, deleted))
+        sys.exit(0)
@@ -1,8 +1,8 @@
 from datetime import datetime, timedelta
 from collections import OrderedDict
-import sys
+import sys, json
 from django.core.management.base import BaseCommand
-from observer import ingest_logic, models, utils
+from observer import consume, ingest_logic, models, utils, http_stats
 from observer.utils import lmap, subdict
 from functools import partial
 
@@ -17,25 +17,52 @@ class Command(BaseCommand):
         parser.add_argument('--msid', nargs='+', required=False)
         parser.add_argument('--target', nargs='+', required=False, choices=TARGETS)
         parser.add_argument('--days', type=int, required=False)
+        parser.add_argument('--workers', type=int, default=1, help="number of articles to download concurrently")
+        parser.add_argument('--resume', action='store_true', default=False, help="continue the previous, interrupted, download")
+        parser.add_argument('--stats-file', required=False, help="path to write per-endpoint HTTP statistics to as JSON")
+
+    def report_stats(self, stats_file=None):
+        if not http_stats.STATS.entries:
+            return
+        print("\n" + http_stats.STATS.report())
+        if stats_file:
+            with open(stats_file, 'w') as fh:
+                json.dump(http_stats.STATS.as_dict(), fh, indent=4)
 
     def handle(self, *args, **options):
+        http_stats.STATS.reset()
         try:
             targetlist = options['target'] or TARGETS
             msidlist = options['msid']
             days = options['days']
-
-            dl_ajson = ingest_logic.download_all_article_versions
-            dl_metrics = ingest_logic.download_all_article_metrics
-            dl_presspackages = partial(ingest_logic.download_all, models.PRESSPACKAGE)
-            dl_profiles = partial(ingest_logic.download_all, models.PROFILE)
-            dl_digests = partial(ingest_logic.download_all, models.DIGEST)
-            dl_labs = partial(ingest_logic.download_all, models.LABS_POST)
-            dl_community = partial(ingest_logic.download_all, models.COMMUNITY)
-            dl_podcasts = partial(ingest_logic.download_all, models.PODCAST)
-            dl_reviewed_preprints = partial(ingest_logic.download_all, models.REVIEWED_PREPRINT)
+            workers = options['workers']
+            if workers > 1 and not consume.threads_allowed():
+                print("ignoring '--workers', the DEBUG API cache can't be shared between threads")
+                workers = 1
+
+            run_id = None
+            if options['resume']:
+                run_id = ingest_logic.last_run_id()
+                if run_id:
+                    print("resuming run %s" % run_id)
+                else:
+                    print("no previous run found to resume")
+            run_id = run_id or ingest_logic.new_run_id()
+
+            dl_ajson = partial(ingest_logic.download_all_article_versions, workers=workers, run_id=run_id)
+            dl_metrics = partial(ingest_logic.download_all_article_metrics, run_id=run_id)
+            dl_presspackages = partial(ingest_logic.download_all, models.PRESSPACKAGE, run_id=run_id)
+            dl_profiles = partial(ingest_logic.download_all, models.PROFILE, run_id=run_id)
+            dl_digests = partial(ingest_logic.download_all, models.DIGEST, run_id=run_id)
+            dl_labs = partial(ingest_logic.download_all, models.LABS_POST, run_id=run_id)
+            dl_community = partial(ingest_logic.download_all, models.COMMUNITY, run_id=run_id)
+            dl_podcasts = partial(ingest_logic.download_all, models.PODCAST, run_id=run_id)
+            dl_reviewed_preprints = partial(ingest_logic.download_all, models.REVIEWED_PREPRINT, run_id=run_id)
 
             if msidlist:
                 dl_ajson = partial(lmap, ingest_logic.download_article_versions, msidlist)
+                if workers > 1:
+                    dl_ajson = partial(ingest_logic.download_articles_concurrently, [(msid, None) for msid in msidlist], workers=workers)
                 dl_metrics = partial(lmap, ingest_logic.download_article_metrics, msidlist)
                 if LAX not in targetlist or METRICS not in targetlist:
                     # except articles and article-metrics, all other content is just a few pages to download,
@@ -58,7 +85,7 @@ class Command(BaseCommand):
                     if res:
                         print("%s: %s" % (result['id'], result['versionDate']))
                     return res
-                ingest_logic.download_regenerate_article_list(some_fn)
+                ingest_logic.download_regenerate_article_list(some_fn, workers=workers)
                 exit(0)
 
             dl_targets = OrderedDict([
@@ -77,17 +104,18 @@ class Command(BaseCommand):
                 print('downloading %r' % content_type)
                 fn()
 
-            # regenerate
+            # regenerate just the content that changed.
+            # use `./manage.sh regen` to regenerate everything.
 
-            regen_articles = ingest_logic.regenerate_all_articles
+            regen_articles = partial(ingest_logic.regenerate_all_articles, dirty=True)
             # regen_metrics = ... # included in article metrics
-            regen_presspackages = partial(ingest_logic.regenerate, models.PRESSPACKAGE)
-            regen_profiles = partial(ingest_logic.regenerate, models.PROFILE)
-            regen_digests = partial(ingest_logic.regenerate, models.DIGEST)
-            regen_labs_posts = partial(ingest_logic.regenerate, models.LABS_POST)
-            regen_community = partial(ingest_logic.regenerate, models.COMMUNITY) # includes features, blog posts, interviews, etc
-            regen_podcasts = partial(ingest_logic.regenerate, models.PODCAST)
-            regen_reviewed_preprints = partial(ingest_logic.regenerate, models.REVIEWED_PREPRINT)
+            regen_presspackages = partial(ingest_logic.regenerate, models.PRESSPACKAGE, dirty=True)
+            regen_profiles = partial(ingest_logic.regenerate, models.PROFILE, dirty=True)
+            regen_digests = partial(ingest_logic.regenerate, models.DIGEST, dirty=True)
+            regen_labs_posts = partial(ingest_logic.regenerate, models.LABS_POST, dirty=True)
+            regen_community = partial(ingest_logic.regenerate, models.COMMUNITY, dirty=True) # includes features, blog posts, interviews, etc
+            regen_podcasts = partial(ingest_logic.regenerate, models.PODCAST, dirty=True)
+            regen_reviewed_preprints = partial(ingest_logic.regenerate, models.REVIEWED_PREPRINT, dirty=True)
 
             if msidlist:
                 regen_articles = partial(lmap, ingest_logic.regenerate_article, msidlist)
@@ -110,7 +138,10 @@ class Command(BaseCommand):
                 fn()
 
         except KeyboardInterrupt:
-            print("\nctrl-c caught, quitting.\ndownload progress has been saved")
+            print("\nctrl-c caught, quitting.\ndownload progress has been saved, use '--resume' to continue")
             sys.exit(1)
 
+        finally:
+            self.report_stats(options['stats_file'])
+
         sys.exit(0)
@@ -1,16 +1,73 @@
 import sys, json
+import argparse
 from django.core.management.base import BaseCommand
+from django.db import transaction
+import contextlib
 import logging
-from observer import ingest_logic
+from observer import ingest_logic, models, profiling, utils
 
 LOG = logging.getLogger(__name__)
 
+def msid_range(val):
+    "parses a range of manuscript IDs like '10000-20000' into a pair of integers"
+    try:
+        lowest, highest = [int(bit) for bit in val.split('-')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a range of manuscript IDs like '10000-20000', got: %r" % val)
+    if lowest > highest:
+        raise argparse.ArgumentTypeError("the start of the range is greater than the end: %r" % val)
+    return lowest, highest
+
+def datetime_arg(val):
+    try:
+        return utils.todt(val)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a date or datetime, got: %r" % val)
+
 class Command(BaseCommand):
-    help = "regenerates all content from the raw JSON stored in the database."
+    help = "regenerates all content, or just some of it, from the raw JSON stored in the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dirty', action='store_true', default=False, help="only regenerate content whose raw JSON has changed since it was last regenerated")
+        parser.add_argument('--workers', type=int, default=1, help="number of processes to flatten raw JSON in. content is read and written by this process and the raw JSON and flattened content are copied between processes.")
+        parser.add_argument('--content-type', nargs='+', choices=ingest_logic.REGENERATABLE, help="only regenerate content of these types. articles are %r." % models.LAX_AJSON)
+        parser.add_argument('--msid-range', type=msid_range, help="only regenerate articles whose manuscript ID is within this inclusive range, like '10000-20000'")
+        parser.add_argument('--since', type=datetime_arg, help="only regenerate content whose raw JSON was written on or after this date or datetime")
+        parser.add_argument('--batch-size', type=int, help="number of items committed at once. articles are batched by commit time when not given.")
+        parser.add_argument('--progress-interval', type=float, default=5, help="seconds between progress reports")
+        parser.add_argument('--profile', action='store_true', default=False, help="time each stage of regenerating each item and sample memory use between batches. implies '--workers 1'.")
+        parser.add_argument('--top', type=int, default=10, help="number of the slowest items to report when profiling")
+        parser.add_argument('--dry-run', action='store_true', default=False, help="roll back everything regenerated. everything is regenerated in a single transaction.")
 
     def handle(self, *args, **options):
+        content_type_list = options['content_type']
+        if options['msid_range']:
+            if content_type_list and content_type_list != [models.LAX_AJSON]:
+                print("the '--msid-range' parameter is only compatible with '--content-type=%s'" % models.LAX_AJSON)
+                sys.exit(1)
+            content_type_list = [models.LAX_AJSON]
+
+        workers = options['workers']
+        if options['profile'] and workers > 1:
+            print("ignoring '--workers', profiling is done in a single process")
+            workers = 1
+
+        progress = utils.Progress(interval=options['progress_interval'])
         try:
-            ingest_logic.regenerate_all()
+            with contextlib.ExitStack() as stack:
+                profiler = stack.enter_context(profiling.profiling()) if options['profile'] else None
+                if options['dry_run']:
+                    stack.enter_context(transaction.atomic())
+                ingest_logic.regenerate_all(dirty=options['dirty'], workers=workers,
+                                            content_type_list=content_type_list, since=options['since'],
+                                            msid_range=options['msid_range'], batches_of=options['batch_size'], progress=progress)
+                if options['dry_run']:
+                    transaction.set_rollback(True)
+            self.stdout.write(progress.summary())
+            if options['dry_run']:
+                self.stdout.write("dry run, nothing was changed")
+            if profiler:
+                self.stdout.write("\n" + profiler.report(top=options['top']))
 
         except json.JSONDecodeError as err:
             LOG.error("failed to load bad content: %s", err)
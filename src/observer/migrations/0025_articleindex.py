@@ -0,0 +1,26 @@
+# Generated by Django 3.2.25 on 2026-10-17 06:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('observer', '0024_alter_content_content_type'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArticleIndex',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('msid', models.CharField(max_length=25, unique=True)),
+                ('version', models.PositiveSmallIntegerField()),
+                ('version_date', models.DateTimeField(help_text='date and time the most recent version was published', null=True)),
+                ('datetime_record_updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'article index',
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-17 06:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('observer', '0025_articleindex'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Checkpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run_id', models.CharField(max_length=32)),
+                ('target', models.CharField(max_length=25)),
+                ('endpoint', models.CharField(max_length=255)),
+                ('position', models.CharField(max_length=25, null=True)),
+                ('complete', models.BooleanField(default=False)),
+                ('datetime_record_updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('target', 'endpoint')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-17 06:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('observer', '0026_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rawjson',
+            name='content_hash',
+            field=models.CharField(blank=True, help_text='hash of `json`, see `utils.content_hash`', max_length=40, null=True),
+        ),
+    ]
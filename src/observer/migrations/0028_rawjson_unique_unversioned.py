@@ -0,0 +1,34 @@
+# Generated by Django 3.2.25 on 2026-10-17 06:20
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def remove_duplicates(apps, schema_editor):
+    "removes all but the most recently inserted unversioned RawJSON row for each msid and json_type"
+    RawJSON = apps.get_model('observer', 'RawJSON')
+    duplicates = RawJSON.objects \
+        .filter(version__isnull=True) \
+        .values('msid', 'json_type') \
+        .annotate(num=Count('id'), max_id=Max('id')) \
+        .filter(num__gt=1)
+    for row in duplicates:
+        RawJSON.objects \
+            .filter(version__isnull=True, msid=row['msid'], json_type=row['json_type']) \
+            .exclude(id=row['max_id']) \
+            .delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('observer', '0027_rawjson_content_hash'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='rawjson',
+            constraint=models.UniqueConstraint(condition=models.Q(('version__isnull', True)), fields=('msid', 'json_type'), name='unique_unversioned_msid_json_type'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 3.2.25 on 2026-10-17 06:23
+
+import hashlib
+from django.db import migrations, models
+
+
+def author_key(author_type, name, country):
+    "a frozen copy of `models.author_key` as it was when this migration was written"
+    def norm(val):
+        return ' '.join(str(val or '').split())
+    key = '|'.join(map(norm, [author_type, name, country]))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def populate_keys(apps, schema_editor):
+    "sets the `key` of every existing author. duplicate authors can then be merged with `./manage.sh compact_authors`"
+    Author = apps.get_model('observer', 'Author')
+    batch = []
+    for author in Author.objects.only('id', 'type', 'name', 'country').iterator():
+        author.key = author_key(author.type, author.name, author.country)
+        batch.append(author)
+        if len(batch) == 1000:
+            Author.objects.bulk_update(batch, ['key'])
+            batch = []
+    if batch:
+        Author.objects.bulk_update(batch, ['key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('observer', '0028_rawjson_unique_unversioned'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='author',
+            name='key',
+            field=models.CharField(db_index=True, help_text='see `author_key`', max_length=40, null=True),
+        ),
+        migrations.RunPython(populate_keys, migrations.RunPython.noop),
+    ]
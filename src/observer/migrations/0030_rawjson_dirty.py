@@ -0,0 +1,22 @@
+# Generated by Django 3.2.25 on 2026-10-17 06:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('observer', '0029_author_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rawjson',
+            name='dirty',
+            field=models.BooleanField(default=True, help_text='`json` has changed since the content it belongs to was last regenerated'),
+        ),
+        migrations.AddIndex(
+            model_name='rawjson',
+            index=models.Index(fields=['json_type', 'dirty'], name='json_type_dirty_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-17 06:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('observer', '0030_rawjson_dirty'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rawjson',
+            name='datetime_record_updated',
+            field=models.DateTimeField(auto_now=True, db_index=True, help_text='when `json` was last written. `NULL` if before this field existed.', null=True),
+        ),
+    ]
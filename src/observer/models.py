@@ -1,3 +1,4 @@
+import hashlib
 from annoying.fields import JSONField
 from django.db import models
 from django.db.models import (
@@ -176,14 +177,27 @@ class Subject(models.Model):
     def __repr__(self):
         return '<Subject "%s">' % self.name
 
+def author_key(author_type, name, country):
+    """returns a hash identifying an author by it's `author_type`, `name` and `country`.
+    whitespace is normalised so trivially different names have the same key."""
+    def norm(val):
+        return ' '.join(str(val or '').split())
+    key = '|'.join(map(norm, [author_type, name, country]))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
 class Author(models.Model):
     type = models.CharField(max_length=50)
     name = models.CharField(max_length=255)
     country = models.CharField(max_length=150, null=True)
+    key = models.CharField(max_length=40, null=True, db_index=True, help_text="see `author_key`")
 
     class Meta:
         ordering = ('name',)
 
+    def save(self, *args, **kwargs):
+        self.key = author_key(self.type, self.name, self.country)
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return self.name
 
@@ -326,12 +340,21 @@ class RawJSON(models.Model):
     version = PositiveSmallIntegerField(null=True, blank=True) # only used by Article objects
     json = JSONField()
     json_type = CharField(max_length=25, choices=json_type_choices(), null=False, blank=False)
+    content_hash = CharField(max_length=40, null=True, blank=True, help_text="hash of `json`, see `utils.content_hash`")
+    dirty = BooleanField(default=True, help_text="`json` has changed since the content it belongs to was last regenerated")
+    datetime_record_updated = DateTimeField(auto_now=True, null=True, db_index=True, help_text="when `json` was last written. `NULL` if before this field existed.")
 
     class Meta:
         unique_together = ('msid', 'version')
         ordering = ('-msid', 'version') # [09561 v1, 09561 v2, 09560 v1]
         indexes = [
-            models.Index(fields=['msid', 'json_type'], name='msid_json_type_idx')
+            models.Index(fields=['msid', 'json_type'], name='msid_json_type_idx'),
+            models.Index(fields=['json_type', 'dirty'], name='json_type_dirty_idx'),
+        ]
+        constraints = [
+            # `unique_together` doesn't apply to unversioned content as NULL values are never equal.
+            # see `utils.bulk_upsert`
+            models.UniqueConstraint(fields=['msid', 'json_type'], condition=models.Q(version__isnull=True), name='unique_unversioned_msid_json_type')
         ]
 
     def __str__(self):
@@ -342,6 +365,44 @@ class RawJSON(models.Model):
             return '<RawJSON %r %sv%s>' % (self.json_type, self.msid, self.version)
         return '<RawJSON %r %s>' % (self.json_type, self.msid)
 
+class ArticleIndex(models.Model):
+    """the most recent version of each article in the API's `/articles` listing.
+    updated incrementally by `ingest_logic.update_article_index`."""
+    msid = CharField(max_length=25, unique=True)
+    version = PositiveSmallIntegerField()
+    version_date = DateTimeField(null=True, help_text="date and time the most recent version was published")
+
+    datetime_record_updated = DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = 'article index'
+
+    def __str__(self):
+        return self.msid
+
+    def __repr__(self):
+        return '<ArticleIndex %sv%s>' % (self.msid, self.version)
+
+class Checkpoint(models.Model):
+    """the progress of a bulk download of a `target` content type from an API `endpoint`.
+    `position` is the last fully processed page or msid. see `load_from_api --resume`."""
+    run_id = CharField(max_length=32)
+    target = CharField(max_length=25) # ll: 'lax-ajson', 'profiles-id'
+    endpoint = CharField(max_length=255) # ll: 'articles', 'profiles'
+    position = CharField(max_length=25, null=True)
+    complete = BooleanField(default=False)
+
+    datetime_record_updated = DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('target', 'endpoint')
+
+    def __str__(self):
+        return "%s %s" % (self.target, self.position)
+
+    def __repr__(self):
+        return '<Checkpoint %r %r %s>' % (self.target, self.endpoint, self.position)
+
 # TODO - this would require scraping full press package data
 # class PressPackageContact(models.Model):
 #    id = CharField(max_length=150, primary_key=True)
@@ -0,0 +1,125 @@
+"""stage by stage profiling of regeneration.
+
+while `profiling` is in use, the time each item spends in each stage of regeneration is recorded:
+
+- load: reading the item's raw json from the database, including decoding it
+- flatten: rendering the raw json into a flat map of values, see `ingest_logic.flatten_article_json`
+- extract: separating child objects from the flattened values, see `ingest_logic.extract_children`
+- save: writing the objects to the database, see `utils.save_objects`
+
+raw json is loaded a batch at a time so the time spent loading a batch is shared between it's items.
+memory is sampled with `tracemalloc` between batches. tracing memory slows everything down, so timings
+are best compared with each other rather than with regeneration that isn't being profiled.
+
+`ingest_logic` records into the shared `PROFILER` object, which is `None` when not profiling."""
+
+import contextlib, time, tracemalloc
+
+STAGES = ['load', 'flatten', 'extract', 'save']
+
+MEMORY_ROWS = 20
+
+class Profiler:
+    def __init__(self):
+        self.timings = {} # {(content-type, id): {stage: seconds, ...}, ...}
+        self.memory = [] # [(items-done, current-bytes, peak-bytes), ...]
+
+    def record(self, key_list, stage_name, seconds):
+        "records that the items in `key_list` spent `seconds` in `stage_name` between them"
+        if not key_list:
+            return
+        seconds = seconds / len(key_list)
+        for key in key_list:
+            timing = self.timings.setdefault(key, {})
+            timing[stage_name] = timing.get(stage_name, 0) + seconds
+
+    def sample_memory(self):
+        "records the memory currently allocated and the peak since the last sample, if memory is being traced"
+        if not tracemalloc.is_tracing():
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        if hasattr(tracemalloc, 'reset_peak'): # python 3.9+
+            tracemalloc.reset_peak()
+        self.memory.append((len(self.timings), current, peak))
+
+    def slowest(self, top=10):
+        "returns a list of the `top` slowest items as pairs of (key, {stage: seconds, ...})"
+        return sorted(self.timings.items(), key=lambda pair: sum(pair[1].values()), reverse=True)[:top]
+
+    def breakdown(self):
+        "returns a map of {stage: (total-seconds, mean-seconds, max-seconds), ...}"
+        result = {}
+        for stage_name in STAGES:
+            val_list = [timing[stage_name] for timing in self.timings.values() if stage_name in timing]
+            if val_list:
+                result[stage_name] = (sum(val_list), sum(val_list) / len(val_list), max(val_list))
+        return result
+
+    def report(self, top=10):
+        "returns a human readable per-stage breakdown, the `top` slowest items and the memory samples"
+        def table(row_list):
+            width_list = [max(len(str(row[i])) for row in row_list) for i in range(len(row_list[0]))]
+            return ["  ".join(str(val).ljust(width) for val, width in zip(row, width_list)).rstrip() for row in row_list]
+
+        ms = lambda seconds: "%.1f" % (seconds * 1000)
+        breakdown = self.breakdown()
+        total = sum(stage_total for stage_total, _, _ in breakdown.values())
+        row_list = [['stage', 'total s', 'mean ms', 'max ms', 'share']]
+        for stage_name, (stage_total, mean, maximum) in breakdown.items():
+            row_list.append([stage_name, "%.2f" % stage_total, ms(mean), ms(maximum), "%.1f%%" % (stage_total / total * 100 if total else 0)])
+        row_list.append(['all', "%.2f" % total, ms(total / len(self.timings)) if self.timings else '-', '', ''])
+        line_list = ["%s items" % len(self.timings)] + table(row_list)
+
+        line_list += ["", "%s slowest items" % top]
+        row_list = [['content type', 'id', 'total ms'] + ["%s ms" % stage_name for stage_name in STAGES]]
+        for (content_type, content_id), timing in self.slowest(top):
+            row_list.append([content_type, content_id, ms(sum(timing.values()))] + [ms(timing.get(stage_name, 0)) for stage_name in STAGES])
+        line_list += table(row_list)
+
+        if self.memory:
+            peak = max(peak for _, _, peak in self.memory)
+            line_list += ["", "memory between batches (tracemalloc), peak %.1f MiB" % (peak / 1024 / 1024)]
+            row_list = [['items', 'current MiB', 'peak MiB']]
+            # at most ~`MEMORY_ROWS` evenly spaced samples and the last
+            sample_list = self.memory[::max(len(self.memory) // MEMORY_ROWS, 1)]
+            if sample_list[-1] != self.memory[-1]:
+                sample_list.append(self.memory[-1])
+            for num_items, current, peak in sample_list:
+                row_list.append([num_items, "%.1f" % (current / 1024 / 1024), "%.1f" % (peak / 1024 / 1024)])
+            line_list += table(row_list)
+        return "\n".join(line_list)
+
+PROFILER = None
+
+@contextlib.contextmanager
+def profiling(trace_memory=True):
+    """records the time items spend in each stage of regeneration while in use.
+    usage: with profiling() as profiler: ...; print(profiler.report())"""
+    global PROFILER
+    previous = PROFILER
+    PROFILER = Profiler()
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        yield PROFILER
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+        PROFILER = previous
+
+@contextlib.contextmanager
+def stage(name, key_list):
+    "records the time spent in the `name` stage by the items in `key_list`, if profiling"
+    if PROFILER is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        PROFILER.record(key_list, name, time.perf_counter() - start)
+
+def batch_done():
+    "samples memory use after a batch of items, if profiling"
+    if PROFILER is not None:
+        PROFILER.sample_memory()
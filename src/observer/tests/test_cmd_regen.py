@@ -1,6 +1,8 @@
 from os.path import join
-from .base import BaseCase, call_command
-from observer import models, ingest_logic
+from .base import BaseCase, call_command, jsonfix
+from unittest.mock import patch
+from datetime import timedelta
+from observer import consume, models, ingest_logic, utils
 
 class Cmd(BaseCase):
     def setUp(self):
@@ -30,3 +32,77 @@ class Cmd(BaseCase):
 
         # article has been ingested
         self.assertEqual(models.Article.objects.count(), 1)
+
+    def test_regen_dirty(self):
+        "only articles that have changed since they were last regenerated are regenerated"
+        ingest_logic.file_upsert(join(self.fixture_dir, 'ajson', 'elife-13964-v1.xml.json'))
+        ingest_logic.file_upsert(join(self.fixture_dir, 'ajson', 'elife-14850-v1.xml.json'), regen=False)
+        self.assertEqual(models.Article.objects.count(), 1)
+
+        with patch('observer.ingest_logic.regenerate_many_articles') as mock:
+            errcode, stdout = call_command(self.nom, '--dirty')
+        self.assertEqual(errcode, 0)
+        mock.assert_called_once()
+        self.assertEqual(list(mock.call_args[0][0]), [14850]) # streamed from the database
+        self.assertEqual(mock.call_args[1]['workers'], 1)
+
+    def test_regen_workers(self):
+        ingest_logic.file_upsert(join(self.fixture_dir, 'ajson', 'elife-13964-v1.xml.json'), regen=False)
+        errcode, stdout = call_command(self.nom, '--workers', '2')
+        self.assertEqual(errcode, 0)
+        self.assertEqual(models.Article.objects.count(), 1)
+
+    def test_regen_content_type(self):
+        "just the given content types are regenerated"
+        ingest_logic.file_upsert(join(self.fixture_dir, 'ajson', 'elife-13964-v1.xml.json'), regen=False)
+        fixture = jsonfix('presspackages', 'many.json')
+        consume.upsert_all(models.PRESSPACKAGE, fixture['items'], consume.default_idfn)
+        errcode, stdout = call_command(self.nom, '--content-type', models.PRESSPACKAGE, '--batch-size', '2')
+        self.assertEqual(errcode, 0)
+        self.assertEqual(models.Article.objects.count(), 0)
+        self.assertEqual(models.PressPackage.objects.count(), len(fixture['items']))
+        self.assertIn("%s done in" % len(fixture['items']), stdout)
+
+    def test_regen_msid_range(self):
+        "just the articles within the given range of manuscript ids are regenerated"
+        for fixture in ['elife-13964-v1.xml.json', 'elife-14850-v1.xml.json', 'elife-15378-v1.xml.json']:
+            ingest_logic.file_upsert(join(self.fixture_dir, 'ajson', fixture), regen=False)
+        errcode, stdout = call_command(self.nom, '--msid-range', '14000-16000')
+        self.assertEqual(errcode, 0)
+        self.assertEqual(sorted(models.Article.objects.values_list('msid', flat=True)), [14850, 15378])
+
+        errcode, stdout = call_command(self.nom, '--msid-range', '14000-16000', '--content-type', models.PROFILE)
+        self.assertEqual(errcode, 1)
+
+    def test_regen_since(self):
+        "just the content whose raw json was written on or after the given datetime is regenerated"
+        ingest_logic.file_upsert(join(self.fixture_dir, 'ajson', 'elife-13964-v1.xml.json'), regen=False)
+        since = utils.utcnow() + timedelta(seconds=1)
+        models.RawJSON.objects.filter(msid='13964').update(datetime_record_updated=since - timedelta(days=1))
+        ingest_logic.file_upsert(join(self.fixture_dir, 'ajson', 'elife-14850-v1.xml.json'), regen=False)
+        models.RawJSON.objects.filter(msid='14850').update(datetime_record_updated=since)
+
+        errcode, stdout = call_command(self.nom, '--since', utils.ymdhms(since))
+        self.assertEqual(errcode, 0)
+        self.assertEqual(list(models.Article.objects.values_list('msid', flat=True)), [14850])
+
+    def test_regen_failures_summarised(self):
+        "articles that fail to regenerate are skipped and listed in the summary"
+        ingest_logic.file_upsert(join(self.fixture_dir, 'ajson', 'elife-13964-v1.xml.json'), regen=False)
+        ingest_logic.file_upsert(join(self.fixture_dir, 'ajson', 'elife-14850-v1.xml.json'), regen=False)
+        models.RawJSON.objects.filter(msid='13964').update(json={'pants': 'party'})
+        errcode, stdout = call_command(self.nom)
+        self.assertEqual(errcode, 0)
+        self.assertEqual(models.Article.objects.count(), 1)
+        self.assertIn("failed: ('%s', 13964)" % models.LAX_AJSON, stdout)
+
+    def test_regen_profile_dry_run(self):
+        "regeneration can be profiled and rolled back"
+        ingest_logic.file_upsert(join(self.fixture_dir, 'ajson', 'elife-13964-v1.xml.json'), regen=False)
+        errcode, stdout = call_command(self.nom, '--profile', '--dry-run', '--workers', '2', '--top', '1')
+        self.assertEqual(errcode, 0)
+        self.assertEqual(models.Article.objects.count(), 0)
+        self.assertTrue(models.RawJSON.objects.get(msid='13964').dirty)
+        self.assertIn("dry run", stdout)
+        self.assertIn("1 slowest items", stdout)
+        self.assertIn("%s     13964" % models.LAX_AJSON, stdout)
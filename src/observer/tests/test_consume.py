@@ -1,23 +1,41 @@
 import pytest
 import json
+import requests
+import requests_cache
+import threading
 from . import base
 from os.path import join
 from unittest import mock
-from observer import consume, models
+from observer import consume, models, utils
+from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 def test_consume():
     expected_params = {'per-page': 100, 'page': 1}
-    expected_headers = {'headers': {'user-agent': 'observer/unreleased (https://github.com/elifesciences/observer)'}}
+    expected_headers = {'params': expected_params,
+                        'headers': {'user-agent': 'observer/unreleased (https://github.com/elifesciences/observer)'},
+                        'timeout': (settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT)}
     expected_result = {'omg': 'pants'}
     mock_request = mock.MagicMock(json=lambda: expected_result)
-    with mock.patch('requests.get', return_value=mock_request) as mockobj:
+    with mock.patch('requests.Session.get', return_value=mock_request) as mockobj:
         assert expected_result == consume.consume("whatever")
-        actual_params, actual_headers = mockobj.call_args
-        actual_params = actual_params[1]
-
-        assert actual_params == expected_params
+        _, actual_headers = mockobj.call_args
         assert actual_headers == expected_headers
 
+def test_session():
+    "a single session with pooled connections to the API is shared between threads"
+    sess = consume.session()
+    assert sess is consume.session()
+    adapter = sess.get_adapter(settings.API_URL + "/articles")
+    assert adapter._pool_maxsize == settings.HTTP_POOL_SIZE
+
+def test_session__forked():
+    "a new session is created when the process id changes"
+    sess = consume.session()
+    with mock.patch('os.getpid', return_value=-1):
+        assert sess is not consume.session()
+
 def test_content_type_from_endpoint():
     """given a request, the content-type identifier is correctly generated.
     the content-type identifier is used as an index for `models.RawJSON.json_type`"""
@@ -122,3 +140,128 @@ class Upsert(base.BaseCase):
 
         insert()
         self.assertEqual(expected, models.RawJSON.objects.count())
+
+@pytest.mark.django_db
+def test_all_items__page_order():
+    "pages fetched concurrently are still upserted in page order"
+    def fake_consume(endpoint, params):
+        page = params.get('page', 1)
+        if params['per-page'] == 1:
+            return {"total": 500, "items": []}
+        return {"total": 500, "items": [{"id": str(page * 1000 + i)} for i in range(100)]}
+
+    with mock.patch('observer.consume.consume', side_effect=fake_consume):
+        with mock.patch('observer.consume.upsert_all') as mock_upsert_all:
+            consume.all_items('profiles')
+
+    rows = [row for (_, row_list, _), _ in mock_upsert_all.call_args_list for row in row_list]
+    expected = [str(page * 1000 + i) for page in range(1, 6) for i in range(100)]
+    assert [row['id'] for row in rows] == expected
+
+@pytest.mark.django_db
+def test_all_items__debug_cache():
+    "pages are fetched in the calling thread while the DEBUG cache is installed, it can't be shared between threads"
+    thread_list = []
+
+    def fake_get(url, params=None, **kwargs):
+        thread_list.append(threading.get_ident())
+        return mock.MagicMock(status_code=200, content=b'', json=lambda: {"total": 500, "items": [{"id": str(params['page'])}]})
+
+    requests_cache.install_cache(backend='memory')
+    try:
+        assert not consume.threads_allowed()
+        with mock.patch.dict(consume._SESSION, {'pid': None, 'session': None}):
+            with mock.patch('requests.Session.get', side_effect=fake_get):
+                consume.all_items('profiles')
+                assert isinstance(consume.session(), requests_cache.CachedSession)
+    finally:
+        requests_cache.uninstall_cache()
+    assert consume.threads_allowed()
+    assert len(thread_list) == 6 # initial request + 5 pages
+    assert set(thread_list) == {threading.get_ident()}
+    assert models.RawJSON.objects.filter(json_type=models.PROFILE).count() == 5
+
+def test_token_bucket():
+    "a token bucket allows a burst of requests up to it's capacity and then blocks"
+    bucket = consume.TokenBucket(rate=1000, capacity=2)
+    assert bucket.take() == 0
+    assert bucket.take() == 0
+    assert bucket.take() > 0
+
+def test_aimd():
+    "the concurrency limit grows by one on success and is halved when requests are throttled"
+    aimd = consume.AIMD(minimum=1, maximum=4)
+    assert aimd.limit == 1
+    aimd.record()
+    assert aimd.adjust() == 2
+    aimd.record()
+    assert aimd.adjust() == 3
+    aimd.record()
+    assert aimd.adjust() == 4
+    aimd.record()
+    assert aimd.adjust() == 4 # maximum reached
+
+    aimd.record(throttled=True)
+    aimd.record()
+    assert aimd.adjust() == 2
+    aimd.record(throttled=True)
+    assert aimd.adjust() == 1
+    aimd.record(throttled=True)
+    assert aimd.adjust() == 1 # minimum reached
+
+def test_requests_get__throttled():
+    "429 responses are recorded as throttled requests"
+    response = requests.Response()
+    response.status_code = 429
+    aimd = consume.AIMD(minimum=1, maximum=4)
+    with mock.patch('observer.consume.CONCURRENCY', aimd):
+        with mock.patch('requests.Session.get', return_value=response):
+            with pytest.raises(requests.exceptions.HTTPError):
+                consume.requests_get.__wrapped__("https://example.org")
+    assert aimd.throttled == 1
+
+def test_requests_get__timeout_retried():
+    "requests that time out are retried rather than given up on"
+    response = mock.MagicMock(status_code=200, content=b'{}')
+    with mock.patch('requests.Session.get', side_effect=[requests.exceptions.ReadTimeout(), response]) as mock_get:
+        with mock.patch('backoff._sync.time.sleep'):
+            assert consume.requests_get("https://example.org") is response
+    assert mock_get.call_count == 2
+
+def test_consume__timeout_logged():
+    "a request that times out on every attempt is logged and raised"
+    with mock.patch('requests.Session.get', side_effect=requests.exceptions.ConnectTimeout()):
+        with mock.patch('backoff._sync.time.sleep'):
+            with mock.patch('observer.consume.LOG') as mock_log:
+                with pytest.raises(requests.exceptions.ConnectTimeout):
+                    consume.consume("whatever")
+    assert mock_log.error.called
+
+@pytest.mark.django_db
+def test_upsert__unchanged():
+    "RawJSON isn't written when it's content hasn't changed"
+    content = {'id': 'foo', 'title': 'bar'}
+    _, created, updated = consume.upsert('foo', models.PROFILE, content)
+    assert (created, updated) == (True, False)
+
+    with CaptureQueriesContext(connection) as ctx:
+        inst, created, updated = consume.upsert('foo', models.PROFILE, dict(content))
+    assert (created, updated) == (False, False)
+    assert len(ctx.captured_queries) == 1 # select only
+
+    _, created, updated = consume.upsert('foo', models.PROFILE, {'id': 'foo', 'title': 'baz'})
+    assert (created, updated) == (False, True)
+    raw = models.RawJSON.objects.get(msid='foo')
+    assert raw.json['title'] == 'baz'
+    assert raw.content_hash == utils.content_hash(raw.json)
+
+@pytest.mark.django_db
+def test_upsert_all():
+    "many rows are upserted with a constant number of queries"
+    row_list = [{'id': str(i), 'title': 'foo'} for i in range(250)]
+    with CaptureQueriesContext(connection) as ctx:
+        assert consume.upsert_all(models.PROFILE, row_list, consume.default_idfn) == (250, 0)
+    assert len(ctx.captured_queries) < 10
+    row_list[0]['title'] = 'bar'
+    assert consume.upsert_all(models.PROFILE, row_list, consume.default_idfn) == (0, 1)
+    assert models.RawJSON.objects.get(msid='0').json['title'] == 'bar'
@@ -0,0 +1,119 @@
+import copy, glob, os
+from collections import OrderedDict
+import pytest
+from et3 import render
+from observer import extractors, ingest_logic, models
+from observer.extractors import path as p
+from . import base
+
+def _items(fixture_dir):
+    "yields each item in each json fixture in `fixture_dir`"
+    for path in sorted(glob.glob(os.path.join(base.FIXTURE_DIR, fixture_dir, '*.json'))):
+        data = base.jsonfix(fixture_dir, os.path.basename(path))
+        for item in data.get('items', [data]):
+            yield item
+
+def _articles():
+    "yields article-json prepared like `ingest_logic.flatten_article_json` does, one per version"
+    version_list = list(_items('ajson')) + list(_items('insights'))
+    for data in version_list:
+        data = copy.deepcopy(data)
+        data['known-versions'] = [v for v in version_list if v['id'] == data['id']]
+        data['history'] = {}
+        data['metrics'] = {'views': 1, 'downloads': 2, 'crossref': 3, 'pubmed': 4, 'scopus': 5}
+        yield data
+
+def _corpus():
+    "yields pairs of (description, item) for every fixture that can be rendered"
+    for data in _articles():
+        yield ingest_logic.DESC, data
+        yield ingest_logic.INSIGHTS_DESC, data
+
+    fixture_dirs = {
+        models.LABS_POST: 'labs-posts',
+        models.DIGEST: 'digests',
+        models.PRESSPACKAGE: 'presspackages',
+        models.PROFILE: 'profiles',
+        models.INTERVIEW: 'interviews',
+        models.COLLECTION: 'collections',
+        models.BLOG_ARTICLE: 'blog-articles',
+        models.REVIEWED_PREPRINT: 'reviewed-preprints',
+        models.PODCAST: 'podcast-episodes',
+    }
+    for content_type, fixture_dir in fixture_dirs.items():
+        for item in _items(fixture_dir):
+            yield ingest_logic.CONTENT_DESCRIPTIONS[content_type]['description'], item
+
+    for item in _items('community'):
+        yield ingest_logic.CONTENT_DESCRIPTIONS[item['type']]['description'], item
+
+def _render(fn, *args):
+    "returns the result of calling `fn` or the type and message of the error it raised"
+    try:
+        return fn(*args)
+    except Exception as err:
+        return (type(err), str(err))
+
+def test_equivalence():
+    "compiled descriptions render every fixture exactly as et3 does"
+    compiled = {}
+    num_items = 0
+    for description, item in _corpus():
+        if id(description) not in compiled:
+            compiled[id(description)] = extractors.compile_description(description)
+        expected = _render(render.render_item, description, item)
+        actual = _render(compiled[id(description)], item)
+        assert expected == actual
+        if isinstance(expected, dict):
+            assert list(expected.keys()) == list(actual.keys())
+        num_items += 1
+    assert num_items > 250
+
+def test_renderers():
+    "the renderers `ingest_logic` uses are compiled from it's descriptions"
+    for content_type, content_description in ingest_logic.CONTENT_DESCRIPTIONS.items():
+        if 'description' in content_description:
+            assert content_type in ingest_logic.RENDERERS
+    data = next(_articles())
+    assert ingest_logic.render_article(data) == render.render_item(ingest_logic.DESC, data)
+
+@pytest.mark.parametrize("pobj, data", [
+    (p('a.b'), {'a': {'b': 1}}),
+    (p('a.0.b'), {'a': [{'b': 1}]}),
+    (p('a.b', None), {'a': {}}),
+    (p('a.b', None), {}),
+    (p('a.1', None), {'a': [1]}), # IndexError, defaults only apply to missing keys
+    (p('a.b'), {'a': {}}), # KeyError
+    (p('a.b'), {'a': 1}), # ValueError, not a dict or list
+    (p('a.b'), {'a': [1]}), # ValueError, not an int
+    (p('a'), "not a dict"),
+    (p(None), {'a': 1}),
+    (ingest_logic.pp(p('a.b'), p('c')), {'c': 2}),
+    (ingest_logic.pp(p('a.b'), p('c')), {}),
+    (ingest_logic.pp(), {}),
+])
+def test_segment(pobj, data):
+    "compiled paths return the same values and raise the same errors as et3 paths"
+    assert _render(extractors.compile_segment(pobj), data) == _render(pobj, data)
+
+def test_description():
+    "constants, tuples, nested descriptions, callable pipelines and excluded values are rendered as et3 does"
+    def ctxfn(ctx, v):
+        return (ctx, v)
+    ctxfn.requires_context = True
+
+    description = OrderedDict([
+        ('constant', ['foo']),
+        ('pair', [(p('a'), p('b', 0), 'c', ('d',)), list]),
+        ('nested', {'x': [p('a'), str]}),
+        ('callable', lambda doall, item: doall(item, [p('a')])),
+        ('context', [p('a'), ctxfn]),
+        ('excluded', [p('z', render.EXCLUDE_ME)]),
+        ('empty', []),
+    ])
+    data = {'a': 1}
+    expected = render.render_item(description, data)
+    actual = extractors.compile_description(description)(data)
+    assert expected == actual
+    assert isinstance(actual, OrderedDict)
+    assert 'excluded' not in actual
@@ -0,0 +1,86 @@
+import requests
+from observer import bench, fake_api, logic, models
+from . import base
+
+class FakeAPI(base.BaseCase):
+    def setUp(self):
+        self.server = fake_api.start(scale=0.5)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def get(self, endpoint, **params):
+        return requests.get(self.server.url + "/" + endpoint, params=params)
+
+    def test_articles(self):
+        "synthetic articles are listed newest first and each of their versions can be fetched"
+        resp = self.get('articles', **{'per-page': 100}).json()
+        self.assertEqual(resp['total'], 50)
+        msid_list = [int(item['id']) for item in resp['items']]
+        self.assertEqual(msid_list, sorted(msid_list, reverse=True))
+
+        latest = resp['items'][0]
+        version_list = self.get('articles/%s/versions' % latest['id']).json()['versions']
+        self.assertEqual(version_list[-1]['version'], latest['version'])
+
+        article = self.get('articles/%s/versions/%s' % (latest['id'], latest['version'])).json()
+        self.assertEqual(article['id'], latest['id'])
+        self.assertEqual(article['versionDate'], latest['versionDate'])
+        self.assertEqual(self.get('articles/%s/versions/99' % latest['id']).status_code, 404)
+        self.assertEqual(self.get('articles/1/versions/1').status_code, 404)
+
+    def test_listings(self):
+        "all listings observer consumes are served and paginated with unique identifiers"
+        for endpoint in fake_api.listing_endpoints():
+            resp = self.get(endpoint, **{'per-page': 1})
+            self.assertEqual(resp.status_code, 200, endpoint)
+
+        resp = self.get('profiles', **{'per-page': 100, 'page': 2}).json()
+        self.assertEqual(resp['total'], 661) # 1323 * 0.5
+        id_list = [item['id'] for item in resp['items']]
+        self.assertEqual(len(set(id_list)), 100)
+        self.assertTrue(all(len(iid) == 8 for iid in id_list))
+
+        item = self.get('profiles/%s' % id_list[0]).json()
+        self.assertEqual(item['id'], id_list[0])
+
+    def test_errors(self):
+        self.server.error_rate = 1
+        self.assertEqual(self.get('articles').status_code, 503)
+        self.assertEqual(self.server.stats()['errors'], 1)
+
+    def test_padding(self):
+        self.server.padding = 1000
+        resp = self.get('digests').json()
+        self.assertTrue(all(len(item['-padding']) == 1000 for item in resp['items']))
+
+class Bench(base.BaseCase):
+    def test_load_from_api(self):
+        "`load_from_api` can be run end to end against the fake API"
+        results = bench.load_from_api(scale=0.1, rate=1000, target=['lax'], workers=2)
+        self.assertEqual(results['articles'], 10)
+        self.assertEqual(models.Article.objects.count(), 10)
+        self.assertEqual(results['errors'], 0)
+
+    def test_regenerate(self):
+        "content loaded from the fake API can be regenerated using many processes"
+        results = bench.regenerate(scale=0.1, workers=2)
+        self.assertEqual(results['articles'], 10)
+        # metrics of articles that don't exist are never regenerated and stay dirty
+        self.assertFalse(models.RawJSON.objects.filter(dirty=True).exclude(json_type=models.METRICS_SUMMARY).exists())
+        self.assertEqual(list(logic.dirty_articles()), [])
+
+    def test_micro_benchmarks(self):
+        "benchmarks that don't touch the database can be run"
+        self.assertEqual(bench.flatten(iterations=1)['articles'], 12)
+        results = bench.dates(iterations=1)
+        self.assertTrue(results['unique timestamps'] <= results['timestamps'])
+        results = bench.allocations(iterations=1)
+        self.assertTrue(results['copy-free (KiB/article)'] < results['copying (KiB/article)'])
+
+    def test_stream_ids(self):
+        "the ids of a synthetic catalogue can be iterated over and the memory used measured"
+        results = bench.stream_ids(rows=2000)
+        self.assertEqual(models.RawJSON.objects.count(), 2000)
+        self.assertEqual(logic.known_articles().count(), 2000)
+        self.assertTrue(results['streamed, peak memory growth (MiB)'] >= 0)
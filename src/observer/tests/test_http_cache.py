@@ -0,0 +1,91 @@
+import os
+import json
+import requests
+from unittest import mock
+from django.test import override_settings
+from observer import http_cache, consume, utils
+
+def response(status_code, body=None, headers=None):
+    resp = requests.Response()
+    resp.status_code = status_code
+    resp.headers.update(headers or {})
+    resp._content = json.dumps(body).encode('utf-8') if body is not None else b''
+    return resp
+
+def test_cache_disabled():
+    "no requests are cached when a cache directory isn't configured"
+    with override_settings(API_CACHE_DIR=None):
+        assert not http_cache.enabled()
+        with mock.patch('requests.Session.get', return_value=response(200, {'foo': 'bar'}, {'ETag': '"1"'})) as mock_get:
+            assert consume.consume("profiles") == {'foo': 'bar'}
+            assert 'If-None-Match' not in mock_get.call_args[1]['headers']
+
+def test_cache_revalidated():
+    "cached responses are revalidated and a 304 response is served from the cache"
+    temp_dir, killer = utils.tempdir()
+    try:
+        with override_settings(API_CACHE_DIR=temp_dir):
+            fresh = response(200, {'foo': 'bar'}, {'ETag': '"1"'})
+            with mock.patch('requests.Session.get', return_value=fresh):
+                assert consume.consume("profiles") == {'foo': 'bar'}
+
+            with mock.patch('requests.Session.get', return_value=response(304)) as mock_get:
+                assert consume.consume("profiles") == {'foo': 'bar'}
+                assert mock_get.call_args[1]['headers']['If-None-Match'] == '"1"'
+
+            # different parameters are cached separately
+            with mock.patch('requests.Session.get', return_value=response(200, {'bar': 'baz'})) as mock_get:
+                assert consume.consume("profiles", {'page': 2}) == {'bar': 'baz'}
+                assert 'If-None-Match' not in mock_get.call_args[1]['headers']
+    finally:
+        killer()
+
+def test_cache_revalidated__new_validators():
+    "new validators in a 304 response replace the cached ones and the cached body is kept"
+    temp_dir, killer = utils.tempdir()
+    try:
+        with override_settings(API_CACHE_DIR=temp_dir):
+            with mock.patch('requests.Session.get', return_value=response(200, {'foo': 'bar'}, {'ETag': '"1"'})):
+                assert consume.consume("profiles") == {'foo': 'bar'}
+
+            with mock.patch('requests.Session.get', return_value=response(304, headers={'ETag': '"2"'})):
+                assert consume.consume("profiles") == {'foo': 'bar'}
+
+            with mock.patch('requests.Session.get', return_value=response(304)) as mock_get:
+                assert consume.consume("profiles") == {'foo': 'bar'}
+                assert mock_get.call_args[1]['headers']['If-None-Match'] == '"2"'
+    finally:
+        killer()
+
+def test_cache_uncacheable():
+    "responses without an ETag or Last-Modified header are not stored"
+    temp_dir, killer = utils.tempdir()
+    try:
+        with override_settings(API_CACHE_DIR=temp_dir):
+            assert not http_cache.put("https://example.org", {}, response(200, {'foo': 'bar'}))
+            assert http_cache.put("https://example.org", {}, response(200, {'foo': 'bar'}, {'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'}))
+            entry = http_cache.get("https://example.org", {})
+            assert http_cache.conditional_headers(entry) == {'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT'}
+    finally:
+        killer()
+
+def test_cache_eviction():
+    "the least recently used entries are evicted once the cache grows too large"
+    temp_dir, killer = utils.tempdir()
+    try:
+        with override_settings(API_CACHE_DIR=temp_dir, API_CACHE_MAX_BYTES=10 ** 9):
+            for i in range(5):
+                http_cache.put("https://example.org/%s" % i, {}, response(200, {'id': i}, {'ETag': str(i)}))
+            # make the first entry the oldest, and the second the most recently used
+            for i in range(5):
+                path = http_cache.cache_path(http_cache.cache_key("https://example.org/%s" % i, {}))
+                os.utime(path, (i, i))
+            http_cache.touch("https://example.org/1", {})
+
+            entry_size = http_cache.cache_size() // 5
+            assert http_cache.evict(max_bytes=entry_size * 3) == 3
+            assert http_cache.get("https://example.org/0", {}) is None
+            assert http_cache.get("https://example.org/1", {}) is not None
+            assert http_cache.get("https://example.org/4", {}) is not None
+    finally:
+        killer()
@@ -0,0 +1,75 @@
+import json, os
+from unittest import mock
+import pytest
+from django.conf import settings
+from observer import bench, consume, http_stats, utils
+from . import base
+
+@pytest.mark.parametrize("given, expected", [
+    ("articles", "articles"),
+    ("/articles/", "articles"),
+    ("articles/123/versions", "articles/{id}/versions"),
+    ("articles/123/versions/2", "articles/{id}/versions/{version}"),
+    ("metrics/article/summary", "metrics/article/summary"),
+    ("metrics/article/9560/summary", "metrics/article/{id}/summary"),
+    ("profiles/ssiyns7x", "profiles/{id}"),
+    ("press-packages/81d42f7d", "press-packages/{id}"),
+    (settings.API_URL + "/digests/59885?page=2", "digests/{id}"),
+])
+def test_endpoint_template(given, expected):
+    assert http_stats.endpoint_template(given) == expected
+
+def test_stats():
+    stats = http_stats.HTTPStats()
+    stats.request("articles/1/versions/1", 503, 0.07, 10)
+    stats.retry("articles/1/versions/1", 0.5)
+    stats.request("articles/1/versions/1", 200, 0.3, 1000, limiter_wait=0.2)
+    stats.call("articles/1/versions/1", 1.0)
+    stats.request("articles/2/versions/1", None, 60)
+    stats.giveup("articles/2/versions/1")
+    stats.call("articles/2/versions/1", 60)
+
+    entry = stats.as_dict()["articles/{id}/versions/{version}"]
+    assert entry['calls'] == 2
+    assert entry['requests'] == 3
+    assert entry['statuses'] == {'503': 1, '200': 1, 'error': 1}
+    assert entry['latency']['0.1'] == 1
+    assert entry['latency']['0.5'] == 1
+    assert entry['latency']['inf'] == 1
+    assert entry['bytes'] == 1010
+    assert entry['retries'] == 1
+    assert entry['giveups'] == 1
+    assert entry['backoff-seconds'] == 0.5
+    assert entry['limiter-seconds'] == 0.2
+
+    report = stats.report().splitlines()
+    assert report[0].startswith("endpoint")
+    assert report[1].split()[:5] == ["articles/{id}/versions/{version}", "2", "3", "1", "1"]
+
+def test_consume_recorded():
+    "calls to `consume.consume` and the requests they make are recorded"
+    http_stats.STATS.reset()
+    response = mock.MagicMock(status_code=200, content=b'{"total": 0}', json=lambda: {'total': 0})
+    with mock.patch('requests.Session.get', return_value=response):
+        consume.consume("articles/123/versions/1")
+    consume._retrying({'args': [settings.API_URL + "/articles/123/versions/1"], 'wait': 1.5})
+    entry = http_stats.STATS.as_dict()["articles/{id}/versions/{version}"]
+    assert entry['calls'] == 1
+    assert entry['requests'] == 1
+    assert entry['bytes'] == 12
+    assert entry['retries'] == 1
+    assert entry['backoff-seconds'] == 1.5
+
+class LoadFromAPI(base.BaseCase):
+    def test_stats_file(self):
+        "`load_from_api` reports HTTP statistics and can write them to a file"
+        tempdir, rmdir = utils.tempdir()
+        self.addCleanup(rmdir)
+        path = os.path.join(tempdir, 'stats.json')
+        with bench.fake_api_running(scale=0.1, rate=1000):
+            retcode, _ = base.call_command('load_from_api', target=['profiles'], stats_file=path)
+        self.assertEqual(retcode, 0)
+        with open(path, 'r') as fh:
+            stats = json.load(fh)
+        self.assertEqual(list(stats.keys()), ['profiles'])
+        self.assertEqual(stats['profiles']['calls'], 3) # initial request + 2 pages of 133 profiles
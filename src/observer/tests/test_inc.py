@@ -24,6 +24,74 @@ class One(base.BaseCase):
         self.assertEqual(1, models.Article.objects.count())
         models.Article.objects.get(msid=msid)
 
+class Unchanged(base.BaseCase):
+    def test_unchanged_item_not_regenerated(self):
+        "events for content that hasn't changed since it was last downloaded are not regenerated"
+        ppid = "81d42f7d"
+        fixture = base.jsonfix('presspackages', ppid + '.json')
+        with patch('observer.consume.consume', return_value=fixture):
+            ingest_logic.download_regenerate(models.PRESSPACKAGE, ppid)
+            self.assertEqual(1, models.PressPackage.objects.count())
+
+            with patch('observer.ingest_logic.regenerate_item') as mock:
+                ingest_logic.download_regenerate(models.PRESSPACKAGE, ppid)
+                self.assertFalse(mock.called)
+
+        fixture['title'] = 'changed'
+        with patch('observer.consume.consume', return_value=fixture):
+            ingest_logic.download_regenerate(models.PRESSPACKAGE, ppid)
+        self.assertEqual(models.PressPackage.objects.get(id=ppid).title, 'changed')
+
+    def test_unchanged_item_regenerated_if_missing(self):
+        "unchanged content is regenerated if it doesn't exist yet"
+        ppid = "81d42f7d"
+        fixture = base.jsonfix('presspackages', ppid + '.json')
+        consume.upsert(ppid, models.PRESSPACKAGE, fixture)
+        with patch('observer.consume.consume', return_value=fixture):
+            ingest_logic.download_regenerate(models.PRESSPACKAGE, ppid)
+        self.assertEqual(1, models.PressPackage.objects.count())
+
+    def test_item_timeout_logged(self):
+        "a request for an item that failed without a response, like a timeout, is logged and nothing is deleted"
+        ppid = "81d42f7d"
+        fixture = base.jsonfix('presspackages', ppid + '.json')
+        with patch('observer.consume.consume', return_value=fixture):
+            ingest_logic.download_regenerate(models.PRESSPACKAGE, ppid)
+
+        with patch('observer.consume.consume', side_effect=requests.exceptions.ReadTimeout()):
+            with patch('observer.ingest_logic.LOG') as mock_log:
+                ingest_logic.download_regenerate(models.PRESSPACKAGE, ppid)
+        self.assertTrue(mock_log.error.called)
+        self.assertFalse(mock_log.exception.called)
+        self.assertEqual(1, models.PressPackage.objects.count())
+
+    def test_unchanged_article_not_regenerated(self):
+        "events for articles whose versions haven't changed since they were last downloaded are not regenerated"
+        msid = 13964
+        fixture = base.jsonfix('ajson', 'elife-13964-v1.xml.json')
+        with patch('observer.ingest_logic._fetch_version_list', return_value=[1]):
+            with patch('observer.consume.consume', return_value=fixture):
+                ingest_logic.download_regenerate_article(msid)
+                self.assertEqual(1, models.Article.objects.count())
+
+                with patch('observer.ingest_logic.regenerate_article') as mock:
+                    ingest_logic.download_regenerate_article(msid)
+                    self.assertFalse(mock.called)
+
+    def test_unchanged_article_regenerated_if_dirty(self):
+        "events for unchanged articles whose metrics have changed since they were last regenerated are regenerated"
+        msid = 13964
+        fixture = base.jsonfix('ajson', 'elife-13964-v1.xml.json')
+        with patch('observer.ingest_logic._fetch_version_list', return_value=[1]):
+            with patch('observer.consume.consume', return_value=fixture):
+                ingest_logic.download_regenerate_article(msid)
+                self.assertEqual(1, models.Article.objects.count())
+
+                ingest_logic.upsert_json(msid, None, models.METRICS_SUMMARY, {'id': msid, 'views': 1, 'downloads': 2, 'crossref': 3, 'pubmed': 4, 'scopus': 5})
+                with patch('observer.ingest_logic.regenerate_article') as mock:
+                    ingest_logic.download_regenerate_article(msid)
+                    self.assertTrue(mock.called)
+
 def test_handling_event():
     "simple events can be handled without issue."
     cases = [
@@ -113,7 +181,7 @@ def test_404_deletes_item():
     response.status_code = 404
     exc = requests.exceptions.RequestException()
     exc.response = response
-    with patch('observer.ingest_logic.download_item', side_effect=exc):
+    with patch('observer.ingest_logic._download_item', side_effect=exc):
         inc.handler(dummy_event)
 
     assert models.Content.objects.count() == 0
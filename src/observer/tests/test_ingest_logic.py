@@ -1,12 +1,15 @@
 import json
 from os.path import join
 from . import base
-from observer import ingest_logic, models, utils
+from observer import consume, ingest_logic, logic, models, utils
 from unittest.mock import patch
 from observer.ingest_logic import p, pp
 from datetime import datetime
 import pytz
 import pytest
+import requests
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 class IngestLogic(base.BaseCase):
     def setUp(self):
@@ -185,6 +188,51 @@ class IngestLogic(base.BaseCase):
         # v1 and v3 would have been ingested fine but all should be rolled back when any one fails
         self.assertRaises(models.Article.DoesNotExist, models.Article.objects.get, msid=13964)
 
+    def test_bulk_regenerate_ajson__prefetched(self):
+        "article and metrics data is loaded once per batch of articles rather than once per article"
+        ingest_logic.bulk_file_upsert(join(self.fixture_dir, 'ajson'), regen=False)
+        ingest_logic.upsert_json(13964, None, models.METRICS_SUMMARY, {'id': 13964, 'views': 1, 'downloads': 2, 'crossref': 3, 'pubmed': 4, 'scopus': 5})
+        with CaptureQueriesContext(connection) as ctx:
+            ingest_logic.regenerate_many_articles(['13964', '14850', '15378', '18675', '20125'], batches_of=3)
+        rawjson_queries = [query for query in ctx.captured_queries if 'observer_rawjson' in query['sql']]
+        self.assertEqual(len(rawjson_queries), 6) # 2 batches, 2 queries per batch to load and 1 to mark them clean
+        self.assertEqual(self.unique_article_count, models.Article.objects.count())
+
+        # same result as regenerating the article individually
+        art = models.Article.objects.get(msid=13964)
+        self.assertEqual((art.current_version, art.num_views, art.num_citations_scopus), (3, 1, 5))
+        ignore = ['id', 'datetime_record_created', 'datetime_record_updated']
+        expected, actual = utils.to_dict(art), utils.to_dict(ingest_logic.regenerate_article(13964))
+        utils.delall(expected, ignore)
+        utils.delall(actual, ignore)
+        self.assertEqual(expected, actual)
+
+    def test_bulk_regenerate_ajson__bisected(self):
+        "a batch is committed without savepoints and an article that fails to save is found and skipped"
+        ingest_logic.bulk_file_upsert(join(self.fixture_dir, 'ajson'), regen=False)
+        write_article = ingest_logic._write_article
+
+        def bad_write(msid, object_list, update=True):
+            write_article(msid, object_list, update)
+            if msid == '15378':
+                raise AssertionError("bad data")
+
+        with patch('observer.ingest_logic._write_article', side_effect=bad_write):
+            with CaptureQueriesContext(connection) as ctx:
+                ingest_logic.regenerate_many_articles(['13964', '14850', '15378', '18675', '20125'], batches_of=5)
+        self.assertEqual(self.unique_article_count - 1, models.Article.objects.count())
+        self.assertFalse(models.Article.objects.filter(msid=15378).exists())
+        self.assertEqual(list(logic.dirty_articles()), [15378])
+        # each attempt is a savepoint within the test's transaction, rather than one per article.
+        # 5 articles => [13964, 14850] + [15378, 18675, 20125] => [15378] + [18675, 20125]
+        savepoints = [query for query in ctx.captured_queries if query['sql'].startswith('SAVEPOINT')]
+        self.assertEqual(len(savepoints), 5)
+
+        with CaptureQueriesContext(connection) as ctx:
+            ingest_logic.regenerate_many_articles(['13964', '14850', '15378', '18675', '20125'], batches_of=5)
+        self.assertEqual(len([query for query in ctx.captured_queries if query['sql'].startswith('SAVEPOINT')]), 1)
+        self.assertEqual(self.unique_article_count, models.Article.objects.count())
+
 
 class IngestLogicFns(base.BaseCase):
     def test_find_author(self):
@@ -259,9 +307,221 @@ class Article(base.BaseCase):
             with patch('observer.ingest_logic._download_versions') as mock:
                 ingest_logic.download_article_versions(12345)
                 expected_msid = 12345
-                expected_num_versions = 2
-                mock.assert_called_with(expected_msid, expected_num_versions)
+                expected_versions = [1, 2]
+                mock.assert_called_with(expected_msid, expected_versions)
+
+    def test_only_new_versions_downloaded(self):
+        "versions of an article we already have are not downloaded again, except for the most recent version"
+        for version in [1, 2]:
+            fixture = base.jsonfix('ajson', 'elife-13964-v%s.xml.json' % version)
+            ingest_logic.upsert_json(13964, version, models.LAX_AJSON, fixture)
 
+        resp = {"versions": [{"status": "preprint"},
+                             {"status": "poa", "version": 1},
+                             {"status": "poa", "version": 2},
+                             {"status": "vor", "version": 3}]}
+        with patch('observer.consume.consume', return_value=resp):
+            with patch('observer.ingest_logic._download_versions') as mock:
+                ingest_logic.download_article_versions(13964)
+                mock.assert_called_with(13964, [3])
+
+    def test_versions_to_fetch(self):
+        fixture = base.jsonfix('ajson', 'elife-13964-v1.xml.json')
+        ingest_logic.upsert_json(13964, 1, models.LAX_AJSON, fixture)
+        cases = [
+            ([], []),
+            ([1], [1]), # most recent version is always fetched
+            ([1, 2], [2]),
+            ([1, 2, 3], [2, 3]),
+        ]
+        for given, expected in cases:
+            self.assertEqual(ingest_logic.versions_to_fetch('13964', given), expected)
+
+
+class ArticleIndex(base.BaseCase):
+    def listing(self, snippet_list):
+        "returns a fake `consume.consume` that serves the given `snippet_list` as the `/articles` listing"
+        def fake_consume(endpoint, params={}):
+            per_page = params.get('per-page', 100)
+            start = (params.get('page', 1) - 1) * per_page
+            return {'total': len(snippet_list), 'items': snippet_list[start:start + per_page]}
+        return fake_consume
+
+    def test_update_article_index(self):
+        "the article index is updated incrementally, stopping at the first unchanged article"
+        snippet_list = [
+            {'id': '03', 'version': 1, 'versionDate': '2020-01-03T00:00:00Z'},
+            {'id': '02', 'version': 2, 'versionDate': '2020-01-02T00:00:00Z'},
+            {'id': '01', 'version': 1, 'versionDate': '2020-01-01T00:00:00Z'},
+        ]
+        with patch('observer.consume.consume', side_effect=self.listing(snippet_list)):
+            changed = ingest_logic.update_article_index()
+        self.assertEqual(changed, [('3', 1), ('2', 2), ('1', 1)])
+        self.assertEqual(models.ArticleIndex.objects.count(), 3)
+
+        # a new article and a new version of an existing article are published
+        snippet_list = [
+            {'id': '01', 'version': 2, 'versionDate': '2020-01-05T00:00:00Z'},
+            {'id': '04', 'version': 1, 'versionDate': '2020-01-04T00:00:00Z'},
+            {'id': '03', 'version': 1, 'versionDate': '2020-01-03T00:00:00Z'},
+            {'id': '02', 'version': 2, 'versionDate': '2020-01-02T00:00:00Z'},
+        ]
+        with patch('observer.consume.consume', side_effect=self.listing(snippet_list)) as mock:
+            changed = ingest_logic.update_article_index()
+        self.assertEqual(changed, [('1', 2), ('4', 1)])
+        self.assertEqual(models.ArticleIndex.objects.count(), 4)
+        self.assertEqual(models.ArticleIndex.objects.get(msid='1').version, 2)
+        self.assertEqual(mock.call_count, 2) # initial request + first page
+
+    def test_download_all_article_versions(self):
+        "only articles that have changed in the article index or haven't been downloaded are fetched"
+        fixture = base.jsonfix('ajson', 'elife-13964-v1.xml.json')
+        ingest_logic.upsert_json(13964, 1, models.LAX_AJSON, fixture)
+        models.ArticleIndex.objects.create(msid='13964', version=2)
+        models.ArticleIndex.objects.create(msid='14850', version=1)
+        ingest_logic.upsert_json(14850, 1, models.LAX_AJSON, fixture)
+
+        snippet_list = [{'id': '20125', 'version': 1, 'versionDate': '2020-01-03T00:00:00Z'},
+                        {'id': '14850', 'version': 1, 'versionDate': None}]
+        with patch('observer.consume.consume', side_effect=self.listing(snippet_list)):
+            with patch('observer.ingest_logic._download_versions') as mock:
+                ingest_logic.download_all_article_versions()
+        expected = [
+            (('20125', [1]), {}), # new
+            (('13964', [2]), {}), # known, but version 2 is missing
+        ]
+        self.assertEqual(mock.call_args_list, expected)
+
+class Checkpoints(base.BaseCase):
+    def test_download_all_checkpointed(self):
+        "progress of a bulk download is recorded and a completed download is skipped when resumed"
+        run_id = ingest_logic.new_run_id()
+        fixture = base.jsonfix('profiles', 'many.json')
+        fixture['total'] = 300
+        with patch('observer.consume.consume', return_value=fixture) as mock:
+            ingest_logic.download_all(models.PROFILE, run_id=run_id)
+            self.assertEqual(mock.call_count, 4) # initial request + 3 pages
+        checkpoint = models.Checkpoint.objects.get(target=models.PROFILE, endpoint='profiles')
+        self.assertTrue(checkpoint.complete)
+        self.assertEqual(ingest_logic.last_run_id(), None) # nothing to resume
+
+        with patch('observer.consume.consume', return_value=fixture) as mock:
+            ingest_logic.download_all(models.PROFILE, run_id=run_id)
+            self.assertFalse(mock.called)
+
+        # a new run starts from the beginning
+        with patch('observer.consume.consume', return_value=fixture) as mock:
+            ingest_logic.download_all(models.PROFILE, run_id=ingest_logic.new_run_id())
+            self.assertEqual(mock.call_count, 4)
+
+    def test_download_all_resumed(self):
+        "an interrupted bulk download continues from the page after the last page processed"
+        run_id = ingest_logic.new_run_id()
+        ingest_logic.save_checkpoint(run_id, models.PROFILE, 'profiles', '2')
+        fixture = base.jsonfix('profiles', 'many.json')
+        fixture['total'] = 300
+        with patch('observer.consume.consume', return_value=fixture) as mock:
+            ingest_logic.download_all(models.PROFILE, run_id=run_id)
+        requested_pages = [args[1].get('page') for args, _ in mock.call_args_list]
+        self.assertEqual(requested_pages, [None, 3])
+
+    def test_download_all_article_metrics_resumed(self):
+        "an interrupted metrics download continues from the page after the last page processed"
+        run_id = ingest_logic.new_run_id()
+        ingest_logic.save_checkpoint(run_id, models.METRICS_SUMMARY, 'metrics/article/summary', '50')
+        fixture = base.jsonfix('metrics-summary', 'many.json') # 59 pages
+        with patch('observer.consume.consume', return_value=fixture) as mock:
+            ingest_logic.download_all_article_metrics(run_id=run_id)
+        self.assertEqual(mock.call_count, 1 + 9)
+        self.assertTrue(models.Checkpoint.objects.get(target=models.METRICS_SUMMARY).complete)
+
+    def test_download_all_article_versions_resumed(self):
+        "an interrupted article download continues from the msid after the last msid processed"
+        run_id = ingest_logic.new_run_id()
+        for msid in ['1', '2', '3']:
+            models.ArticleIndex.objects.create(msid=msid, version=1)
+        ingest_logic.save_checkpoint(run_id, models.LAX_AJSON, 'articles', '3')
+        with patch('observer.ingest_logic.update_article_index', return_value=[]):
+            with patch('observer.ingest_logic._download_versions') as mock:
+                ingest_logic.download_all_article_versions(run_id=run_id)
+        self.assertEqual([args[0] for args, _ in mock.call_args_list], ['2', '1'])
+        checkpoint = models.Checkpoint.objects.get(target=models.LAX_AJSON)
+        self.assertTrue(checkpoint.complete)
+
+    def test_download_all_article_versions_concurrently_checkpointed(self):
+        "the checkpoint of a concurrent article download is the lowest msid where all higher msids have been processed"
+        run_id = ingest_logic.new_run_id()
+        positions = []
+
+        def fake_download(msid_ver_list, workers, on_finish):
+            for msid in ['3', '1', '4', '2']:
+                on_finish(msid, True)
+                checkpoint = models.Checkpoint.objects.filter(target=models.LAX_AJSON).first()
+                positions.append(checkpoint and checkpoint.position)
+
+        idx = [('4', 1), ('3', 1), ('2', 1), ('1', 1)]
+        with patch('observer.ingest_logic.update_article_index', return_value=idx):
+            with patch('observer.ingest_logic.download_articles_concurrently', side_effect=fake_download):
+                ingest_logic.download_all_article_versions(workers=2, run_id=run_id)
+        self.assertEqual(positions, [None, None, '3', '1'])
+
+    def test_download_all_article_versions_concurrently_failed(self):
+        "the checkpoint of a concurrent article download never passes an article that failed"
+        run_id = ingest_logic.new_run_id()
+
+        def fake_download(msid_ver_list, workers, on_finish):
+            on_finish('4', True)
+            on_finish('2', True)
+            on_finish('3', False)
+            on_finish('1', True)
+
+        idx = [('4', 1), ('3', 1), ('2', 1), ('1', 1)]
+        with patch('observer.ingest_logic.update_article_index', return_value=idx):
+            with patch('observer.ingest_logic.download_articles_concurrently', side_effect=fake_download):
+                ingest_logic.download_all_article_versions(workers=2, run_id=run_id)
+        checkpoint = models.Checkpoint.objects.get(target=models.LAX_AJSON)
+        self.assertEqual(checkpoint.position, '4')
+        self.assertFalse(checkpoint.complete)
+
+    def test_download_all_failed_page(self):
+        "the checkpoint of a bulk download never passes a page that failed and the download isn't completed"
+        run_id = ingest_logic.new_run_id()
+        fixture = base.jsonfix('profiles', 'many.json')
+        fixture['total'] = 300
+
+        def fake_consume(endpoint, params):
+            if params.get('page') == 2:
+                raise requests.exceptions.ConnectionError()
+            return fixture
+
+        with patch('observer.consume.consume', side_effect=fake_consume):
+            ingest_logic.download_all(models.PROFILE, run_id=run_id)
+        checkpoint = models.Checkpoint.objects.get(target=models.PROFILE)
+        self.assertEqual(checkpoint.position, '1')
+        self.assertFalse(checkpoint.complete)
+
+    def test_download_all_article_metrics_failed_page(self):
+        "the checkpoint of a metrics download never passes a page that failed and the download isn't completed"
+        run_id = ingest_logic.new_run_id()
+        fixture = base.jsonfix('metrics-summary', 'many.json') # 59 pages
+
+        def fake_consume(endpoint, params):
+            if params.get('page') == 25:
+                raise requests.exceptions.ConnectionError()
+            return fixture
+
+        with patch('observer.consume.consume', side_effect=fake_consume):
+            ingest_logic.download_all_article_metrics(run_id=run_id)
+        checkpoint = models.Checkpoint.objects.get(target=models.METRICS_SUMMARY)
+        self.assertEqual(checkpoint.position, '20')
+        self.assertFalse(checkpoint.complete)
+
+    def test_last_run_id(self):
+        "the run to resume is the most recent run with an incomplete download, not a later completed run"
+        interrupted, later = ingest_logic.new_run_id(), ingest_logic.new_run_id()
+        ingest_logic.save_checkpoint(interrupted, models.LAX_AJSON, 'articles', '100')
+        ingest_logic.save_checkpoint(later, models.PROFILE, 'profiles', complete=True)
+        self.assertEqual(ingest_logic.last_run_id(), interrupted)
 
 #
 #
@@ -319,6 +579,45 @@ class Authors(base.BaseCase):
         actual = [(p.type, p.name, p.country) for p in list(authors)[-2:]]
         self.assertEqual(expected, actual)
 
+    def test_authors_keyed(self):
+        "authors are identified by a hash of their type, name and country and aren't duplicated when regenerated"
+        msid = ingest_logic.file_upsert(join(self.fixture_dir, 'ajson', 'elife-13964-v1.xml.json'))
+        ingest_logic.regenerate_article(msid)
+        self.assertEqual(24, models.Author.objects.count())
+        author = models.Author.objects.get(name='Anke Hartung')
+        self.assertEqual(author.key, models.author_key('person', ' Anke  Hartung', 'United States'))
+
+    def test_authors_interned(self):
+        "authors that have been committed aren't looked up again while interning"
+        ingest_logic.upsert_json(13964, 1, models.LAX_AJSON, base.jsonfix('ajson', 'elife-13964-v1.xml.json'))
+        with utils.interning():
+            with self.captureOnCommitCallbacks(execute=True):
+                ingest_logic.regenerate_article(13964)
+            self.assertEqual(24, models.Author.objects.count())
+            with CaptureQueriesContext(connection) as ctx:
+                ingest_logic.regenerate_article(13964)
+        author_queries = [query for query in ctx.captured_queries if 'FROM "observer_author"' in query['sql']]
+        self.assertEqual(author_queries, [])
+        self.assertEqual(24, models.Article.objects.get(msid=13964).authors.count())
+
+    def test_compact_authors(self):
+        "duplicate authors are merged and orphaned authors can be deleted"
+        msid = ingest_logic.file_upsert(join(self.fixture_dir, 'ajson', 'elife-13964-v1.xml.json'))
+        art = models.Article.objects.get(msid=msid)
+        # `bulk_create` skips `Author.save` and the key isn't set, like authors created before keys existed.
+        duplicates = models.Author.objects.bulk_create([models.Author(type='person', name='Anke Hartung', country='United States') for _ in range(2)])
+        art.authors.add(*models.Author.objects.filter(key__isnull=True))
+        models.Author.objects.create(type='person', name='Nobody', country='Nowhere')
+        self.assertEqual(27, models.Author.objects.count())
+
+        self.assertEqual(ingest_logic.compact_authors(), (2, 0))
+        self.assertEqual(25, models.Author.objects.count())
+        self.assertEqual(24, art.authors.count())
+        self.assertEqual(len(duplicates), 2)
+
+        self.assertEqual(ingest_logic.compact_authors(delete_orphans=True), (0, 1))
+        self.assertEqual(24, models.Author.objects.count())
+
 class Metrics(base.BaseCase):
     def setUp(self):
         pass
@@ -342,6 +641,128 @@ class Metrics(base.BaseCase):
         expected = {"id": 90560, "views": 11, "downloads": 0, "crossref": 0, "pubmed": 0, "scopus": 0}
         self.assertEqual(models.RawJSON.objects.get(msid=90560).json, expected)
 
+    def test_metrics_summary_consume_all__batched(self):
+        "metrics summaries are upserted in batches of pages as they are downloaded"
+        fixture = base.jsonfix('metrics-summary', 'many.json') # 5806 results, 59 pages
+        with patch('observer.consume.consume', return_value=fixture):
+            with patch('observer.ingest_logic._upsert_metrics_batch') as mock:
+                self.assertEqual(ingest_logic.download_all_article_metrics(pages_per_batch=25), 5900)
+        self.assertEqual([len(args[0]) for args, _ in mock.call_args_list], [2500, 2500, 900])
+
+class Dirty(base.BaseCase):
+    def test_dirty_articles(self):
+        "only articles whose article-json or metrics have changed since they were last regenerated are regenerated"
+        ingest_logic.upsert_json(13964, 1, models.LAX_AJSON, base.jsonfix('ajson', 'elife-13964-v1.xml.json'))
+        ingest_logic.upsert_json(14850, 1, models.LAX_AJSON, base.jsonfix('ajson', 'elife-14850-v1.xml.json'))
+        self.assertEqual(list(logic.dirty_articles()), [14850, 13964])
+
+        ingest_logic.regenerate_all_articles(dirty=True)
+        self.assertEqual(models.Article.objects.count(), 2)
+        self.assertEqual(list(logic.dirty_articles()), [])
+        self.assertFalse(models.RawJSON.objects.filter(dirty=True).exists())
+
+        # unchanged article-json doesn't dirty an article
+        ingest_logic.upsert_json(13964, 1, models.LAX_AJSON, base.jsonfix('ajson', 'elife-13964-v1.xml.json'))
+        self.assertEqual(list(logic.dirty_articles()), [])
+
+        # metrics do, but only for articles that exist
+        metrics = {'id': 13964, 'views': 1, 'downloads': 2, 'crossref': 3, 'pubmed': 4, 'scopus': 5}
+        ingest_logic._upsert_metrics_batch([metrics, dict(metrics, id=1)])
+        self.assertEqual(list(logic.dirty_articles()), [13964])
+
+        with patch('observer.ingest_logic.regenerate_many_articles') as mock:
+            ingest_logic.regenerate_all_articles(dirty=True)
+        mock.assert_called_once()
+        self.assertEqual(list(mock.call_args[0][0]), [13964]) # streamed from the database
+        self.assertEqual(mock.call_args[1], {'workers': 1})
+
+        ingest_logic.regenerate_all_articles(dirty=True)
+        self.assertEqual(models.Article.objects.get(msid=13964).num_views, 1)
+        self.assertEqual(list(logic.dirty_articles()), [])
+
+    def test_dirty_content(self):
+        "only content whose raw json has changed since it was last regenerated is regenerated"
+        fixture = base.jsonfix('presspackages', 'many.json')
+        consume.upsert_all(models.PRESSPACKAGE, fixture['items'], consume.default_idfn)
+        ingest_logic.regenerate(models.PRESSPACKAGE, dirty=True)
+        self.assertEqual(models.PressPackage.objects.count(), len(fixture['items']))
+        self.assertEqual(list(logic.dirty_content(models.PRESSPACKAGE)), [])
+
+        item = dict(fixture['items'][0], title='changed')
+        consume.upsert_all(models.PRESSPACKAGE, [item] + fixture['items'][1:], consume.default_idfn)
+        self.assertEqual(list(logic.dirty_content(models.PRESSPACKAGE)), [item['id']])
+
+        ingest_logic.regenerate(models.PRESSPACKAGE, dirty=True)
+        self.assertEqual(models.PressPackage.objects.get(id=item['id']).title, 'changed')
+        self.assertEqual(list(logic.dirty_content(models.PRESSPACKAGE)), [])
+
+class Workers(base.BaseCase):
+    def test_regenerate_articles(self):
+        "articles flattened in worker processes are the same as articles flattened in this process"
+        ingest_logic.bulk_file_upsert(join(self.fixture_dir, 'ajson'), regen=False)
+        msid_list = list(logic.known_articles())
+        ingest_logic.regenerate_many_articles(msid_list, batches_of=2, workers=2)
+        self.assertEqual(len(msid_list), models.Article.objects.count())
+        self.assertEqual(list(logic.dirty_articles()), [])
+
+        ignore = ['id', 'datetime_record_created', 'datetime_record_updated']
+        for msid in msid_list:
+            expected = utils.to_dict(models.Article.objects.get(msid=msid))
+            actual = utils.to_dict(ingest_logic.regenerate_article(msid))
+            utils.delall(expected, ignore)
+            utils.delall(actual, ignore)
+            self.assertEqual(expected, actual)
+
+    def test_regenerate_items(self):
+        "content flattened in worker processes is written by this process"
+        fixture = base.jsonfix('presspackages', 'many.json')
+        consume.upsert_all(models.PRESSPACKAGE, fixture['items'], consume.default_idfn)
+        ingest_logic.regenerate(models.PRESSPACKAGE, workers=2)
+        self.assertEqual(models.PressPackage.objects.count(), len(fixture['items']))
+        self.assertEqual(list(logic.dirty_content(models.PRESSPACKAGE)), [])
+
+class Update(base.BaseCase):
+    def test_regenerate_article_unchanged(self):
+        "regenerating an article that hasn't changed writes nothing"
+        ingest_logic.file_upsert(join(self.fixture_dir, 'ajson', 'elife-13964-v1.xml.json'))
+        with utils.QueryCounter() as counter:
+            ingest_logic.regenerate_article(13964)
+        self.assertEqual(counter.rows_written, 0)
+
+        with utils.QueryCounter() as rebuild:
+            ingest_logic._write_article(13964, ingest_logic.extract_article(13964), update=False)
+        self.assertTrue(rebuild.rows_written > 0)
+
+    def test_regenerate_article_changed(self):
+        "an article updated in place is the same as one deleted and created again"
+        ingest_logic.file_upsert(join(self.fixture_dir, 'ajson', 'elife-13964-v1.xml.json'))
+        art = models.Article.objects.get(msid=13964)
+        created = art.datetime_record_created
+
+        ajson = base.jsonfix('ajson', 'elife-13964-v1.xml.json')
+        ajson['title'] = 'changed'
+        ajson['subjects'] = ajson['subjects'][:1] + [{'id': 'ecology', 'name': 'Ecology'}]
+        ajson['authors'] = ajson['authors'][1:]
+        ingest_logic.upsert_json(13964, 1, models.LAX_AJSON, ajson)
+        ingest_logic.regenerate_article(13964)
+
+        def as_dict(art):
+            data = utils.to_dict(art)
+            data['subjects'] = sorted(art.subjects.values_list('name', flat=True))
+            data['authors'] = sorted(art.authors.values_list('key', flat=True))
+            utils.delall(data, ['id', 'datetime_record_created', 'datetime_record_updated'])
+            return data
+
+        updated = models.Article.objects.get(msid=13964)
+        self.assertEqual(updated.title, 'changed')
+        self.assertEqual(updated.datetime_record_created, created)
+        self.assertIn('ecology', as_dict(updated)['subjects'])
+        self.assertEqual(updated.authors.count(), len(ajson['authors']))
+
+        expected = as_dict(updated)
+        ingest_logic._write_article(13964, ingest_logic.extract_article(13964), update=False)
+        self.assertEqual(expected, as_dict(models.Article.objects.get(msid=13964)))
+
 class PressPackages(base.BaseCase):
     def test_download_single_presspackage(self):
         ppid = "81d42f7d"
@@ -678,3 +1099,40 @@ def test_download_with_idfn():
 
         ingest_logic.regenerate(models.PODCAST)
         assert models.Content.objects.count() == 1
+
+def fake_article_api(endpoint, params={}):
+    "serves article versions from the fixtures directory"
+    bits = endpoint.split('/') # articles/{id}/versions/{version}
+    if len(bits) == 3:
+        version_list = [1, 2, 3] if bits[1] == '13964' else [1]
+        return {'versions': [{'status': 'preprint'}] + [{'status': 'vor', 'version': v} for v in version_list]}
+    if bits[1] == '99999':
+        response = requests.Response()
+        response.status_code = 404
+        raise requests.exceptions.HTTPError(response=response)
+    return base.jsonfix('ajson', 'elife-%s-v%s.xml.json' % (bits[1], bits[3]))
+
+@pytest.mark.django_db
+def test_download_articles_concurrently():
+    "versions of many articles can be downloaded at once and each article regenerated when all it's versions are present"
+    msid_ver_list = [('13964', None), ('14850', 1), ('99999', None), ('20125', None)]
+    with patch('observer.consume.consume', side_effect=fake_article_api):
+        downloaded = ingest_logic.download_articles_concurrently(msid_ver_list, regen=True, workers=2)
+    assert sorted(downloaded) == ['13964', '14850', '20125']
+    assert models.RawJSON.objects.count() == 5
+    assert models.Article.objects.count() == 3
+    assert models.Article.objects.get(msid=13964).current_version == 3
+
+@pytest.mark.django_db
+def test_download_regenerate_article_list__concurrently():
+    "recently modified articles can be downloaded concurrently"
+    listing = {'total': 2, 'items': [{'id': '20125'}, {'id': '14850'}]}
+
+    def fake_consume(endpoint, params={}):
+        if endpoint == 'articles':
+            return listing
+        return fake_article_api(endpoint, params)
+
+    with patch('observer.consume.consume', side_effect=fake_consume):
+        ingest_logic.download_regenerate_article_list(lambda _: True, workers=2)
+    assert models.Article.objects.count() == 2
@@ -0,0 +1,46 @@
+from os.path import join
+from observer import consume, ingest_logic, models, profiling
+from . import base
+
+def test_record():
+    "time spent by a batch of items is shared between them and accumulates per stage"
+    profiler = profiling.Profiler()
+    profiler.record([('a', '1'), ('a', '2')], 'load', 0.2)
+    profiler.record([('a', '1')], 'save', 0.3)
+    profiler.record([('a', '1')], 'save', 0.1)
+    profiler.record([], 'save', 1)
+    assert profiler.timings[('a', '1')] == {'load': 0.1, 'save': 0.4}
+    assert [key for key, _ in profiler.slowest(1)] == [('a', '1')]
+    assert profiler.breakdown()['load'] == (0.2, 0.1, 0.1)
+    assert 'flatten' not in profiler.breakdown()
+
+def test_stage():
+    "stages are only timed while profiling"
+    with profiling.stage('load', [('a', '1')]):
+        pass
+    assert profiling.PROFILER is None
+
+    with profiling.profiling() as profiler:
+        with profiling.stage('load', [('a', '1')]):
+            pass
+        profiling.batch_done()
+    assert profiling.PROFILER is None
+    assert list(profiler.timings.keys()) == [('a', '1')]
+    assert len(profiler.memory) == 1
+
+class Regenerate(base.BaseCase):
+    def test_profile(self):
+        "each stage of regenerating articles and other content is timed"
+        ingest_logic.file_upsert(join(self.fixture_dir, 'ajson', 'elife-13964-v1.xml.json'), regen=False)
+        fixture = base.jsonfix('profiles', 'many.json')
+        consume.upsert_all(models.PROFILE, fixture['items'][:3], consume.default_idfn)
+
+        with profiling.profiling() as profiler:
+            ingest_logic.regenerate_all(content_type_list=[models.LAX_AJSON, models.PROFILE])
+        self.assertEqual(len(profiler.timings), 4)
+        self.assertEqual(set(profiler.timings[(models.LAX_AJSON, '13964')].keys()), set(profiling.STAGES))
+        self.assertEqual(len(profiler.memory), 2) # a batch of articles and a batch of profiles
+
+        report = profiler.report(top=2)
+        self.assertIn("2 slowest items", report)
+        self.assertIn("memory between batches", report)
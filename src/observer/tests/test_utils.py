@@ -1,5 +1,8 @@
 from datetime import datetime, date
-from observer import utils
+from dateutil import parser
+from rfc3339 import rfc3339
+import pytest, pytz
+from observer import logic, models, utils
 
 def test_pad_msid():
     cases = [
@@ -34,6 +37,59 @@ def test_ymd():
     for given, expected in cases:
         assert expected == utils.ymd(given)
 
+def _dateutil_todt(val):
+    "`utils.todt` as it was before RFC 3339 timestamps were parsed without `dateutil`"
+    return utils._utc(parser.parse(val, fuzzy=False))
+
+@pytest.mark.parametrize("given", [
+    "2016-05-27T00:00:00Z",
+    "2016-05-27T23:59:59z",
+    "2016-05-27 12:34:56Z",
+    "2016-05-27T12:34:56.123Z",
+    "2016-05-27T12:34:56.123456Z",
+    "2016-05-27T12:34:56+00:00",
+    "2016-05-27T12:34:56+05:30",
+    "2016-05-27T01:34:56-10:00",
+    "2016-05-27T12:34:56",
+    "2016-05-27",
+    "2016-02-29T00:00:00Z",
+    # unusual formats handled by `dateutil`
+    "27 May 2016",
+    "2016-05-27T12:34:56.1234567Z",
+    "20160527T123456Z",
+])
+def test_todt(given):
+    "timestamps are parsed into UTC datetimes exactly as `dateutil` would"
+    expected = _dateutil_todt(given)
+    actual = utils.todt(given)
+    assert expected == actual
+    assert actual.tzinfo == pytz.utc
+
+@pytest.mark.parametrize("given", ["2016-02-30T00:00:00Z", "2016-13-01", "24:00:00", "foo", ""])
+def test_todt__invalid(given):
+    with pytest.raises(ValueError):
+        _dateutil_todt(given)
+    with pytest.raises(ValueError):
+        utils.todt(given)
+
+def test_todt__types():
+    dt = datetime(2016, 5, 27, 12, tzinfo=pytz.utc)
+    assert utils.todt(None) is None
+    assert utils.todt(dt) is dt
+    assert utils.todt(datetime(2016, 5, 27, 12)) == dt
+    with pytest.raises(TypeError):
+        utils.todt(20160527)
+
+@pytest.mark.parametrize("given", [
+    datetime(2016, 5, 27, 12, 34, 56, 123456, tzinfo=pytz.utc),
+    datetime(2016, 5, 27, 12, 34, 56),
+    datetime(2016, 5, 27, 12, 34, 56, tzinfo=pytz.timezone('Australia/Brisbane')),
+    "2016-05-27T12:34:56+05:30",
+    "1066-10-14",
+])
+def test_ymdhms(given):
+    assert utils.ymdhms(given) == rfc3339(utils.todt(given), utc=True)
+
 def test_thumbnail_dimensions():
     cases = [
         # given (max, x, y) => expected (x, y)
@@ -80,3 +136,224 @@ def test_iiif_thumbnail_link():
     uri = "https://domain.tld/image-id.jpg"
     for given, expected in cases:
         assert expected == utils.iiif_thumbnail_link(uri, *given)
+
+def test_deepcopy():
+    "nested dicts, lists and tuples are copied, immutable values are shared"
+    class Thing:
+        pass
+    thing = Thing()
+    data = {'a': [1, {'b': (2, [3])}], 'c': utils.utcnow(), 'd': models.Article, 'e': {thing}}
+    actual = utils.deepcopy(data)
+    assert {key: val for key, val in actual.items() if key != 'e'} == {key: val for key, val in data.items() if key != 'e'}
+    assert actual['a'] is not data['a']
+    assert actual['a'][1]['b'][1] is not data['a'][1]['b'][1]
+    assert actual['d'] is models.Article
+    assert actual['e'] is not data['e'] # anything else is copied with `copy.deepcopy`
+    assert list(actual['e'])[0] is not thing
+
+def test_deepcopy__references():
+    "values referenced more than once are copied once and data that contains itself can be copied"
+    shared = {'a': [1, 2]}
+    data = {'b': shared, 'c': [shared, (shared,)]}
+    data['d'] = data
+    actual = utils.deepcopy(data)
+    assert actual['b'] is not shared
+    assert actual['b'] == shared
+    assert actual['c'][0] is actual['b']
+    assert actual['c'][1][0] is actual['b']
+    assert actual['d'] is actual
+
+def test_content_hash():
+    "the content hash is independent of key order and changes with the content"
+    assert utils.content_hash({'a': 1, 'b': [1, 2]}) == utils.content_hash({'b': [1, 2], 'a': 1})
+    assert utils.content_hash({'a': 1, 'b': [1, 2]}) != utils.content_hash({'a': 1, 'b': [2, 1]})
+
+@pytest.mark.django_db
+def test_bulk_upsert():
+    "rows are created, updated and left alone in bulk"
+    def row(msid, title):
+        data = {'title': title}
+        return {'msid': msid, 'version': None, 'json': data, 'json_type': models.PROFILE, 'content_hash': utils.content_hash(data)}
+
+    key_list, where = ['msid', 'json_type'], "version IS NULL"
+    row_list = [row('a', 'foo'), row('b', 'bar'), row('c', 'baz')]
+    assert utils.bulk_upsert(models.RawJSON, row_list, key_list, where=where, unchanged_field='content_hash') == (3, 0)
+    assert utils.bulk_upsert(models.RawJSON, row_list, key_list, where=where, unchanged_field='content_hash') == (0, 0)
+
+    row_list = [row('a', 'foo'), row('b', 'updated'), row('d', 'new'), row('d', 'newer')]
+    assert utils.bulk_upsert(models.RawJSON, row_list, key_list, where=where, unchanged_field='content_hash', batch_size=2) == (1, 1)
+    assert models.RawJSON.objects.count() == 4
+    assert models.RawJSON.objects.get(msid='b').json == {'title': 'updated'}
+    assert models.RawJSON.objects.get(msid='d').json == {'title': 'newer'} # last row wins
+
+@pytest.mark.django_db
+def test_bulk_upsert__versioned():
+    row_list = [{'msid': '1', 'version': v, 'json': {}, 'json_type': models.LAX_AJSON} for v in [1, 2]]
+    assert utils.bulk_upsert(models.RawJSON, row_list, ['msid', 'version']) == (2, 0)
+    assert utils.bulk_upsert(models.RawJSON, row_list, ['msid', 'version']) == (0, 2)
+    assert models.RawJSON.objects.count() == 2
+
+@pytest.mark.django_db
+def test_bulk_upsert__defaults():
+    "fields with a default that aren't given are set when a row is created and left alone when it's updated"
+    row_list = [{'msid': '1', 'version': 1, 'json': {}, 'json_type': models.LAX_AJSON}]
+    utils.bulk_upsert(models.RawJSON, row_list, ['msid', 'version'])
+    assert models.RawJSON.objects.get(msid='1').dirty
+    models.RawJSON.objects.update(dirty=False)
+    utils.bulk_upsert(models.RawJSON, row_list, ['msid', 'version'])
+    assert not models.RawJSON.objects.get(msid='1').dirty
+
+@pytest.mark.django_db
+def test_bulk_upsert__auto_now():
+    "fields that are set automatically when a model is saved are also set by `bulk_upsert`"
+    utils.bulk_upsert(models.ArticleIndex, [{'msid': '1', 'version': 1}], ['msid'])
+    assert models.ArticleIndex.objects.get(msid='1').datetime_record_updated is not None
+
+def _content(cid, category_list):
+    parent = {'Model': models.Content, 'key_list': ['id'],
+              'orig_data': {'id': cid, 'content_type': models.DIGEST, 'title': cid, 'datetime_published': utils.utcnow()}}
+    children = [{'Model': models.ContentCategory, 'key_list': ['name'], 'parent-relation': 'categories',
+                 'orig_data': {'name': name, 'label': label}} for name, label in category_list]
+    return (parent, children)
+
+@pytest.mark.django_db
+def test_save_objects():
+    "children of many parents are found, created, updated and attached in bulk"
+    models.ContentCategory.objects.create(name='cell-biology', label='old label')
+    queue = [
+        _content('1', [('cell-biology', 'Cell Biology'), ('neuroscience', 'Neuroscience')]),
+        _content('2', [('neuroscience', 'Neuroscience'), ('ecology', 'Ecology')]),
+    ]
+    with utils.QueryCounter() as counter:
+        utils.save_objects(queue)
+    # 2 parents * (select, update, insert) + categories (select, bulk update, bulk insert) + 1 bulk insert of relations
+    assert counter.count == 10
+
+    assert models.ContentCategory.objects.count() == 3
+    assert models.ContentCategory.objects.get(name='cell-biology').label == 'Cell Biology'
+    assert list(models.Content.objects.get(id='1').categories.values_list('name', flat=True)) == ['cell-biology', 'neuroscience']
+    assert list(models.Content.objects.get(id='2').categories.values_list('name', flat=True)) == ['ecology', 'neuroscience']
+
+    # saving again changes nothing
+    utils.save_objects([_content('1', [('cell-biology', 'Cell Biology'), ('neuroscience', 'Neuroscience')])])
+    assert models.ContentCategory.objects.count() == 3
+    assert models.Content.objects.get(id='1').categories.count() == 2
+
+@pytest.mark.django_db
+def test_save_objects__update():
+    "in update mode just the changed fields and relationships are written"
+    utils.save_objects([_content('1', [('cell-biology', 'Cell Biology'), ('neuroscience', 'Neuroscience')])])
+    created = models.Content.objects.get(id='1').datetime_record_created
+
+    with utils.QueryCounter() as counter:
+        utils.save_objects([_content('1', [('cell-biology', 'Cell Biology'), ('neuroscience', 'Neuroscience')])], update=True)
+    assert counter.rows_written == 0
+
+    with utils.QueryCounter() as counter:
+        utils.save_objects([_content('1', [('cell-biology', 'Cell Biology'), ('ecology', 'Ecology')])], update=True)
+    # 1 new category, 1 link removed, 1 link added
+    assert counter.rows_written == 3
+    content = models.Content.objects.get(id='1')
+    assert list(content.categories.values_list('name', flat=True)) == ['cell-biology', 'ecology']
+    assert content.datetime_record_created == created
+
+@pytest.mark.django_db
+def test_update_or_create():
+    "only changed fields are written and fields not given are reset to their default"
+    data = {'id': '1', 'content_type': models.DIGEST, 'title': 'foo', 'description': 'bar', 'datetime_published': utils.utcnow()}
+    inst, created, updated = utils.update_or_create(models.Content, data, ['id'])
+    assert (created, updated) == (True, False)
+
+    inst, created, updated = utils.update_or_create(models.Content, data, ['id'])
+    assert (created, updated) == (False, False)
+
+    inst, created, updated = utils.update_or_create(models.Content, utils.subdict(data, ['id', 'content_type', 'title', 'datetime_published']), ['id'])
+    assert (created, updated) == (False, True)
+    assert models.Content.objects.get(id='1').description is None
+
+@pytest.mark.django_db
+def test_commit_bisecting():
+    "items that fail on their own are found and the rest are committed"
+    def fn(item_list):
+        for item in item_list:
+            models.ContentCategory.objects.create(name=item, label=item)
+            assert item not in ['c', 'f']
+
+    committed, failed = utils.commit_bisecting(fn, list('abcdefg'))
+    assert (committed, failed) == (list('abdeg'), list('cf'))
+    assert sorted(models.ContentCategory.objects.values_list('name', flat=True)) == list('abdeg')
+
+def test_batch_sizer():
+    "batches are resized towards the target commit time by at most a factor of two each time"
+    sizer = utils.BatchSizer(10, target=1.0, maximum=100)
+    assert [len(batch) for batch in sizer.partition(range(25))] == [10, 10, 5]
+    sizer.record(10, 0.1) # 100 items a second
+    assert sizer.size == 20
+    sizer.record(20, 0.2)
+    assert sizer.size == 40
+    sizer.record(40, 0.01)
+    assert sizer.size == 80
+    sizer.record(80, 0.01)
+    assert sizer.size == 100 # maximum
+    sizer.record(100, 10) # 10 items a second
+    assert sizer.size == 50
+    sizer.record(50, 5)
+    assert sizer.size == 25
+    sizer.record(0, 0)
+    assert sizer.size == 25
+
+    batches = []
+    sizer = utils.BatchSizer(2)
+    for batch in sizer.partition(range(7)):
+        batches.append(batch)
+        sizer.size += 1
+    assert batches == [[0, 1], [2, 3, 4], [5, 6]]
+
+@pytest.mark.django_db
+def test_iter_chunked():
+    "values are read a chunk at a time, in order, without skipping or repeating any, from a single query"
+    row_list = [{'msid': str(msid), 'version': version, 'json': {}, 'json_type': models.LAX_AJSON}
+                for msid in range(1, 12) for version in [1, 2]]
+    utils.bulk_upsert(models.RawJSON, row_list, ['msid', 'version'])
+    expected = list(range(11, 0, -1))
+    assert list(logic.known_articles()) == expected
+    with utils.QueryCounter() as counter:
+        assert list(utils.iter_chunked(logic.known_articles(), chunk_size=3)) == expected
+    assert counter.count == 1
+    assert list(utils.iter_chunked(logic.known_articles(), chunk_size=11)) == expected
+
+    # rows changed while iterating don't affect the values still to come
+    actual = []
+    for msid in utils.iter_chunked(logic.dirty_articles(), chunk_size=2):
+        models.RawJSON.objects.filter(msid=str(msid)).update(dirty=False)
+        actual.append(msid)
+    assert actual == expected
+
+    models.RawJSON.objects.create(msid='b', json={}, json_type=models.PROFILE)
+    models.RawJSON.objects.create(msid='a', json={}, json_type=models.PROFILE)
+    assert list(utils.iter_chunked(logic.known_content(models.PROFILE), chunk_size=1)) == ['b', 'a']
+
+def test_progress():
+    "items done, the rate they're done at, the time remaining and failures are reported"
+    progress = utils.Progress(total=100, interval=0)
+    assert progress.eta() is None
+    progress.start -= 10 # seconds
+    progress.update(20)
+    progress.update(20, failed=[('lax-ajson', 1)])
+    assert progress.rate() == pytest.approx(4, rel=0.01)
+    assert progress.eta() == pytest.approx(15, rel=0.01)
+    assert progress.status() == "40/100 (40.0%), 4.0/sec, ETA 0:00:15, 1 failed"
+    assert progress.summary().splitlines() == ["40 done in 0:00:10 (4.0/sec), 1 failed", "failed: ('lax-ajson', 1)"]
+
+    progress = utils.Progress()
+    progress.update(1)
+    assert progress.status().startswith("1, ")
+
+@pytest.mark.django_db
+def test_resolve_children__null_keys():
+    "children whose key fields contain NULL values are found and not duplicated"
+    row_list = [{'type': 'person', 'name': 'Jane Doe', 'country': None}]
+    for _ in range(2):
+        obj_idx = utils._resolve_children(models.Author, ('country', 'name', 'type'), row_list)
+    assert list(obj_idx.keys()) == [(None, 'Jane Doe', 'person')]
+    assert models.Author.objects.count() == 1
@@ -1,17 +1,19 @@
-from functools import partial
-from rfc3339 import rfc3339
-import os, json
+from functools import partial, lru_cache
+import os, re, sys, json, hashlib, time
+import resource
 from os.path import join
 import copy
 from dateutil import parser
-from datetime import datetime, date
+from datetime import datetime, date, timedelta, timezone as dt_timezone
 import pytz
 import itertools
 import logging
 import tempfile
+import contextlib
 import shutil
 from math import ceil
-from django.db import transaction
+from django.db import transaction, connection
+from django.utils import timezone
 
 LOG = logging.getLogger(__name__)
 
@@ -26,10 +28,35 @@ second = partial(nth, n=1)
 third = partial(nth, n=2)
 last = partial(nth, n=-1)
 
-def deepcopy(d):
-    # copy.deepcopy is exceptionally slow!
-    # TODO: replace this wrapper with a faster implementation
-    return copy.deepcopy(d)
+# values that can be shared rather than copied
+_IMMUTABLE = (str, int, float, bool, type(None), bytes, datetime, date, type)
+
+def deepcopy(d, memo=None):
+    """copies `d`, like `copy.deepcopy`, but walks plain dicts, lists and tuples itself and shares immutable values.
+    `copy.deepcopy` is exceptionally slow! anything else is copied with `copy.deepcopy`.
+    like `copy.deepcopy`, `memo` maps the id of each value already copied to it's copy, so values referenced more than
+    once are copied once and data that contains itself can be copied."""
+    if isinstance(d, _IMMUTABLE):
+        return d
+    if memo is None:
+        memo = {}
+    d_id = id(d)
+    if d_id in memo:
+        return memo[d_id]
+    if type(d) is dict:
+        result = memo[d_id] = {}
+        for key, val in d.items():
+            result[key] = deepcopy(val, memo)
+        return result
+    if type(d) is list:
+        result = memo[d_id] = []
+        result.extend(deepcopy(val, memo) for val in d)
+        return result
+    if type(d) is tuple:
+        result = tuple(deepcopy(val, memo) for val in d)
+        # a tuple that contains itself, through a mutable value, has already been copied while copying that value
+        return memo.setdefault(d_id, result)
+    return copy.deepcopy(d, memo)
 
 def ensure(assertion, msg, *args):
     """intended as a convenient replacement for `assert` statements that
@@ -76,16 +103,8 @@ def val_map(fn, d):
 def key_map(fn, d):
     return {fn(k): v for k, v in d.items()}
 
-def todt(val):
-    "turn almost any formatted datetime string into a UTC datetime object"
-    if val is None:
-        return None
-
-    if isinstance(val, datetime):
-        dt = val # don't attempt to parse, work with what we have
-    else:
-        dt = parser.parse(val, fuzzy=False)
-
+def _utc(dt, val=None):
+    "returns the given datetime `dt`, parsed from `val`, as a datetime in UTC"
     if dt.tzinfo:
         if dt.tzinfo != pytz.utc:
             LOG.debug("got an aware dt that isn't in UTC: %r", dt)
@@ -97,11 +116,55 @@ def todt(val):
     LOG.debug("encountered naive timestamp %r from %r. UTC assumed.", dt, val)
     return pytz.utc.localize(dt)
 
+# the RFC 3339 timestamps returned by the eLife API, like "2016-05-27T00:00:00Z", and plain dates like "2016-05-27".
+RFC3339_RE = re.compile(r"^(\d{4})-(\d{2})-(\d{2})(?:[Tt ](\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6}))?([Zz]|[+-]\d{2}:\d{2})?)?$")
+
+def parse_rfc3339(val):
+    """parses the RFC 3339 timestamp `val` into a datetime without using `dateutil`.
+    returns `None` if `val` isn't in a supported format and raises a `ValueError` if it's not a valid date."""
+    match = RFC3339_RE.match(val)
+    if not match:
+        return None
+    year, month, day, hour, minute, seconds, fraction, offset = match.groups()
+    dt = datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(seconds or 0),
+                  int(fraction.ljust(6, '0')) if fraction else 0)
+    if not offset:
+        return dt
+    if offset in 'Zz':
+        return dt.replace(tzinfo=pytz.utc)
+    delta = timedelta(hours=int(offset[1:3]), minutes=int(offset[4:6]))
+    return dt.replace(tzinfo=dt_timezone(-delta if offset[0] == '-' else delta))
+
+@lru_cache(maxsize=8192)
+def _str_todt(val):
+    "parses a datetime string into a UTC datetime. the same timestamps are parsed many times, results are cached."
+    try:
+        dt = parse_rfc3339(val)
+    except ValueError:
+        dt = None # let `dateutil` decide what is and isn't valid
+    if dt is None:
+        dt = parser.parse(val, fuzzy=False)
+    return _utc(dt, val)
+
+def todt(val):
+    "turn almost any formatted datetime string into a UTC datetime object"
+    if val is None:
+        return None
+
+    if isinstance(val, datetime):
+        return _utc(val) # don't attempt to parse, work with what we have
+
+    if isinstance(val, str):
+        return _str_todt(val)
+
+    return _utc(parser.parse(val, fuzzy=False), val)
+
 def ymdhms(dt):
     "returns an rfc3339 representation of a datetime object"
     if dt:
         dt = todt(dt) # convert to utc, etc
-        return rfc3339(dt, utc=True)
+        # same as `rfc3339(dt, utc=True)`
+        return "%04d-%02d-%02dT%02d:%02d:%02dZ" % (dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second)
 
 def ymd(dt):
     if dt:
@@ -184,6 +247,11 @@ def json_dumps(data, **kwargs):
 
     return json.dumps(data, default=coerce, **kwargs)
 
+def content_hash(data):
+    "returns a hash of the given JSON-serialisable `data` that is independent of key order"
+    data = json.dumps(data, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
 def renkey(ddict, oldkey, newkey):
     "renames a key in ddict from oldkey to newkey"
     if oldkey in ddict:
@@ -204,12 +272,133 @@ def pad_msid(msid):
 def norm_msid(msid):
     return str(msid).lstrip('0')
 
-def do_all_atomically(fn, idlist, batches_of=25):
-    @transaction.atomic
-    def _(sub_list):
-        lmap(fn, sub_list)
-        LOG.info("comitting %s objects" % len(sub_list))
-    return lmap(_, partition(idlist, batches_of))
+class QueryCounter:
+    """counts the database queries made, and the rows they inserted, updated or deleted, while in use as a context manager.
+    usage: with QueryCounter() as counter: ...; counter.count, counter.rows_written"""
+
+    def __init__(self):
+        self.count = 0
+        self.rows_written = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        result = execute(sql, params, many, context)
+        if sql.lstrip()[:6].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+            self.rows_written += max(context['cursor'].rowcount, 0) # -1 when unknown
+        return result
+
+    def __enter__(self):
+        self._wrapper = connection.execute_wrapper(self)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        return self._wrapper.__exit__(*args)
+
+def _duration(seconds):
+    return str(timedelta(seconds=int(seconds)))
+
+class Progress:
+    """tracks a task over `total` items, logging the number done, the number done per second and an estimate of the
+    time remaining at most once every `interval` seconds. items that failed are remembered for the summary.
+    usage: progress = Progress(total); ...; progress.update(len(batch), failed=[...]); print(progress.summary())"""
+
+    def __init__(self, total=None, interval=5):
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.failed = []
+        self.start = self.last_report = time.monotonic()
+
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    def rate(self):
+        "returns the number of items done per second"
+        elapsed = self.elapsed()
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def eta(self):
+        "returns the estimated number of seconds remaining or `None` if it can't be estimated yet"
+        rate = self.rate()
+        if self.total is None or not rate:
+            return None
+        return max(self.total - self.done, 0) / rate
+
+    def update(self, num, failed=None):
+        "records that `num` more items have been done, including any that `failed`"
+        self.done += num
+        self.failed.extend(failed or [])
+        now = time.monotonic()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            LOG.info(self.status())
+
+    def status(self):
+        "returns a line like '1200/5000 (24.0%), 85.2/sec, ETA 0:00:44, 2 failed'"
+        done = str(self.done)
+        if self.total:
+            done = "%s/%s (%.1f%%)" % (self.done, self.total, self.done / self.total * 100)
+        eta = self.eta()
+        eta = _duration(eta) if eta is not None else "unknown"
+        return "%s, %.1f/sec, ETA %s, %s failed" % (done, self.rate(), eta, len(self.failed))
+
+    def summary(self):
+        "returns a description of the completed task and a line per failed item"
+        line_list = ["%s done in %s (%.1f/sec), %s failed" % (self.done, _duration(self.elapsed()), self.rate(), len(self.failed))]
+        line_list.extend("failed: %s" % (item,) for item in self.failed)
+        return "\n".join(line_list)
+
+def iter_chunked(queryset, chunk_size=2000):
+    """yields each value in `queryset`, `chunk_size` rows at a time, without caching them like evaluating `queryset` does.
+    the query is run just once, using a server-side cursor where the database supports one, so the cost of sorting
+    it's results is paid once rather than once per chunk."""
+    return queryset.iterator(chunk_size=chunk_size)
+
+def commit_bisecting(fn, item_list, errors=(AssertionError, KeyError)):
+    """calls `fn` with `item_list` in a single transaction, without a savepoint per item.
+    if `fn` raises one of `errors` the transaction is rolled back and each half of `item_list` is tried again in it's own
+    transaction, and so on, until just the items that fail on their own remain.
+    returns a pair of (committed, failed) item lists."""
+    try:
+        with transaction.atomic():
+            fn(item_list)
+        return item_list, []
+    except errors:
+        if len(item_list) == 1:
+            return [], item_list
+    mid = len(item_list) // 2
+    committed, failed = commit_bisecting(fn, item_list[:mid], errors)
+    committed2, failed2 = commit_bisecting(fn, item_list[mid:], errors)
+    return committed + committed2, failed + failed2
+
+class BatchSizer:
+    """suggests the size of the next batch so that committing a batch takes about `target` seconds.
+    the size at most halves or doubles after each batch and stays between `minimum` and `maximum`.
+    usage: for batch in sizer.partition(id_list): ...; sizer.record(len(batch), elapsed)"""
+
+    def __init__(self, size=25, target=1.0, minimum=1, maximum=1000):
+        self.size = size
+        self.target = target
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def record(self, num, elapsed):
+        "records that a batch of `num` items took `elapsed` seconds to commit"
+        if num < 1 or elapsed <= 0:
+            return
+        ideal = self.target / (elapsed / num)
+        size = min(max(ideal, self.size / 2, self.minimum), self.size * 2, self.maximum)
+        self.size = max(int(size), 1)
+
+    def partition(self, seq):
+        "like `partition`, but each batch is the suggested size at the time it's taken from `seq`"
+        seq = iter(seq)
+        while True:
+            batch = list(itertools.islice(seq, self.size))
+            if not batch:
+                return
+            yield batch
 
 EXCLUDE_ME = 0xDEADBEEF
 
@@ -241,33 +430,284 @@ def create_or_update(Model, orig_data, key_list=None, create=True, update=True,
     # in this case if the model cannot be found then None is returned: (None, False, False)
     return (inst, created, updated)
 
-def save_objects(queue):
+def update_or_create(Model, orig_data, key_list):
+    """like `create_or_update` but only the fields whose values differ from the stored object are written.
+    fields not in `orig_data` are reset to their default, as if the object had been deleted and created again,
+    except fields that are set automatically when an object is created.
+    returns a triple of (inst, created, updated)"""
+    data = {key: val for key, val in orig_data.items() if val != EXCLUDE_ME}
+    inst = Model.objects.filter(**subdict(data, key_list)).first()
+    if not inst:
+        inst = Model(**data)
+        inst.save()
+        return (inst, True, False)
+
+    changed = []
+    auto_now_list = []
+    for field in Model._meta.concrete_fields:
+        if getattr(field, 'auto_now', False):
+            auto_now_list.append(field.name)
+        if field.primary_key or field.name in key_list or getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False):
+            continue
+        val = field.to_python(data[field.name]) if field.name in data else field.get_default()
+        if getattr(inst, field.attname) != val:
+            setattr(inst, field.attname, val)
+            changed.append(field.name)
+    if not changed:
+        return (inst, False, False)
+    inst.save(update_fields=changed + auto_now_list)
+    return (inst, False, True)
+
+def _bulk_upsert_sql(Model, column_list, key_list, num_rows, where=None, unchanged_field=None, insert_only=()):
+    """returns the `INSERT ... ON CONFLICT ... DO UPDATE` statement used by `bulk_upsert`.
+    columns in `insert_only` are set when a row is created but not when it's updated."""
+    qn = connection.ops.quote_name
+    table = qn(Model._meta.db_table)
+    placeholders = "(%s)" % ", ".join(["%s"] * len(column_list))
+    update_list = [col for col in column_list if col not in key_list and col not in insert_only]
+    sql = "INSERT INTO %s (%s) VALUES %s ON CONFLICT (%s)" % (
+        table, ", ".join(map(qn, column_list)), ", ".join([placeholders] * num_rows), ", ".join(map(qn, key_list)))
+    if where:
+        sql += " WHERE %s" % where # conflicts with a partial unique index
+    if not update_list:
+        return sql + " DO NOTHING"
+    sql += " DO UPDATE SET %s" % ", ".join("%s = excluded.%s" % (qn(col), qn(col)) for col in update_list)
+    if unchanged_field:
+        distinct = "IS NOT" if connection.vendor == 'sqlite' else "IS DISTINCT FROM"
+        sql += " WHERE %s.%s %s excluded.%s" % (table, qn(unchanged_field), distinct, qn(unchanged_field))
+    return sql
+
+def bulk_upsert(Model, row_list, key_list, batch_size=500, where=None, unchanged_field=None):
+    """inserts or updates many rows of `Model` using the database's native upsert, `INSERT ... ON CONFLICT`.
+    each row in `row_list` is a map of field names to values, like the `orig_data` given to `create_or_update`,
+    and all rows must have the same fields.
+    `key_list` are the fields of a unique constraint that identify a row. if the constraint is partial then
+    `where` is it's condition as SQL, for example "version IS NULL".
+    rows whose `unchanged_field` value is the same as the stored value are not updated.
+    fields with a default that aren't in `row_list` are set to their default when a row is created.
+    when the same key appears more than once in `row_list` the last row wins.
+    returns a pair of (created, updated) counts."""
+    fields = {field.name: field for field in Model._meta.concrete_fields}
+    key_fields = [fields[key] for key in key_list]
+
+    def keyfn(row):
+        return tuple(field.to_python(row[field.name]) for field in key_fields)
+
+    row_idx = {keyfn(row): row for row in row_list}
+    if not row_idx:
+        return (0, 0)
+
+    if connection.vendor not in ['postgresql', 'sqlite']:
+        created = updated = 0
+        for row in row_idx.values():
+            _, c, u = create_or_update(Model, row, key_list)
+            created, updated = created + c, updated + u
+        return (created, updated)
+
+    # fields that are set automatically when saving a model instance are set here too
+    now = timezone.now()
+    auto_now_list = [f.name for f in fields.values() if getattr(f, 'auto_now', False) or getattr(f, 'auto_now_add', False)]
+    name_list = list(next(iter(row_idx.values())).keys()) # all rows are expected to have the same fields
+    name_list += [name for name in auto_now_list if name not in name_list]
+    # fields with a default that aren't given are set to their default when created and left alone when updated
+    default_list = [f.name for f in fields.values() if f.has_default() and f.name not in name_list]
+    name_list += default_list
+    column_list = [fields[name].column for name in name_list]
+    batch_size = min(batch_size, connection.ops.bulk_batch_size(name_list, list(row_idx.values())) or batch_size)
+
+    created = updated = 0
+    with transaction.atomic():
+        for batch in partition(list(row_idx.items()), batch_size):
+            # find the rows that already exist to count what is created and what is updated
+            existing_qs = Model.objects.filter(**{key_list[0] + '__in': set(key[0] for key, _ in batch)})
+            if where:
+                existing_qs = existing_qs.extra(where=[where])
+            existing = {tuple(vals[:len(key_list)]): vals[-1] for vals in existing_qs.values_list(*key_list, unchanged_field or key_list[0])}
+
+            params = []
+            for key, row in batch:
+                if key not in existing:
+                    created += 1
+                elif not unchanged_field or existing[key] != row[unchanged_field]:
+                    updated += 1
+                for name in name_list:
+                    if name in default_list:
+                        val = fields[name].get_default()
+                    else:
+                        val = now if (name in auto_now_list and name not in row) else row[name]
+                    params.append(fields[name].get_db_prep_save(val, connection))
+
+            sql = _bulk_upsert_sql(Model, column_list, [f.column for f in key_fields], len(batch), where,
+                                   unchanged_field and fields[unchanged_field].column, [fields[name].column for name in default_list])
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+
+    return (created, updated)
+
+def _child_key(Model, key_list, row):
+    return tuple(Model._meta.get_field(key).to_python(row[key]) for key in key_list)
+
+# primary keys of children known to exist, {Model: {key: pk, ...}, ...}. see `interning`.
+_INTERNED = {'cache': None}
+
+@contextlib.contextmanager
+def interning():
+    """while in use, `save_objects` remembers the primary keys of children marked with 'intern' that it has found or
+    created and doesn't look for them in the database again.
+    interned children are never updated and are only remembered once the transaction creating them commits."""
+    previous = _INTERNED['cache']
+    if previous is None:
+        _INTERNED['cache'] = {}
+    try:
+        yield _INTERNED['cache']
+    finally:
+        _INTERNED['cache'] = previous
+
+def _resolve_children(Model, key_list, row_list, interned=None):
+    """finds or creates the `Model` objects described by the maps of field values in `row_list`.
+    existing objects are found by their `key_list` fields and updated if their other fields differ.
+    a constant number of queries are made regardless of the number of rows.
+    if `interned`, a map of {key: pk}, is given then those objects are assumed to exist and objects are never updated.
+    returns a map of {key: pk, ...}"""
+    row_idx = {_child_key(Model, key_list, row): row for row in row_list}
+    known = {}
+    if interned is not None:
+        known = {key: interned[key] for key in row_idx if key in interned}
+        row_idx = {key: row for key, row in row_idx.items() if key not in known}
+        if not row_idx:
+            return known
+
+    def objkey(obj):
+        return _child_key(Model, key_list, {key: getattr(obj, key) for key in key_list})
+
+    def lookup():
+        "returns a map of {key: obj, ...} for all objects in `row_idx` that exist"
+        qs = Model.objects.all()
+        for i, key in enumerate(key_list):
+            val_set = set(row_key[i] for row_key in row_idx)
+            if None not in val_set: # NULL never matches an `IN` clause
+                qs = qs.filter(**{key + '__in': val_set})
+        return {objkey(obj): obj for obj in qs if objkey(obj) in row_idx}
+
+    obj_idx = lookup()
+
+    # update existing objects
+    changed = set()
+    if interned is None:
+        for key, obj in obj_idx.items():
+            for field, val in row_idx[key].items():
+                if getattr(obj, field) != val:
+                    setattr(obj, field, val)
+                    changed.add(field)
+    if changed:
+        Model.objects.bulk_update(obj_idx.values(), list(changed))
+
+    # create missing objects
+    missing = [Model(**row) for key, row in row_idx.items() if key not in obj_idx]
+    if missing:
+        created = Model.objects.bulk_create(missing)
+        if all(obj.pk is not None for obj in created):
+            obj_idx.update({objkey(obj): obj for obj in created})
+        else:
+            # not all databases return the primary keys of created objects
+            obj_idx = lookup()
+
+    pk_idx = {key: obj.pk for key, obj in obj_idx.items()}
+    if interned is not None:
+        transaction.on_commit(partial(interned.update, pk_idx))
+    pk_idx.update(known)
+    return pk_idx
+
+def save_objects(queue, update=False):
     """complements create_or_update(), saves a list of pairs of (parent, children-list).
     each parent and each child are the kwargs to be passed to `create_or_update`.
     each child requires an extra kwarg 'parent-relation' which will be used to 'attach' the
     child to the parent.
     An actual 'queue' object with queue semantics is not necessary but order is important!
     parents must exist *before* children can be inserted and associated with them.
+
+    children are saved in bulk: the children of *all* parents in the `queue` are found or created with a
+    few queries per type of child and attached to their parents with a single query per relationship.
+    children with a truthy 'intern' kwarg are remembered between calls, see `interning`.
+
+    if `update` is `True`, existing parents are updated in place with `update_or_create` and any children
+    attached to them that aren't in their children-list are detached, rather than the parents having been deleted first.
     """
+    parent_list = []
     for parent_kwargs, children in queue:
         ensure(isinstance(children, list), "'children' must be a list.")
-        parent = create_or_update(**parent_kwargs)[0]
+        if update:
+            parent = update_or_create(parent_kwargs['Model'], parent_kwargs['orig_data'], parent_kwargs['key_list'])[0]
+        else:
+            parent = create_or_update(**parent_kwargs)[0]
+        parent_list.append((parent, children))
 
-        child_idx = {}
+    # group the children of all parents by type of child
+    child_rows = {} # {(Model, key-list, intern): [row, ...], ...}
+    relations = [] # [(parent, relationship, (Model, key-list, intern), row), ...]
+    for parent, children in parent_list:
         for child_kwargs in children:
             ensure('parent-relation' in child_kwargs, "child is missing synthetic 'parent-relation' key.")
-            key = child_kwargs.pop('parent-relation') # ll: 'subjects', 'authors', etc
-            childobj = create_or_update(**child_kwargs)[0]
-            child_list = child_idx.get(key, [])
-            child_list.append(childobj)
-            child_idx[key] = child_list
-
-        # attach children to parent
-        # ll: article.subjects.add(subj1, subj2, ..., subjN)
-        for relationship, childobj_list in child_idx.items():
-            getattr(parent, relationship).add(*childobj_list)
-        # re-save the parent
-        parent.save()
+            relationship = child_kwargs['parent-relation'] # ll: 'subjects', 'authors', etc
+            row = child_kwargs['orig_data'] # never modified, only copied if values must be excluded
+            if EXCLUDE_ME in row.values():
+                row = {key: val for key, val in row.items() if val != EXCLUDE_ME}
+            child_type = (child_kwargs['Model'], tuple(child_kwargs.get('key_list') or sorted(row.keys())), bool(child_kwargs.get('intern')))
+            child_rows.setdefault(child_type, []).append(row)
+            relations.append((parent, relationship, child_type, row))
+
+    child_idx = {}
+    for child_type, row_list in child_rows.items():
+        Model, key_list, intern = child_type
+        interned = None
+        if intern and _INTERNED['cache'] is not None:
+            interned = _INTERNED['cache'].setdefault(Model, {})
+        child_idx[child_type] = _resolve_children(Model, key_list, row_list, interned)
+
+    # attach children to parents
+    # ll: article.subjects.add(subj1, subj2, ..., subjN)
+    through_rows = {} # {Through: set([(parent-pk, child-pk), ...]), ...}
+    for parent, relationship, child_type, row in relations:
+        Model, key_list, _ = child_type
+        field = type(parent)._meta.get_field(relationship)
+        child_pk = child_idx[child_type][_child_key(Model, key_list, row)]
+        through = (field.remote_field.through, field.m2m_field_name(), field.m2m_reverse_field_name())
+        through_rows.setdefault(through, set()).add((parent.pk, child_pk))
+
+    if update:
+        # existing links between parents and children, including relationships with no children this time
+        existing_rows = {} # {Through: {(parent-pk, child-pk): through-pk, ...}, ...}
+        parent_idx = {}
+        for parent, _ in parent_list:
+            parent_idx.setdefault(type(parent), set()).add(parent.pk)
+        for ParentModel, parent_pk_set in parent_idx.items():
+            for field in ParentModel._meta.many_to_many:
+                through = (field.remote_field.through, field.m2m_field_name(), field.m2m_reverse_field_name())
+                Through, parent_field, child_field = through
+                rows = Through.objects \
+                    .filter(**{parent_field + '_id__in': parent_pk_set}) \
+                    .values_list(parent_field + '_id', child_field + '_id', 'pk')
+                existing_rows[through] = {(parent_pk, child_pk): pk for parent_pk, child_pk, pk in rows}
+
+        for through, existing in existing_rows.items():
+            wanted = through_rows.get(through, set())
+            removed = [pk for pair, pk in existing.items() if pair not in wanted]
+            if removed:
+                through[0].objects.filter(pk__in=removed).delete()
+            through_rows[through] = wanted - set(existing.keys())
+
+    for (Through, parent_field, child_field), pair_list in through_rows.items():
+        if not pair_list:
+            continue
+        Through.objects.bulk_create([Through(**{parent_field + '_id': parent_pk, child_field + '_id': child_pk})
+                                     for parent_pk, child_pk in pair_list], ignore_conflicts=True)
+
+def peak_memory():
+    "returns the peak resident set size of the current process in MiB"
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak = peak / 1024 # reported in bytes on MacOS, kilobytes elsewhere
+    return round(peak / 1024, 1)
 
 def tempdir():
     # usage: tempdir, killer = tempdir(); killer()